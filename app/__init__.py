@@ -4,17 +4,33 @@ import os
 
 # Third party libraries
 from flask import Flask
-from mongoengine import connect
+from mongoengine import connect, disconnect
 from flask_login import LoginManager
 #from oauthlib.oauth2 import WebApplicationClient
 import certifi
 from app.utils.secrets import getSecrets
+from app.utils.querystats import QueryStats
+from app.utils.profiler import SamplingProfiler
+from app.utils.metrics import Metrics, PoolMetrics
+from app.utils.deadline import Deadlines
+from app.utils.ratelimit import RateLimiter
+from app.utils.assets import StaticAssets
+from app.utils.compress import Compress
+from app.utils.readrouting import ReadRouting
+from app.utils.livefeed import LiveFeed
+from app.utils.autocomplete import Autocomplete
+from app.utils.moderation import Moderation
+from app.utils.doccache import DocumentCache
+from app.utils.clinicimport import ClinicImport
 from flask_moment import Moment
 import base64
 
 # Flask app setup
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or os.urandom(24)
+# The biggest request (in bytes) the site accepts, mostly to cap profile picture
+# uploads. Anything bigger gets a 413 error before it is read.
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 5 * 1024 * 1024))
 
 # Configuration
 secrets = getSecrets()
@@ -25,8 +41,87 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+# Counts and times the MongoDB commands for each request (see app/utils/querystats.py)
+queryStats = QueryStats(app)
+
+# Opt-in sampling profiler for slow routes (see app/utils/profiler.py)
+profiler = SamplingProfiler(app)
+
+# Prometheus numbers at /metrics (see app/utils/metrics.py)
+metrics = Metrics(app)
+
+# A time budget for each route, sent to MongoDB as maxTimeMS (see app/utils/deadline.py)
+deadlines = Deadlines(app)
+
+# Per-user limits on the routes that create things (see app/utils/ratelimit.py)
+rateLimiter = RateLimiter(app)
+
+# static_url() for templates and long cached static files (see app/utils/assets.py)
+assets = StaticAssets(app)
+
+# gzip/brotli for HTML and other text responses (see app/utils/compress.py)
+compress = Compress(app)
+
+# Read-only pages can read from replica set secondaries (see app/utils/readrouting.py)
+readRouting = ReadRouting(app)
+
+# Live new replies and comments over Server-Sent Events (see app/utils/livefeed.py)
+liveFeed = LiveFeed(app)
+
+# In-memory name search for /autocomplete (see app/utils/autocomplete.py)
+autocomplete = Autocomplete(app)
+
+# Staff-only bulk delete and edit at /moderate (see app/utils/moderation.py)
+moderation = Moderation(app)
+
+# Per-worker cache for objects.get(id=...) on users, clubs, sports and clinics
+# (see app/utils/doccache.py)
+documentCache = DocumentCache(app)
+
+# Bulk clinic CSV imports with rate limited geocoding (see app/utils/clinicimport.py)
+clinicImport = ClinicImport(app)
+
+# Database setup
+# Atlas (mongodb+srv:// hosts) needs TLS, with certifi's certificates so it works the same
+# on every computer. A plain local mongod like the ones bench/ uses has no TLS, and
+# pymongo turns TLS on whenever it is given a tlsCAFile, so the certificates are only
+# passed for hosts that use TLS. MONGO_TLS=1 or MONGO_TLS=0 decides it for any host.
+def tlsOptions(host):
+    setting = os.environ.get("MONGO_TLS")
+    if setting is not None:
+        useTls = setting == "1"
+    else:
+        query = host.partition("?")[2].lower()
+        useTls = host.startswith("mongodb+srv://") or "tls=true" in query or "ssl=true" in query
+    if not useTls:
+        return {}
+    return {"tls": True, "tlsCAFile": certifi.where()}
+
+# A MongoClient must not be shared across a fork, so the connection is lazy: with
+# connect=False pymongo does not open sockets or start its monitor threads until the
+# first query. When running under gunicorn each worker calls connectDB() again in
+# post_fork (see gunicorn.conf.py) to get its own client with a pool sized to its threads.
+def connectDB(maxPoolSize=None, minPoolSize=None):
+    if maxPoolSize is None:
+        maxPoolSize = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+    if minPoolSize is None:
+        minPoolSize = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+    # throw away any client this process inherited before making a new one
+    disconnect()
+    # MONGO_DB_NAME and MONGO_HOST can be set in the environment to point the app at a
+    # different database (like the benchmark database in bench/) without editing secrets.py
+    host = os.environ.get("MONGO_HOST") or secrets['MONGO_HOST']
+    connect(
+        os.environ.get("MONGO_DB_NAME") or secrets['MONGO_DB_NAME'],
+        host=host,
+        **tlsOptions(host),
+        maxPoolSize=maxPoolSize,
+        minPoolSize=min(minPoolSize, maxPoolSize),
+        connect=False,
+        event_listeners=[queryStats, PoolMetrics(), readRouting, documentCache],
+    )
+
+connectDB()
 moment = Moment(app)
 
 def base64encode(img):
@@ -37,3 +132,4 @@ def base64encode(img):
 app.jinja_env.globals.update(base64encode=base64encode)
 
 from .routes import *
+from .utils import datacli, recommend, migrations
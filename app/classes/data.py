@@ -3,27 +3,26 @@
 # the name of the data collection and each item is a data 'field' that stores a piece of data.  Data 
 # fields have types like IntField, StringField etc.  This uses the Mongoengine Python Library. When 
 # you interact with the data you are creating an onject that is an instance of the class.
+#
+# Every class uses RoutedQuerySet so read-only pages can read from a replica set
+# secondary (see app/utils/readrouting.py). User, Clinic, Club and Sport use
+# CachedQuerySet, which does the same and also keeps objects.get(id=...) lookups in a
+# per-worker cache (see app/utils/doccache.py).
 
-from sys import getprofile
-from tokenize import String
-from typing import KeysView
-from xmlrpc.client import Boolean
-
-from setuptools import SetuptoolsDeprecationWarning
 from app import app
-from flask import flash, redirect
-from flask_login import UserMixin, current_user
-from mongoengine import Document, ListField, FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, CASCADE
+from flask_login import UserMixin
+from mongoengine import Document, ListField, FileField, EmailField, StringField, IntField, ReferenceField, LazyReferenceField, DateTimeField, BooleanField, FloatField, ObjectIdField, CASCADE
+from app.utils.readrouting import RoutedQuerySet
+from app.utils.doccache import CachedQuerySet
 import datetime as dt
-import jwt
-from time import time
-from bson.objectid import ObjectId
-from flask_security import RoleMixin
-from functools import wraps
 
 
 class User(UserMixin, Document):
-    createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    # The old name (which never got a default because of a typo). Migration 2 in
+    # app/utils/migrations.py moves it to create_date; it stays declared until every
+    # database has been migrated so users that still have it can load.
+    createdate = DateTimeField()
     gid = StringField(sparse=True, unique=True)
     gname = StringField()
     gprofile_pic = StringField()
@@ -35,10 +34,30 @@ class User(UserMixin, Document):
     prononuns = StringField()
     role = StringField()
     grade = IntField()
+    # Staff can use the bulk moderation pages at /moderate (see app/utils/moderation.py).
+    # Only set from the command line: flask --app main moderate staff <email>
+    staff = BooleanField(default=False)
 
 
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        'queryset_class': CachedQuerySet
+    }
+
+# One row per distinct uploaded file, named by the SHA-256 of its bytes. Users who upload
+# the same picture share one GridFS file, and refs counts how many users point at it so
+# the file is deleted when the last one changes their picture (see app/utils/blobstore.py).
+class Blob(Document):
+    sha256 = StringField(primary_key=True)
+    grid_id = ObjectIdField()
+    refs = IntField(default=0)
+    length = IntField()
+    content_type = StringField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'indexes': ['grid_id'],
+        'queryset_class': RoutedQuerySet
     }
 
 class Blog(Document):
@@ -46,11 +65,17 @@ class Blog(Document):
     subject = StringField()
     content = StringField()
     tag = StringField()
+    # How many comments this blog has. Kept up to date with $inc by commentNew and
+    # commentDelete so the blog list can show it without counting. 'flask data
+    # reconcile-counters' fixes it if it ever drifts.
+    comment_count = IntField(default=0)
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', ('-create_date', '-_id')],
+        'queryset_class': RoutedQuerySet
     }
 
 class Comment(Document):
@@ -65,12 +90,21 @@ class Comment(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        # 'comment' is for finding the comments made on a comment when it is deleted in
+        # bulk (see app/utils/moderation.py)
+        'indexes': ['author', 'blog', 'comment'],
+        'queryset_class': RoutedQuerySet
     }
 
 class Clinic(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
-    createdate = DateTimeField(default=dt.datetime.utcnow)
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField()
+    # The names every other collection doesn't use. Migration 1 in
+    # app/utils/migrations.py renames them; they stay declared until every database has
+    # been migrated so clinics that still have them can load.
+    createdate = DateTimeField()
     modifydate = DateTimeField()
     name = StringField()
     streetAddress = StringField()
@@ -82,7 +116,9 @@ class Clinic(Document):
     lon = FloatField()
     
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', ('-create_date', '-_id')],
+        'queryset_class': CachedQuerySet
     }
 
 class Review(Document):
@@ -92,11 +128,16 @@ class Review(Document):
     text = StringField()
     rating = IntField()
     subject = StringField()
+    # How many replies (at every level) this review has. Kept up to date with $inc by
+    # the reply routes, like Blog.comment_count.
+    reply_count = IntField(default=0)
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', ('-create_date', '-_id')],
+        'queryset_class': RoutedQuerySet
     }
 
 class Reply(Document):
@@ -108,6 +149,13 @@ class Reply(Document):
     outer = BooleanField()
     replies = ListField()
     dFromOuter = IntField()
+    # parent is the reply this one answers (empty for replies right on the review) and
+    # ancestors is every reply above this one up to the top of the thread. With ancestors
+    # a whole thread can be found or deleted with one indexed query instead of walking
+    # down the replies lists one level at a time.
+    # They are lazy references so using them never loads the other replies.
+    parent = LazyReferenceField('Reply')
+    ancestors = ListField(LazyReferenceField('Reply'))
     #ReferenceField('Reply',reverse_delete_rule=CASCADE)
     # Line 68 is where you store all the info you need but won't find in the Course and Teacher Object
     text = StringField()
@@ -115,7 +163,9 @@ class Reply(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', 'ancestors', ('review', 'dFromOuter')],
+        'queryset_class': RoutedQuerySet
     }
 
 class Slime(Document):
@@ -126,7 +176,9 @@ class Slime(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author'],
+        'queryset_class': RoutedQuerySet
     }
 
 class Club(Document):
@@ -138,11 +190,16 @@ class Club(Document):
     meeting_day = StringField()
     meeting_time = StringField()
     members = ListField(ReferenceField('User'))
+    # len(members), kept up to date with $inc by joinClub so the club list doesn't have
+    # to load the members lists.
+    member_count = IntField(default=0)
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', 'members', ('-create_date', '-_id')],
+        'queryset_class': CachedQuerySet
     }
 
 class Sport(Document):
@@ -160,5 +217,24 @@ class Sport(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': ['author', ('-create_date', '-_id')],
+        'queryset_class': CachedQuerySet
+    }
+
+# Precomputed "you might also like" clubs, written by 'flask recommend clubs' (see
+# app/utils/recommend.py). key is "club:<id>" for clubs like a club, "club:<id>:grade:<n>"
+# for the same thing weighted towards members in grade n, "user:<id>" for clubs a user
+# hasn't joined yet, and "popular" for users who haven't joined any. The names are copied
+# in so showing them takes a single lookup.
+class Suggestion(Document):
+    key = StringField(primary_key=True)
+    clubs = ListField(ObjectIdField())
+    names = ListField(StringField())
+    scores = ListField(FloatField())
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'indexes': ['create_date'],
+        'queryset_class': RoutedQuerySet
     }
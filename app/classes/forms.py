@@ -5,8 +5,8 @@
 from flask_wtf import FlaskForm
 import mongoengine.errors
 from wtforms.validators import URL, Email, DataRequired, NumberRange
-from wtforms.validators import URL, Email, DataRequired
-from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, BooleanField, URLField
+from wtforms.validators import URL, Email, DataRequired, Optional
+from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, BooleanField, URLField, DateField, HiddenField
 
 class ProfileForm(FlaskForm):
     fname = StringField('First Name', validators=[DataRequired()])
@@ -37,9 +37,17 @@ class ClinicForm(FlaskForm):
     description = StringField('Description', validators=[DataRequired()])
     submit = SubmitField('Submit')
 
+# A CSV file of clinics to add all at once (see app/utils/clinicimport.py)
+class ClinicImportForm(FlaskForm):
+    csvfile = FileField('CSV file', validators=[DataRequired()])
+    submit = SubmitField('Import')
+
+
+# The hospitals people can review. Also used by the moderation filters and the search box.
+HOSPITALS = [("Wilma Chan Highland Hospital","Wilma Chan Highland Hospital"),("Alta Bates Summit Medical Center","Alta Bates Summit Medical Center"), ("UCSF Benioff Children's Hospital", "UCSF Benioff Children's Hospital"), ("Kaiser Permanente", "Kaiser Permanente"), ("Fairmont Rehabilitation & Wellness", "Fairmont Rehabilitation & Wellness"), ("John George Psychiatric Pavilion", "John George Psychiatric Pavilion"), ("Alameda Hospital", "Alameda Hospital"), ("San Leandro Hospital","San Leandro Hospital")]
 
 class ReviewForm(FlaskForm):
-    name = SelectField('Hospital Name',choices=[("Wilma Chan Highland Hospital","Wilma Chan Highland Hospital"),("Alta Bates Summit Medical Center","Alta Bates Summit Medical Center"), ("UCSF Benioff Children's Hospital", "UCSF Benioff Children's Hospital"), ("Kaiser Permanente", "Kaiser Permanente"), ("Fairmont Rehabilitation & Wellness", "Fairmont Rehabilitation & Wellness"), ("John George Psychiatric Pavilion", "John George Psychiatric Pavilion"), ("Alameda Hospital", "Alameda Hospital"), ("San Leandro Hospital","San Leandro Hospital")])
+    name = SelectField('Hospital Name',choices=HOSPITALS)
     text = TextAreaField('Write your Review', validators=[DataRequired()])
     subject = SelectField('Experiences',choices=[("Patient Care", "Patient Care"), ("Visitor","Visitor"),("Waiting Duration","Waiting Duration"), ("Internship/Leanring Programs", "Internship/Leanring Programs"), ("Volunteer", "Volunteer"), ("Patient", "Patient"), ("Hospitality", "Hospitality"), ("Other","Other")])
     rating = IntegerField('Rate your experience: 0 is terrible, 10 is amazing', validators=[NumberRange(min=0,max=10, message="Enter a number between 0 and 10.")])
@@ -74,3 +82,21 @@ class SportForm(FlaskForm):
     meeting_place = StringField("Sport Meeting Place: ", validators=[DataRequired()])
     time_frame = SelectField(choices=[("AM"), ("PM")])
     submit = SubmitField('Add sport')
+
+# The filters and actions on the staff moderation page (see app/routes/moderate.py).
+# Every filter is optional but at least one has to be filled in.
+class ModerationForm(FlaskForm):
+    kind = SelectField('Find', choices=[("blog", "Blogs"), ("comment", "Comments"), ("review", "Reviews"), ("reply", "Replies")])
+    author = StringField('Author (email, username or id)')
+    since = DateField('Posted from', validators=[Optional()])
+    until = DateField('Posted until', validators=[Optional()])
+    tag = StringField('Blog tag')
+    hospital = SelectField('Hospital', choices=[("", "Any")] + HOSPITALS)
+    contains = StringField('Text contains')
+    editField = SelectField('Change', choices=[("subject", "Subject"), ("content", "Content"), ("tag", "Tag"), ("text", "Text")])
+    editValue = StringField('To')
+    # The count from the preview, so a delete only runs if it still matches that many
+    expected = HiddenField()
+    preview = SubmitField('Preview')
+    delete = SubmitField('Delete all')
+    edit = SubmitField('Edit all')
@@ -6,4 +6,5 @@ from .clinic import *
 from .review import *
 from .slime import *
 from .club import *
-from .sport import *
\ No newline at end of file
+from .sport import *
+from .moderate import *
\ No newline at end of file
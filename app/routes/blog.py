@@ -2,28 +2,44 @@
 # a blog where a blogs and comments on those blogs can be
 # Created, Read, Updated or Deleted (CRUD)
 
-from app import app
+from app import app, rateLimiter, readRouting, liveFeed, deadlines
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, abort
 from flask_login import current_user
 from app.classes.data import Blog, Comment
+from app.utils.livefeed import makeEvents
+from app.utils.streaming import Batched, streamTemplate
 from app.classes.forms import BlogForm, CommentForm
 from flask_login import login_required
 import datetime as dt
+from bson import ObjectId
 
 # This is the route to list all blogs
 @app.route('/blog/list')
 @app.route('/blogs')
 # This means the user must be logged in to see this page
 @login_required
+@readRouting.readOnly
+# Streamed, so it gets longer than the other pages (see app/utils/deadline.py)
+@deadlines.budget(10000)
 def blogList():
     # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'blogs'.
-    blogs = Blog.objects()
+    # Batched reads them a batch at a time with each batch's authors loaded in one query.
+    # Sorted the same way as the ('-create_date', '-_id') index so MongoDB can send the
+    # first rows straight away instead of sorting the whole collection first.
+    blogs = Batched(Blog.objects().order_by('-create_date', '-id'), 'author')
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('blogs.html',blogs=blogs)
+    # each blog. streamTemplate sends the page while it is being rendered instead of all at
+    # the end (see app/utils/streaming.py).
+    return streamTemplate('blogs.html',blogs=blogs)
+
+# What the blog page shows instead when its comments take too long to load
+# (see app/utils/deadline.py).
+def blogWithoutComments(blogID):
+    flash("The comments are taking too long to load right now. Try again in a minute.")
+    return render_template('blog.html',blog=Blog.objects.get(id=blogID),comments=[])
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -33,6 +49,8 @@ def blogList():
 @app.route('/blog/<blogID>')
 # This route will only run if the user is logged in.
 @login_required
+@readRouting.readOnly
+@deadlines.budget(3000, degraded=blogWithoutComments)
 def blog(blogID):
     # retrieve the blog using the blogID
     thisBlog = Blog.objects.get(id=blogID)
@@ -41,7 +59,9 @@ def blog(blogID):
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseComments = Comment.objects(blog=thisBlog)
+    # Oldest first, so comments that arrive while the page is open (see static/live.js)
+    # go at the bottom like the rest.
+    theseComments = Comment.objects(blog=thisBlog).order_by('create_date')
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('blog.html',blog=thisBlog,comments=theseComments)
 
@@ -78,6 +98,8 @@ def blogDelete(blogID):
 # Because this route includes a form that both gets and blogs data it needs the 'methods'
 # in the route decorator.
 @app.route('/blog/new', methods=['GET', 'POST'])
+# This turns away a user who posts new blogs too fast (see app/utils/ratelimit.py)
+@rateLimiter.limit("5/minute")
 # This means the user must be logged in to see this page
 @login_required
 # This is a function that is run when the user requests this route.
@@ -99,8 +121,6 @@ def blogNew():
             content = form.content.data,
             tag = form.tag.data,
             author = current_user.id,
-            # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
         )
         # This is a method that saves the data to the mongoDB database.
         newBlog.save()
@@ -143,7 +163,7 @@ def blogEdit(blogID):
             subject = form.subject.data,
             content = form.content.data,
             tag = form.tag.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('blog',blogID=blogID))
@@ -167,7 +187,24 @@ def blogEdit(blogID):
 # about how comments are related to blogs.  Additionally, take a look at data.py to see how the
 # relationship is defined in the Blog and the Comment collections.
 
+# The page for a blog listens here for new comments (see app/utils/livefeed.py).
+@app.route('/blog/<blogID>/events')
+@login_required
+def blogEvents(blogID):
+    if not ObjectId.is_valid(blogID):
+        abort(404)
+    # Comments posted after the last one the page got, for a browser that is reconnecting
+    def backlog(lastId):
+        if not ObjectId.is_valid(lastId):
+            return []
+        docs = Comment._get_collection().find(
+            {'blog': ObjectId(blogID), '_id': {'$gt': ObjectId(lastId)}}
+        ).sort('_id', 1).limit(100)
+        return makeEvents('comment', list(docs))
+    return liveFeed.stream(('blog', blogID), backlog)
+
 @app.route('/comment/new/<blogID>', methods=['GET', 'POST'])
+@rateLimiter.limit("10/minute")
 @login_required
 def commentNew(blogID):
     blog = Blog.objects.get(id=blogID)
@@ -179,6 +216,9 @@ def commentNew(blogID):
             content = form.content.data
         )
         newComment.save()
+        # $inc adds one to the count inside MongoDB so two comments at the same time
+        # can't overwrite each other's count.
+        Blog.objects(id=blogID).update_one(inc__comment_count=1)
         return redirect(url_for('blog',blogID=blogID))
     return render_template('commentform.html',form=form,blog=blog)
 
@@ -194,7 +234,7 @@ def commentEdit(commentID):
     if form.validate_on_submit():
         editComment.update(
             content = form.content.data,
-            modifydate = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
         return redirect(url_for('blog',blogID=editComment.blog.id))
 
@@ -207,5 +247,6 @@ def commentEdit(commentID):
 def commentDelete(commentID): 
     deleteComment = Comment.objects.get(id=commentID)
     deleteComment.delete()
+    Blog.objects(id=deleteComment.blog.id).update_one(dec__comment_count=1)
     flash('The comments was deleted.')
     return redirect(url_for('blog',blogID=deleteComment.blog.id)) 
@@ -1,17 +1,17 @@
-from app import app
-from app.utils.secrets import getSecrets
-import requests
+from app import app, readRouting, autocomplete, moderation, clinicImport
+from app.utils.clinicimport import ADDRESS_FIELDS, findJob
 from flask import render_template, flash, redirect, url_for
-import requests
 from flask_login import current_user
 from app.classes.data import Clinic
-from app.classes.forms import ClinicForm
+from app.classes.forms import ClinicForm, ClinicImportForm
 from flask_login import login_required
 import datetime as dt
+from bson import ObjectId
 
 
 @app.route('/clinic/map')
 @login_required
+@readRouting.readOnly
 def clinicMap():
 
     clinics = Clinic.objects()
@@ -20,6 +20,7 @@ def clinicMap():
 
 @app.route('/clinic/list')
 @login_required
+@readRouting.readOnly
 def clinicList():
 
     clinics = Clinic.objects()
@@ -29,6 +30,7 @@ def clinicList():
 
 @app.route('/clinic/<clinicID>')
 @login_required
+@readRouting.readOnly
 def clinic(clinicID):
 
     thisClinic = Clinic.objects.get(id=clinicID)
@@ -42,34 +44,25 @@ def clinicDelete(clinicID):
     deleteClinic = Clinic.objects.get(id=clinicID)
 
     deleteClinic.delete()
+    autocomplete.remove('clinic', deleteClinic.id)
     flash('The Clinic was deleted.')
     return redirect(url_for('clinicList'))
 
 def updateLatLon(clinic):
-    # get your email address for the secrets file
-    secrets=getSecrets()
-    # call the maps API with the address
-    url = f"https://nominatim.openstreetmap.org/search?street={clinic.streetAddress}&city={clinic.city}&state={clinic.state}&postalcode={clinic.zipcode}&format=json&addressdetails=1&email={secrets['MY_EMAIL_ADDRESS']}"
-    # get the response from the API
-    r = requests.get(url)
-    # Find the lat/lon in the response
-    try:
-        r = r.json()
-    except:
-        flash("unable to retrieve lat/lon")
+    # Look up the address the same way the bulk import does, which keeps to the map
+    # provider's rate limit (see app/utils/clinicimport.py). It gives back None if the
+    # address couldn't be found or the lookup was too slow.
+    point = clinicImport.geocode({name: getattr(clinic, name) or "" for name in ADDRESS_FIELDS})
+    if point is None:
+        flash('unable to retrieve lat/lon')
         return(clinic)
-    else:
-        if len(r) != 0:
-            # update the database
-            clinic.update(
-                lat = float(r[0]['lat']),
-                lon = float(r[0]['lon'])
-            )
-            flash(f"clinic lat/lon updated")
-            return(clinic)
-        else:
-            flash('unable to retrieve lat/lon')
-            return(clinic)
+    # update the database
+    clinic.update(
+        lat = point[0],
+        lon = point[1]
+    )
+    flash(f"clinic lat/lon updated")
+    return(clinic)
 
 @app.route('/clinic/new', methods=['GET', 'POST'])
 @login_required
@@ -86,14 +79,12 @@ def clinicNew():
             zipcode = form.zipcode.data,
             description = form.description.data,
             author = current_user.id,
-            modifydate = dt.datetime.utcnow,
         )
         newClinic.save()
+        autocomplete.add('clinic', newClinic.id, newClinic.name)
 
         newClinic = updateLatLon(newClinic)
 
-        import requests
-
         return redirect(url_for('clinic',clinicID=newClinic.id))
 
     return render_template('clinicform.html',form=form)
@@ -116,8 +107,9 @@ def clinicEdit(clinicID):
             state = form.state.data,
             zipcode = form.zipcode.data,            
             description = form.description.data,
-            modifydate = dt.datetime.utcnow,
+            modify_date = dt.datetime.utcnow(),
         )
+        autocomplete.add('clinic', editClinic.id, form.name.data)
         editClinic = updateLatLon(editClinic)
         return redirect(url_for('clinic',clinicID=clinicID))
 
@@ -129,3 +121,31 @@ def clinicEdit(clinicID):
     form.description.data = editClinic.description
 
     return render_template('clinicform.html',form=form)
+
+# Staff can add a whole CSV file of clinics here. The import runs in the background and
+# this sends them to a page that shows how far it has got (see app/utils/clinicimport.py).
+@app.route('/clinic/import', methods=['GET', 'POST'])
+@login_required
+@moderation.staffOnly
+def clinicImportNew():
+    form = ClinicImportForm()
+    if form.validate_on_submit():
+        upload = form.csvfile.data
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            flash("That file isn't a CSV file saved as UTF-8.")
+            return render_template('clinicimport.html',form=form,job=None)
+        jobID = clinicImport.start(text, current_user.id, upload.filename)
+        return redirect(url_for('clinicImportStatus',jobID=jobID))
+    return render_template('clinicimport.html',form=form,job=None)
+
+@app.route('/clinic/import/<jobID>')
+@login_required
+@moderation.staffOnly
+def clinicImportStatus(jobID):
+    job = findJob(ObjectId(jobID)) if ObjectId.is_valid(jobID) else None
+    if job is None:
+        flash("There is no import with that id.")
+        return redirect(url_for('clinicImportNew'))
+    return render_template('clinicimport.html',form=None,job=job)
@@ -1,8 +1,10 @@
-from app import app
+from app import app, readRouting, autocomplete, deadlines
 import mongoengine.errors
 from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
 from app.classes.data import Club
+from app.utils.streaming import Batched, streamTemplate
+from app.utils.recommend import suggestionsFor, clubKey
 from app.classes.forms import ClubForm
 from flask_login import login_required
 import datetime as dt
@@ -33,11 +35,10 @@ def clubNew():
             meeting_place = form.meeting_place.data,
 
             author = current_user.id,
-            # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
         )
         # This is a method that saves the data to the mongoDB database.
         newClub.save()
+        autocomplete.add('club', newClub.id, newClub.name)
 
         # Once the new club is saved, this sends the user to that club using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -56,25 +57,37 @@ def clubNew():
 @app.route('/club/<clubID>')
 # This route will only run if the user is logged in.
 @login_required
+@readRouting.readOnly
 def club(clubID):
     # retrieve the club using the clubID
     thisClub = Club.objects.get(id=clubID)
+    # Clubs with a lot of the same members, worked out ahead of time by
+    # 'flask recommend clubs'. The list for the user's grade is used if there is one.
+    alsoLike = suggestionsFor(clubKey(thisClub.id, current_user.grade), clubKey(thisClub.id))
     # Send the club object to the 'club.html' template.
-    return render_template('club.html',club=thisClub)
+    return render_template('club.html',club=thisClub,alsoLike=alsoLike)
 
 # This is the route to list all clubs
 @app.route('/club/list')
 @app.route('/clubs')
 # This means the user must be logged in to see this page
 @login_required
+@readRouting.readOnly
+# Streamed, so it gets longer than the other pages (see app/utils/deadline.py)
+@deadlines.budget(10000)
 def clubList():
     # This retrieves all of the 'clubs' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'clubs'.
-    clubs = Club.objects()
+    # The list only shows member_count, so leave the (possibly huge) members lists behind.
+    # Batched reads them a batch at a time with each batch's authors loaded in one query.
+    # Sorted the same way as the ('-create_date', '-_id') index so MongoDB can send the
+    # first rows straight away instead of sorting the whole collection first.
+    clubs = Batched(Club.objects().exclude('members').order_by('-create_date', '-id'), 'author')
     # This renders (shows to the user) the clubs.html template. it also sends the clubs object 
     # to the template as a variable named clubs.  The template uses a for loop to display
-    # each club.
-    return render_template('clubs.html',clubs=clubs)
+    # each club. streamTemplate sends the page while it is being rendered instead of all at
+    # the end (see app/utils/streaming.py).
+    return streamTemplate('clubs.html',clubs=clubs)
 
 # This route enables a user to edit a club.  This functions very similar to creating a new 
 # club except you don't give the user a blank form.  You have to present the user with a form
@@ -102,8 +115,9 @@ def clubEdit(clubID):
             meeting_day = form.meeting_day.data,
             meeting_time = form.meeting_time.data,
             meeting_place = form.meeting_place.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
+        autocomplete.add('club', editClub.id, form.name.data)
         # After updating the document, send the user to the updated club using a redirect.
         return redirect(url_for('club',clubID=clubID))
 
@@ -132,6 +146,7 @@ def clubDelete(clubID):
     if current_user == deleteClub.author:
         # delete the club using the delete() method from Mongoengine
         deleteClub.delete()
+        autocomplete.remove('club', deleteClub.id)
         # send a message to the user that the club was deleted.
         flash('The club was deleted.')
     else:
@@ -145,12 +160,14 @@ def clubDelete(clubID):
 @app.route('/club/join/<clubID>', methods=["POST"])
 @login_required
 def joinClub(clubID):
-    club = Club.objects.get(id=clubID)
-
-    # Prevent duplicate joining
-    if current_user not in club.members:
-        club.members.append(current_user)
-        club.save()
+    # Add the user to the members list and count them in one atomic update. The
+    # members__ne part only matches the club if the user isn't already a member, which
+    # prevents duplicate joining without loading the whole members list.
+    joined = Club.objects(id=clubID, members__ne=current_user.id).update_one(
+        push__members=current_user.id,
+        inc__member_count=1
+    )
+    if joined:
         flash('You have successfully joined the club.')
     else:
         flash('You already joined this club.')
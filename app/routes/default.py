@@ -1,10 +1,22 @@
-from app import app
-from flask import render_template
+from app import app, autocomplete, deadlines
+from app.utils.autocomplete import matchUrl
+from app.utils.activity import feedPage
+from flask import render_template, request, jsonify
+from flask_login import login_required, current_user
+
+# This is for rendering the home page. Logged in users also see the newest posts from
+# around the site (see app/utils/activity.py). ?before= is the "load more" link's cursor.
+# If the feed is too slow the home page is sent without it (see app/utils/deadline.py)
+def indexWithoutFeed():
+    return render_template('index.html', feed=[], nextPage=None)
 
-# This is for rendering the home page
 @app.route('/')
+@deadlines.budget(2000, degraded=indexWithoutFeed)
 def index():
-    return render_template('index.html')
+    feed, nextPage = [], None
+    if current_user.is_authenticated:
+        feed, nextPage = feedPage(request.args.get('before'))
+    return render_template('index.html', feed=feed, nextPage=nextPage)
 
 # Here's the basics for making any new route
 # It's a good idea to use the same name/word, and same capitalization conventions
@@ -14,3 +26,14 @@ def index():
 def aboutus():
     return render_template('aboutus.html')
 
+
+# Clubs, sports, clinics and hospitals whose names have a word starting with q, for the
+# search box in the navbar. The names come from memory, not the database
+# (see app/utils/autocomplete.py).
+@app.route('/autocomplete')
+@login_required
+def autocompleteNames():
+    matches = autocomplete.search(request.args.get('q', '')[:100])
+    for match in matches:
+        match['url'] = matchUrl(match)
+    return jsonify(matches)
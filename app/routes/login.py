@@ -2,6 +2,7 @@
 
 # Python standard libraries
 import json
+import os
 from app import app, login_manager
 from flask import redirect, request, url_for, flash
 from flask_login import (
@@ -10,8 +11,7 @@ from flask_login import (
     login_user,
     logout_user,
 )
-from oauthlib.oauth2 import WebApplicationClient
-import requests
+from app.utils import outbound
 from app.classes.data import User
 from app.utils.secrets import getSecrets
 import mongoengine.errors
@@ -20,7 +20,16 @@ import mongoengine.errors
 secrets = getSecrets()
 
 # OAuth2 client setup
-client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
+# The client is only needed by the two login routes so oauthlib is imported the first
+# time someone logs in instead of every time the app starts.
+client = None
+
+def getClient():
+    global client
+    if client is None:
+        from oauthlib.oauth2 import WebApplicationClient
+        client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
+    return client
 
 # When a route is decorated with @login_required and fails this code is run
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.unauthorized_handler
@@ -40,7 +49,7 @@ def load_user(id):
         return redirect(url_for('index'))
 
 def get_google_provider_cfg():
-    return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
+    return outbound.get(secrets['GOOGLE_DISCOVERY_URL']).json()
 
 @app.route("/login")
 def login():
@@ -50,7 +59,7 @@ def login():
 
     # Use library to construct the request for login and provide
     # scopes that let you retrieve user's profile from Google
-    request_uri = client.prepare_request_uri(
+    request_uri = getClient().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=request.base_url + "/callback",
         scope=["openid", "email", "profile"],
@@ -70,13 +79,13 @@ def callback():
     token_endpoint = google_provider_cfg["token_endpoint"]
 
     # Prepare and send request to get tokens! Yay tokens!
-    token_url, headers, body = client.prepare_token_request(
+    token_url, headers, body = getClient().prepare_token_request(
         token_endpoint,
         authorization_response=request.url,
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
+    token_response = outbound.post(
         token_url,
         headers=headers,
         data=body,
@@ -84,14 +93,14 @@ def callback():
     )
 
     # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json()))
+    getClient().parse_request_body_response(json.dumps(token_response.json()))
 
     # Now that we have tokens (yay) let's find and hit URL
     # from Google that gives you user's profile information,
     # including their Google Profile Image and Email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    uri, headers, body = getClient().add_token(userinfo_endpoint)
+    userinfo_response = outbound.get(uri, headers=headers, data=body)
 
     ### Example info that comes back from google
     # userinfo_response.json() --> {
@@ -160,6 +169,20 @@ def callback():
     return redirect(url_for("myProfile"))
 
 
+# Test login. Google login can't be automated, so the load tests in bench/ log in
+# through this route instead. It only exists when the app is started with
+# ENABLE_TEST_LOGIN=1 in the environment. NEVER turn this on for the real site.
+if os.environ.get("ENABLE_TEST_LOGIN") == "1":
+    @app.route("/login/test/<email>")
+    def testLogin(email):
+        try:
+            thisUser = User.objects.get(email=email)
+        except mongoengine.errors.DoesNotExist:
+            return "No user with that email.", 404
+        login_user(thisUser)
+        return redirect(url_for("myProfile"))
+
+
 @app.route("/logout")
 @login_required
 def logout():
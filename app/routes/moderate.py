@@ -0,0 +1,102 @@
+from app import app, moderation, deadlines
+from app.utils.moderation import ModerationError, FILTERS
+from flask import render_template, flash, request, jsonify
+from flask_login import current_user, login_required
+from app.classes.forms import ModerationForm
+
+# These routes are the staff moderation page and its JSON API. All the work is done in
+# app/utils/moderation.py, these only read the filters and show the results.
+
+def formFilters(form):
+    return {name: getattr(form, name).data for name in FILTERS}
+
+# The JSON body of an API call, or None if it isn't a JSON object
+def jsonBody():
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else None
+
+# The moderation page. Fill in some filters and press Preview to see how many posts (and
+# comments or replies under them) match and the newest few of them. Delete all and Edit
+# all only run if the number matching is still the number the preview showed.
+@app.route('/moderate', methods=['GET', 'POST'])
+@login_required
+@moderation.staffOnly
+# A big delete can take a while, and it is only staff waiting (see app/utils/deadline.py)
+@deadlines.budget(None)
+def moderate():
+    form = ModerationForm()
+    counts = None
+    sample = None
+    if form.validate_on_submit():
+        kind = form.kind.data
+        filters = formFilters(form)
+        try:
+            if form.delete.data or form.edit.data:
+                matched = moderation.count(kind, filters)
+                if str(matched) != form.expected.data:
+                    flash(f"{matched} posts match now, not the {form.expected.data or 0} in the preview. Check them again before changing them.")
+                elif form.delete.data:
+                    done = moderation.delete(kind, filters, by=current_user.email)
+                    flash("Deleted " + ", ".join(f"{count} {name}" for name, count in done.items()) + ".")
+                else:
+                    done = moderation.edit(kind, filters, {form.editField.data: form.editValue.data}, by=current_user.email)
+                    flash(f"Edited {done[kind]} {kind}.")
+            counts = moderation.preview(kind, filters)
+            sample = moderation.sample(kind, filters)
+            form.expected.data = counts[kind]
+        except ModerationError as error:
+            flash(str(error))
+    return render_template('moderate.html', form=form, counts=counts, sample=sample)
+
+# The same thing for scripts. Both take a JSON body like
+#   {"kind": "blog", "filters": {"author": "spam@example.com", "since": "2024-01-31"}}
+# apply also needs "action": "delete" or "edit" (with "set": {"content": "..."}) and can
+# send "expect": <count from the preview> to stop if that changed. Only JSON is accepted,
+# which also means a form on another site can't post here.
+@app.route('/moderate/api/preview', methods=['POST'])
+@login_required
+@moderation.staffOnly
+@deadlines.budget(None)
+def moderatePreview():
+    body = jsonBody()
+    if body is None:
+        return jsonify(error="send a JSON object like {\"kind\": \"blog\", \"filters\": {...}}"), 400
+    kind = body.get('kind')
+    filters = body.get('filters') or {}
+    if not isinstance(filters, dict):
+        return jsonify(error="filters must be a JSON object"), 400
+    try:
+        return jsonify(kind=kind, counts=moderation.preview(kind, filters), sample=moderation.sample(kind, filters))
+    except ModerationError as error:
+        return jsonify(error=str(error)), 400
+
+@app.route('/moderate/api/apply', methods=['POST'])
+@login_required
+@moderation.staffOnly
+@deadlines.budget(None)
+def moderateApply():
+    body = jsonBody()
+    if body is None:
+        return jsonify(error="send a JSON object like {\"kind\": \"blog\", \"filters\": {...}}"), 400
+    kind = body.get('kind')
+    filters = body.get('filters') or {}
+    if not isinstance(filters, dict):
+        return jsonify(error="filters must be a JSON object"), 400
+    action = body.get('action')
+    try:
+        if 'expect' in body:
+            matched = moderation.count(kind, filters)
+            if matched != body['expect']:
+                return jsonify(error="the number of matching posts changed", matched=matched), 409
+        if action == 'delete':
+            counts = moderation.delete(kind, filters, by=current_user.email)
+        elif action == 'edit':
+            changes = body.get('set') or {}
+            if not isinstance(changes, dict):
+                return jsonify(error="set must be a JSON object"), 400
+            counts = moderation.edit(kind, filters, changes, by=current_user.email)
+        else:
+            return jsonify(error="action must be delete or edit"), 400
+    except ModerationError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(kind=kind, action=action, counts=counts)
@@ -1,14 +1,19 @@
-from app import app
+from app import app, rateLimiter, readRouting, liveFeed, deadlines
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, abort
 from flask_login import current_user
 from app.classes.data import Review, Reply
+from app.utils.livefeed import makeEvents
+from app.utils.streaming import Batched, streamTemplate
 from app.classes.forms import ReviewForm, ReplyForm
 from flask_login import login_required
 import datetime as dt
 from mongoengine.queryset.visitor import Q
+from bson import ObjectId
 
 @app.route('/review/new', methods=['GET', 'POST'])
+# This turns away a user who posts new reviews too fast (see app/utils/ratelimit.py)
+@rateLimiter.limit("5/minute")
 # This is a function that is run when the user requests this route.
 # This means the user must be logged in to see this page
 @login_required
@@ -31,8 +36,6 @@ def reviewNew():
             text = form.text.data,
             rating = form.rating.data,
             author = current_user.id,
-            # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
         )
         # This is a method that saves the data to the mongoDB database.
         newReview.save()
@@ -55,22 +58,37 @@ def reviewNew():
 @app.route('/reviews')
 # This means the user must be logged in to see this page
 @login_required
+@readRouting.readOnly
+# Streamed, so it gets longer than the other pages (see app/utils/deadline.py)
+@deadlines.budget(10000)
 def reviewList():
     # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'blogs'.
-    reviews = Review.objects()
+    # Batched reads them a batch at a time with each batch's authors loaded in one query.
+    # Sorted the same way as the ('-create_date', '-_id') index so MongoDB can send the
+    # first rows straight away instead of sorting the whole collection first.
+    reviews = Batched(Review.objects().order_by('-create_date', '-id'), 'author')
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('reviews.html',reviews=reviews)
+    # each blog. streamTemplate sends the page while it is being rendered instead of all at
+    # the end (see app/utils/streaming.py).
+    return streamTemplate('reviews.html',reviews=reviews)
+
 
 
 
 
+# What the review page shows instead when its replies take too long to load, which can
+# happen on a review with thousands of them (see app/utils/deadline.py).
+def reviewWithoutReplies(reviewID):
+    flash("The replies are taking too long to load right now. Try again in a minute.")
+    return render_template('review.html',review=Review.objects.get(id=reviewID), replies=[])
 
 @app.route('/review/<reviewID>')
 # This route will only run if the user is logged in.
 @login_required
+@readRouting.readOnly
+@deadlines.budget(3000, degraded=reviewWithoutReplies)
 def review(reviewID):
     # retrieve the blog using the blogID
     thisReview = Review.objects.get(id=reviewID)
@@ -79,10 +97,28 @@ def review(reviewID):
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseReplies = Reply.objects(Q(review=thisReview) & Q(outer=True) & Q(dFromOuter=0))
+    # Oldest first, so replies that arrive while the page is open (see static/live.js)
+    # go at the bottom like the rest.
+    theseReplies = Reply.objects(Q(review=thisReview) & Q(outer=True) & Q(dFromOuter=0)).order_by('create_date')
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('review.html',review=thisReview, replies=theseReplies)
 
+# The page for a review listens here for new replies (see app/utils/livefeed.py).
+@app.route('/review/<reviewID>/events')
+@login_required
+def reviewEvents(reviewID):
+    if not ObjectId.is_valid(reviewID):
+        abort(404)
+    # Replies posted after the last one the page got, for a browser that is reconnecting
+    def backlog(lastId):
+        if not ObjectId.is_valid(lastId):
+            return []
+        docs = Reply._get_collection().find(
+            {'review': ObjectId(reviewID), '_id': {'$gt': ObjectId(lastId)}}
+        ).sort('_id', 1).limit(100)
+        return makeEvents('reply', list(docs))
+    return liveFeed.stream(('review', reviewID), backlog)
+
 @app.route('/review/edit/<reviewID>', methods=['GET', 'POST'])
 @login_required
 def reviewEdit(reviewID):
@@ -103,7 +139,7 @@ def reviewEdit(reviewID):
             subject = form.subject.data,
             text = form.text.data,
             rating = form.rating.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
         theseReplies = Reply.objects(Q(review=editReview) & Q(outer=True) & Q(dFromOuter=0))
         # After updating the document, send the user to the updated blog using a redirect.
@@ -156,11 +192,13 @@ def replyNewRev(reviewID):
             outer = True
         )
         newReply.save()
+        review.update(inc__reply_count=1)
         theseReplies = Reply.objects(Q(review=review) & Q(outer=True) & Q(dFromOuter=0))
         return redirect(url_for('review',reviewID=review.id, replies=theseReplies))
     return render_template('replyform.html',form=form,review=review)
 
 @app.route('/reply/newRep/<reviewID>/<replyID>', methods=['GET', 'POST'])
+@rateLimiter.limit("10/minute")
 @login_required
 def replyNewRep(reviewID, replyID):
     review = Review.objects.get(id=reviewID)
@@ -173,11 +211,15 @@ def replyNewRep(reviewID, replyID):
             text = form.text.data,
             name = review.name,
             dFromOuter = reply.dFromOuter+1,
-            outer = False
+            outer = False,
+            parent = reply,
+            ancestors = reply.ancestors + [reply]
         )
         newReply.save()
-        reply.replies.append(newReply)
-        reply.save()
+        # push adds the new reply to the end of the list inside MongoDB instead of
+        # loading the whole list, appending and saving it all back.
+        reply.update(push__replies=newReply)
+        review.update(inc__reply_count=1)
         return redirect(url_for('review',reviewID=review.id))
     return render_template('replyform.html',form=form,review=reply)
 
@@ -194,7 +236,7 @@ def replyEdit(replyID):
     if form.validate_on_submit():
         editReply.update(
             text = form.text.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
         theseReplies = Reply.objects(Q(review=review) & Q(outer=True) & Q(dFromOuter=0))
         return redirect(url_for('review',reviewID=editReply.review.id, replies=theseReplies))
@@ -207,13 +249,20 @@ def replyEdit(replyID):
 @login_required
 def replyDelete(replyID): 
     deleteReply = Reply.objects.get(id=replyID)
-    for reply in Reply.objects(Q(review=deleteReply.review) & Q(dFromOuter=(deleteReply.dFromOuter-1))):
-        if reply.replies is not None and deleteReply in reply.replies:
-                replyReplies = reply.replies
-                reply.replies = replyReplies.remove(deleteReply)
-                reply.save()
-    deleteReply.delete()
+    # Deleting a reply deletes every reply under it too, so only its author can.
+    if current_user != deleteReply.author:
+        flash("You can't delete a reply you didn't write.")
+        return redirect(url_for('review',reviewID=deleteReply.review.id))
+    # Take the reply out of its parent's replies list. $pull does this inside MongoDB in
+    # one step. Replies saved before 'parent' existed are found by searching for the
+    # reply in the replies lists one level up.
+    if deleteReply.parent:
+        Reply.objects(id=deleteReply.parent.pk).update_one(pull__replies=deleteReply)
+    elif not deleteReply.outer:
+        Reply.objects(Q(review=deleteReply.review) & Q(dFromOuter=(deleteReply.dFromOuter-1))).update(pull__replies=deleteReply)
+    # Delete the reply and every reply under it in one go. Every reply below this one
+    # has it in its ancestors list, and that list is indexed.
+    deleted = Reply.objects(Q(id=deleteReply.id) | Q(ancestors=deleteReply)).delete()
+    Review.objects(id=deleteReply.review.id).update_one(dec__reply_count=deleted)
     flash('The reply was deleted.')
-    theseReplies = Reply.objects(Q(review=deleteReply.review) & Q(outer=True) & Q(dFromOuter=0))
-    return redirect(url_for('review',reviewID=deleteReply.review.id, replies=theseReplies)) 
-    
\ No newline at end of file
+    return redirect(url_for('review',reviewID=deleteReply.review.id))
@@ -1,13 +1,20 @@
-from app import app
+from app import app, rateLimiter
 import mongoengine.errors
 from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
 from app.classes.data import Slime
 from app.classes.forms import SlimeForm
+from app.utils.writebehind import WriteBehind
 from flask_login import login_required
 import datetime as dt
 
+# Check-ins come in bursts when a whole class fills in the form at once, so they can be
+# saved in batches (see app/utils/writebehind.py).
+slimeWrites = WriteBehind(Slime, app)
+
 @app.route('/slime/new', methods=['GET', 'POST'])
+# A check-in a day is normal, so a few quick retries are plenty
+@rateLimiter.limit("3/minute")
 # This means the user must be logged in to see this page
 @login_required
 # This is a function that is run when the user requests this route.
@@ -28,19 +35,16 @@ def slimeNew():
             sleep_time = form.sleep_time.data,
             time_frame = form.time_frame.data,
             author = current_user.id,
-            # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
         )
-        # This is a method that saves the data to the mongoDB database.
-        newSlime.save()
+        # This saves the data to the mongoDB database, or puts it in the next batch
+        # when WRITE_BEHIND is on.
+        slimeWrites.save(newSlime)
 
-        # Once the new blog is saved, this sends the user to that blog using redirect.
-        # and url_for. Redirect is used to redirect a user to different route so that 
-        # routes code can be run. In this case the user just created a blog so we want 
-        # to send them to that blog. url_for takes as its argument the function name
-        # for that route (the part after the def key word). You also need to send any
-        # other values that are needed by the route you are redirecting to.
-        return redirect(url_for('slime',slimeID=newSlime.id))
+        # There is no page for a single check-in, so send the user back to the home
+        # page. url_for takes as its argument the function name for that route (the
+        # part after the def key word).
+        flash('Your sleep check-in was saved.')
+        return redirect(url_for('index'))
 
     # if form.validate_on_submit() is false then the user either has not yet filled out
     # the form or the form had an error and the user is sent to a blank form. Form errors are 
@@ -1,4 +1,4 @@
-from app import app
+from app import app, readRouting, autocomplete
 import mongoengine.errors
 from flask import render_template, flash, redirect, url_for
 from flask_login import current_user
@@ -29,10 +29,10 @@ def sportNew():
             meeting_place = form.meeting_place.data,
             time_frame = form.time_frame.data,
             author = current_user.id,
-            modify_date = dt.datetime.utcnow
         )
 
         newSport.save()
+        autocomplete.add('sport', newSport.id, newSport.name)
         return redirect(url_for('sport', sportID=newSport.id))
 
     # if form.validate_on_submit() is false then the user either has not yet filled out
@@ -44,6 +44,7 @@ def sportNew():
 @app.route('/sport/<sportID>')
 # This route will only run if the user is logged in.
 @login_required
+@readRouting.readOnly
 def sport(sportID):
     # retrieve the sport using the sportID
     thisSport = Sport.objects.get(id=sportID)
@@ -55,6 +56,7 @@ def sport(sportID):
 @app.route('/sports')
 # This means the user must be logged in to see this page
 @login_required
+@readRouting.readOnly
 def sportList():
     # This retrieves all of the 'sports' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'sports'.
@@ -92,8 +94,9 @@ def sportEdit(sportID):
             meeting_time2 = form.meeting_time2.data,
             time_frame = form.time_frame.data,
             meeting_place = form.meeting_place.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
+        autocomplete.add('sport', editSport.id, form.name.data)
         # After updating the document, send the user to the updated sport using a redirect.
         return redirect(url_for('sport',sportID=sportID))
 
@@ -124,6 +127,7 @@ def sportDelete(sportID):
     if current_user == deleteSport.author:
         # delete the sport using the delete() method from Mongoengine
         deleteSport.delete()
+        autocomplete.remove('sport', deleteSport.id)
         # send a message to the user that the sport was deleted.
         flash('The sport was deleted.')
     else:
@@ -1,9 +1,12 @@
-from app import app
+from app import app, rateLimiter
 from flask_login.utils import login_required
 from flask_login import current_user
-from flask import render_template, redirect, flash, url_for
+from flask import render_template, redirect, flash, url_for, Response
 from app.classes.data import User
 from app.classes.forms import ProfileForm
+from app.utils import blobstore
+from app.utils.userexport import exportUser
+from app.utils.recommend import suggestionsFor, userKey
 from flask_login import current_user
 
 # These routes and functions are for accessing and editing user profiles.
@@ -14,8 +17,12 @@ from flask_login import current_user
 @login_required
 # This is the function that is run when the route is triggered
 def myProfile():
+    # Clubs this user might like, saved by 'flask recommend clubs' (already topped up
+    # with popular clubs they aren't in). Someone who hasn't joined any clubs gets the
+    # most joined ones.
+    alsoLike = suggestionsFor(userKey(current_user.id), "popular")
     # This sends the user to their profile page which renders the 'profilemy.html' template
-    return render_template('profilemy.html')
+    return render_template('profilemy.html',alsoLike=alsoLike)
 
 # This is the route for editing a profile
 # the methods part is required if you are using a form 
@@ -37,13 +44,19 @@ def profileEdit():
             role = form.role.data,
             grade = form.grade.data,
         )
-        # This updates the profile image
+        # This updates the profile image. The blob store saves the upload to GridFS a
+        # chunk at a time, or reuses the stored copy if the same image was uploaded
+        # before, then the old image is let go of.
         if form.image.data:
-            if currUser.image:
-                currUser.image.delete()
-            currUser.image.put(form.image.data, content_type = 'image/jpeg')
-            # This saves all the updates
-            currUser.save()
+            gridId = blobstore.store(form.image.data, form.image.data.mimetype or 'image/jpeg')
+            old = User._get_collection().find_one_and_update(
+                {'_id': currUser.id}, {'$set': {'image': gridId}}, projection={'image': 1}
+            )
+            if old.get('image') != gridId:
+                blobstore.release(old.get('image'))
+            else:
+                # Same picture as before, so give back the reference store() just took
+                blobstore.release(gridId)
         # Then sends the user to their profle page
         return redirect(url_for('myProfile'))
 
@@ -56,3 +69,14 @@ def profileEdit():
 
     return render_template('profileform.html', form=form)
 
+# This sends the user a zip of everything they have on the site. The zip is made while
+# it downloads (see app/utils/userexport.py) so it never has to fit in memory.
+@app.route('/myprofile/export')
+@rateLimiter.limit("2/minute", methods=("GET",))
+@login_required
+def profileExport():
+    return Response(
+        exportUser(current_user.id),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename="my-data.zip"'}
+    )
@@ -0,0 +1,107 @@
+// Adds new replies (review.html) and comments (blog.html) to the page as they are
+// posted, from the Server-Sent Events stream in app/utils/livefeed.py. The page needs an
+// element like
+//   <div id="live" data-events="/review/ID/events" data-review="ID" data-user="USERID">
+// Replies are put right after the last reply under their parent, indented like the ones
+// the server rendered (each has id="reply-ID" and data-depth). Everything from the
+// server is added with textContent so nothing in a reply can turn into HTML.
+
+(function () {
+    var live = document.getElementById("live");
+    if (!live || !window.EventSource) {
+        return;
+    }
+
+    function when(created) {
+        return window.moment ? moment(created).calendar() : new Date(created).toLocaleString();
+    }
+
+    function text(tag, className, value) {
+        var el = document.createElement(tag);
+        if (className) {
+            el.className = className;
+        }
+        el.textContent = value;
+        return el;
+    }
+
+    function link(href, label) {
+        var a = document.createElement("a");
+        a.href = href;
+        if (label) {
+            a.textContent = label;
+            a.className = "btn btn-primary btn-sm";
+            a.setAttribute("role", "button");
+        }
+        return a;
+    }
+
+    function icon(href, src) {
+        var a = link(href);
+        var img = document.createElement("img");
+        img.width = 20;
+        img.src = src;
+        a.appendChild(img);
+        return a;
+    }
+
+    function ownerLinks(parent, kind, event) {
+        if (event.author.id !== live.dataset.user) {
+            return;
+        }
+        parent.appendChild(icon("/" + kind + "/delete/" + event.id, live.dataset.deleteIcon));
+        parent.appendChild(document.createTextNode(" "));
+        parent.appendChild(icon("/" + kind + "/edit/" + event.id, live.dataset.editIcon));
+        parent.appendChild(document.createTextNode(" "));
+    }
+
+    function addReply(event) {
+        if (document.getElementById("reply-" + event.id)) {
+            return;
+        }
+        var div = document.createElement("div");
+        div.id = "reply-" + event.id;
+        div.dataset.depth = event.depth;
+        div.style.marginLeft = (event.depth * 50) + "px";
+        ownerLinks(div, "reply", event);
+        div.appendChild(document.createTextNode(event.author.name + ": " + when(event.created)));
+        div.appendChild(document.createElement("br"));
+        div.appendChild(text("p", "fs-3", event.text));
+        div.appendChild(link("/reply/newRep/" + event.review + "/" + event.id, "Reply"));
+        div.appendChild(document.createElement("br"));
+
+        var replies = document.getElementById("replies");
+        var parent = event.parent && document.getElementById("reply-" + event.parent);
+        if (!parent) {
+            replies.appendChild(div);
+            return;
+        }
+        // skip past the parent's own replies, which all have a bigger depth
+        var after = parent;
+        while (after.nextElementSibling && Number(after.nextElementSibling.dataset.depth) > Number(parent.dataset.depth)) {
+            after = after.nextElementSibling;
+        }
+        after.insertAdjacentElement("afterend", div);
+    }
+
+    function addComment(event) {
+        if (document.getElementById("comment-" + event.id)) {
+            return;
+        }
+        var div = document.createElement("div");
+        div.id = "comment-" + event.id;
+        ownerLinks(div, "comment", event);
+        div.appendChild(document.createTextNode(when(event.created) + " " + event.author.username));
+        div.appendChild(document.createElement("br"));
+        div.appendChild(text("p", "fs-3", event.content));
+        document.getElementById("comments").appendChild(div);
+    }
+
+    var source = new EventSource(live.dataset.events);
+    source.addEventListener("reply", function (message) {
+        addReply(JSON.parse(message.data));
+    });
+    source.addEventListener("comment", function (message) {
+        addComment(JSON.parse(message.data));
+    });
+})();
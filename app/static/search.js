@@ -0,0 +1,67 @@
+// The search box in the navbar. As someone types it asks /autocomplete (see
+// app/utils/autocomplete.py) for the clubs, sports, clinics and hospitals whose names
+// match and lists them as links under the box. It waits until typing pauses for a
+// moment and ignores answers to anything but the latest text.
+
+(function () {
+    var input = document.getElementById("search");
+    var results = document.getElementById("search-results");
+    if (!input || !results || !window.fetch) {
+        return;
+    }
+    var labels = {club: "Club", sport: "Sport", clinic: "Clinic", hospital: "Hospital"};
+    var timer = null;
+    var latest = "";
+
+    function show(matches) {
+        results.replaceChildren();
+        matches.forEach(function (match) {
+            var a = document.createElement("a");
+            a.className = "list-group-item list-group-item-action";
+            a.href = match.url;
+            a.textContent = match.name + " ";
+            var kind = document.createElement("small");
+            kind.className = "text-muted";
+            kind.textContent = labels[match.kind] || match.kind;
+            a.appendChild(kind);
+            results.appendChild(a);
+        });
+    }
+
+    function lookup() {
+        var q = input.value.trim();
+        latest = q;
+        if (!q) {
+            show([]);
+            return;
+        }
+        fetch(input.dataset.url + "?q=" + encodeURIComponent(q), {credentials: "same-origin"})
+            .then(function (response) {
+                return response.ok ? response.json() : [];
+            })
+            .then(function (matches) {
+                if (q === latest) {
+                    show(matches);
+                }
+            })
+            .catch(function () {});
+    }
+
+    input.addEventListener("input", function () {
+        clearTimeout(timer);
+        timer = setTimeout(lookup, 120);
+    });
+    input.addEventListener("keydown", function (event) {
+        if (event.key === "Escape") {
+            input.value = "";
+            show([]);
+        } else if (event.key === "Enter" && results.firstChild) {
+            window.location = results.firstChild.href;
+        }
+    });
+    document.addEventListener("click", function (event) {
+        if (!input.form.contains(event.target)) {
+            show([]);
+        }
+    });
+})();
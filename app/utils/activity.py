@@ -0,0 +1,112 @@
+# The "what's new" feed on the home page: the newest blogs, reviews, clubs, sports and
+# clinics mixed together, newest first.
+#
+# Each collection is already sorted by create_date in its ('-create_date', '-_id') index,
+# so the feed opens one cursor per collection that reads at most one page of documents
+# in that order, and heapq.merge takes the newest of the five front documents over and
+# over until the page is full. Only what ends up on the page (plus one to know if there
+# is more) is ever turned into a feed item, so a page costs the same with a hundred posts
+# or ten million.
+#
+# "Load more" passes the position of the last item shown (its create_date, kind and _id)
+# as ?before=..., and every cursor starts after that position.
+
+import datetime as dt
+import heapq
+from itertools import islice
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import url_for
+
+FEED_SIZE = 20
+
+# kind: (document class name, fields to read, the route and its argument for links)
+KINDS = {
+    "blog": ("Blog", ["subject"], "blog", "blogID"),
+    "review": ("Review", ["name", "subject"], "review", "reviewID"),
+    "club": ("Club", ["name"], "club", "clubID"),
+    "sport": ("Sport", ["name"], "sport", "sportID"),
+    "clinic": ("Clinic", ["name"], "clinic", "clinicID"),
+}
+ORDER = list(KINDS)
+
+
+def documentClass(kind):
+    from app.classes import data
+    return getattr(data, KINDS[kind][0])
+
+
+# MongoDB keeps dates to the millisecond
+def millis(when):
+    return int(when.replace(tzinfo=dt.timezone.utc).timestamp() * 1000)
+
+
+# "1700000000123.2.<id>": create_date in milliseconds, the kind's place in ORDER and the _id
+def makeCursor(item):
+    return f"{millis(item['created'])}.{ORDER.index(item['kind'])}.{item['id']}"
+
+
+def parseCursor(cursor):
+    try:
+        stamp, kindIndex, id = cursor.split(".")
+        created = dt.datetime.fromtimestamp(int(stamp) / 1000, dt.timezone.utc).replace(tzinfo=None)
+        return created, int(kindIndex), ObjectId(id)
+    except (AttributeError, ValueError, InvalidId, OverflowError):
+        return None
+
+
+# Documents of one kind that come after the cursor position in the feed order, which is
+# (create_date, kind, _id) newest first.
+def afterQuery(kindIndex, position):
+    if position is None:
+        return {"create_date": {"$type": "date"}}
+    created, cursorKind, id = position
+    if kindIndex > cursorKind:
+        # in the same millisecond, kinds later in ORDER were already shown
+        return {"create_date": {"$lt": created}}
+    if kindIndex < cursorKind:
+        return {"create_date": {"$lte": created}}
+    return {"$or": [{"create_date": {"$lt": created}}, {"create_date": created, "_id": {"$lt": id}}]}
+
+
+def newest(kind, position, limit):
+    kindIndex = ORDER.index(kind)
+    fields = {name: 1 for name in KINDS[kind][1] + ["author", "create_date"]}
+    cursor = documentClass(kind)._get_collection().find(afterQuery(kindIndex, position), fields)
+    cursor = cursor.sort([("create_date", -1), ("_id", -1)]).limit(limit).batch_size(limit)
+    for doc in cursor:
+        # heapq.merge wants the smallest first, so the key is the feed order turned around
+        yield (-millis(doc["create_date"]), -kindIndex, reversedId(doc["_id"])), kind, doc
+
+
+# Sorts the opposite way to the ObjectId, so the newest _id comes first like the rest.
+def reversedId(id):
+    return bytes(255 - b for b in id.binary)
+
+
+# One page of the feed: (items, cursor for the next page or None).
+def feedPage(before=None, size=FEED_SIZE):
+    from app.classes.data import User
+    position = parseCursor(before) if before else None
+    merged = heapq.merge(*(newest(kind, position, size + 1) for kind in ORDER), key=lambda entry: entry[0])
+    picked = list(islice(merged, size + 1))
+    more = len(picked) > size
+    picked = picked[:size]
+
+    authorIds = list({doc.get("author") for _, _, doc in picked if doc.get("author")})
+    authors = {user["_id"]: user for user in User._get_collection().find(
+        {"_id": {"$in": authorIds}}, {"fname": 1, "lname": 1, "username": 1})}
+    items = []
+    for _, kind, doc in picked:
+        _, fields, endpoint, argument = KINDS[kind]
+        author = authors.get(doc.get("author"), {})
+        items.append({
+            "kind": kind,
+            "id": str(doc["_id"]),
+            "title": " - ".join(doc[name] for name in fields if doc.get(name)),
+            "author": author.get("username") or f"{author.get('fname') or ''} {author.get('lname') or ''}".strip(),
+            "created": doc["create_date"],
+            "url": url_for(endpoint, **{argument: doc["_id"]}),
+        })
+    return items, (makeCursor(items[-1]) if more else None)
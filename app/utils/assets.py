@@ -0,0 +1,175 @@
+# Fingerprinted static files. Browsers keep a copy of files like app/static/lion.png, but
+# with a plain /static/lion.png address they either check back with the server on every
+# page or keep showing the old picture after it changes. The build step gives every file
+# an address that includes a hash of its contents:
+#
+#     flask --app main assets build
+#
+# writes app/static/build/lion.3f2a9c1b7e.png (plus .gz and .br compressed copies when
+# that makes them smaller) and app/static/build/manifest.json which maps lion.png to it.
+# JPEG and PNG files are also re-saved smaller if Pillow is installed. Run it as part of
+# every deploy, after pulling the new code.
+#
+# In templates use static_url() instead of typing /static/ paths:
+#
+#     <img src="{{ static_url('lion.png') }}">
+#
+# It gives the fingerprinted address when the file is in the manifest and the normal
+# /static/ one when it isn't (no build yet, or a file added since). A fingerprinted file
+# never changes, so it is sent with a one year "immutable" Cache-Control and the browser
+# never asks for it again. A changed file gets a new hash and so a new address.
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+
+import click
+from flask import request, send_from_directory, url_for
+from flask.cli import AppGroup
+
+BUILD = "build"
+MANIFEST = "manifest.json"
+ONE_YEAR = 365 * 24 * 3600
+
+# File types that compress well. Images like JPEG and PNG are already compressed.
+COMPRESSIBLE = {".css", ".js", ".json", ".svg", ".ico", ".txt", ".html", ".map", ".xml"}
+
+
+class StaticAssets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.buildDir = os.path.join(app.static_folder, BUILD)
+        self.loadManifest()
+        app.jinja_env.globals.update(static_url=self.staticUrl)
+        # Flask's own static view still serves everything that isn't fingerprinted.
+        self.plainStatic = app.view_functions["static"]
+        app.view_functions["static"] = self.serve
+        app.cli.add_command(assetsCli)
+
+    def loadManifest(self):
+        try:
+            with open(os.path.join(self.buildDir, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        # fingerprinted name -> the encodings it has compressed copies in
+        self.built = {entry["file"]: entry.get("encodings", []) for entry in self.manifest.values()}
+
+    def staticUrl(self, filename):
+        entry = self.manifest.get(filename)
+        if entry:
+            return url_for("static", filename=f"{BUILD}/{entry['file']}")
+        return url_for("static", filename=filename)
+
+    def serve(self, filename):
+        name = filename[len(BUILD) + 1:] if filename.startswith(BUILD + "/") else None
+        if name not in self.built:
+            return self.plainStatic(filename=filename)
+        encoding = None
+        for candidate in ("br", "gzip"):
+            if candidate in self.built[name] and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        sendName = name + {"br": ".br", "gzip": ".gz"}.get(encoding, "")
+        response = send_from_directory(
+            self.buildDir, sendName,
+            mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            max_age=ONE_YEAR,
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if self.built[name]:
+            response.vary.add("Accept-Encoding")
+        return response
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+# Re-saves a JPEG or PNG with the encoder's extra optimizing passes. Returns the original
+# bytes if Pillow isn't installed or the result isn't smaller.
+def optimizeImage(data, ext):
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    formats = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG"}
+    if ext not in formats:
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        out = io.BytesIO()
+        if formats[ext] == "JPEG":
+            image.save(out, "JPEG", quality=85, optimize=True, progressive=True)
+        else:
+            image.save(out, "PNG", optimize=True)
+    except Exception:
+        return data
+    return out.getvalue() if out.tell() < len(data) else data
+
+
+# Writes name.gz and name.br next to a built file and returns the encodings that were
+# kept. A compressed copy is only kept if it saves at least 10%.
+def compressedCopies(path, data):
+    copies = {"gzip": (".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))}
+    try:
+        import brotli
+        copies["br"] = (".br", lambda raw: brotli.compress(raw, quality=11))
+    except ImportError:
+        pass
+    kept = []
+    for encoding, (suffix, compress) in copies.items():
+        packed = compress(data)
+        if len(packed) < len(data) * 0.9:
+            with open(path + suffix, "wb") as f:
+                f.write(packed)
+            kept.append(encoding)
+    return kept
+
+
+assetsCli = AppGroup("assets", help="Static file build tools.")
+
+
+@assetsCli.command("build")
+def buildAssets():
+    """Fingerprint, optimize and compress everything in app/static."""
+    from app import app
+    static = app.static_folder
+    buildDir = os.path.join(static, BUILD)
+    os.makedirs(buildDir, exist_ok=True)
+    manifest = {}
+    before = after = 0
+    for folder, dirs, files in os.walk(static):
+        dirs[:] = [d for d in dirs if os.path.join(folder, d) != buildDir]
+        for filename in sorted(files):
+            source = os.path.join(folder, filename)
+            name = os.path.relpath(source, static).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                data = f.read()
+            base, ext = os.path.splitext(name)
+            built = f"{base}.{fingerprint(data)}{ext}"
+            target = os.path.join(buildDir, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if ext.lower() in (".jpg", ".jpeg", ".png"):
+                data = optimizeImage(data, ext.lower())
+            with open(target, "wb") as f:
+                f.write(data)
+            encodings = compressedCopies(target, data) if ext.lower() in COMPRESSIBLE else []
+            manifest[name] = {"file": built, "encodings": encodings}
+            before += os.path.getsize(source)
+            after += len(data)
+            click.echo(f"  {name} -> {built} {' '.join(encodings)}")
+    with open(os.path.join(buildDir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    click.echo(f"Built {len(manifest)} files, {before / 1024:,.0f}KB -> {after / 1024:,.0f}KB")
@@ -0,0 +1,156 @@
+# The name index behind /autocomplete?q= and the search box in the navbar. It holds the
+# names of every club, sport and clinic plus the hospitals people can review (HOSPITALS
+# in app/classes/forms.py) in one sorted list in memory, so finding the names that start
+# with what someone typed is a binary search (bisect) and a short walk forward instead of
+# a query.
+#
+# Every word of a name is a way in: "perm" finds "Kaiser Permanente" as well as "kais"
+# does. Each name is stored once per word, as the lowercased rest of the name from that
+# word on, e.g. ("kaiser permanente", ...) and ("permanente", ...). Punctuation and extra
+# spaces are left out of the keys and out of what was typed, so "rehabilitation w" finds
+# "Fairmont Rehabilitation & Wellness".
+#
+# The list is built from MongoDB when a gunicorn worker starts (post_fork in
+# gunicorn.conf.py), or on the first search in other setups. The club, sport and
+# clinic routes call add() and remove() when they create, edit or delete something, so
+# the worker that handled the change is up to date straight away. Other gunicorn workers
+# only see it when they rebuild, which they do every AUTOCOMPLETE_REFRESH_SECONDS
+# (default 300).
+#
+# AUTOCOMPLETE_LIMIT (default 8) is how many names a request gets back.
+
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import url_for
+
+WORD = re.compile(r"\w+")
+
+
+class Autocomplete:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.keys = []
+        self.entries = {}
+        self.builtAt = None
+        self.rebuilding = False
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("AUTOCOMPLETE_LIMIT", int(os.environ.get("AUTOCOMPLETE_LIMIT", 8)))
+        app.config.setdefault("AUTOCOMPLETE_REFRESH_SECONDS", int(os.environ.get("AUTOCOMPLETE_REFRESH_SECONDS", 300)))
+        self.limit = app.config["AUTOCOMPLETE_LIMIT"]
+        self.refreshSeconds = app.config["AUTOCOMPLETE_REFRESH_SECONDS"]
+
+    # Every (key, kind, id) one name is stored under: one per word. The first one is the
+    # whole name.
+    def keysFor(self, kind, id, name):
+        words = normalize(name).split(" ")
+        return [(" ".join(words[i:]), kind, id) for i in range(len(words)) if words[i]]
+
+    def load(self):
+        from app.classes.data import Club, Clinic, Sport
+        from app.classes.forms import HOSPITALS
+        entries = {}
+        for kind, cls in (("club", Club), ("sport", Sport), ("clinic", Clinic)):
+            for doc in cls._get_collection().find({}, {"name": 1}):
+                if doc.get("name"):
+                    entries[(kind, str(doc["_id"]))] = doc["name"]
+        for value, label in HOSPITALS:
+            entries[("hospital", value)] = label
+        keys = []
+        for (kind, id), name in entries.items():
+            keys.extend(self.keysFor(kind, id, name))
+        keys.sort()
+        return keys, entries
+
+    # Builds the index the first time this worker needs it (a forked worker can't use
+    # the parent's). When it gets older than AUTOCOMPLETE_REFRESH_SECONDS it is rebuilt
+    # in a background thread while searches keep using the old one.
+    def ensureBuilt(self):
+        if self.pid != os.getpid():
+            self.rebuild()
+        elif time.monotonic() - self.builtAt >= self.refreshSeconds and not self.rebuilding:
+            self.rebuilding = True
+            threading.Thread(target=self.rebuild, name="autocomplete", daemon=True).start()
+
+    def rebuild(self):
+        try:
+            keys, entries = self.load()
+            with self.lock:
+                self.keys, self.entries = keys, entries
+                self.builtAt = time.monotonic()
+                self.pid = os.getpid()
+        finally:
+            self.rebuilding = False
+
+    def add(self, kind, id, name):
+        id = str(id)
+        with self.lock:
+            if self.pid != os.getpid():
+                # Not built yet, it will read this from the database when it is.
+                return
+            self.removeLocked(kind, id)
+            if not name:
+                return
+            self.entries[(kind, id)] = name
+            for key in self.keysFor(kind, id, name):
+                insort(self.keys, key)
+
+    def remove(self, kind, id):
+        with self.lock:
+            if self.pid == os.getpid():
+                self.removeLocked(kind, str(id))
+
+    def removeLocked(self, kind, id):
+        name = self.entries.pop((kind, id), None)
+        if name is None:
+            return
+        for key in self.keysFor(kind, id, name):
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    # The first `limit` names (in alphabetical order of the matching word) with a word
+    # starting with prefix. Of those, names that start with it come first.
+    def search(self, prefix, limit=None):
+        limit = limit or self.limit
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self.ensureBuilt()
+        starts, inside, seen = [], [], set()
+        with self.lock:
+            i = bisect_left(self.keys, (prefix,))
+            while i < len(self.keys) and len(starts) + len(inside) < limit:
+                key, kind, id = self.keys[i]
+                if not key.startswith(prefix):
+                    break
+                i += 1
+                if (kind, id) in seen:
+                    continue
+                seen.add((kind, id))
+                name = self.entries[(kind, id)]
+                match = {"kind": kind, "id": id, "name": name}
+                (starts if key == normalize(name) else inside).append(match)
+        return starts + inside
+
+
+def normalize(text):
+    return " ".join(WORD.findall((text or "").lower()))
+
+
+# Where each kind of match links to.
+def matchUrl(match):
+    if match["kind"] == "club":
+        return url_for("club", clubID=match["id"])
+    if match["kind"] == "sport":
+        return url_for("sport", sportID=match["id"])
+    if match["kind"] == "clinic":
+        return url_for("clinic", clinicID=match["id"])
+    return url_for("reviewList")
@@ -0,0 +1,81 @@
+# Stores uploaded files (profile pictures) in GridFS without keeping copies of the same
+# file. Every file is named by the SHA-256 of its bytes in the Blob collection. Uploading
+# a file that is already stored just adds one to its Blob.refs instead of writing it
+# again, and release() takes one away and deletes the file when nobody uses it anymore.
+#
+#     gridId = blobstore.store(request.files["image"])
+#     ...point the user's FileField at gridId...
+#     blobstore.release(oldGridId)
+#
+# Files are read CHUNK bytes at a time, so memory use is the same for a 10KB or a 10MB
+# upload. (Werkzeug already keeps uploads bigger than 500KB in a temporary file instead
+# of memory, and MAX_CONTENT_LENGTH in app/__init__.py caps how big they can be.)
+
+import hashlib
+
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# GridFS stores files in 255KB chunks, so read them the same size.
+CHUNK = 255 * 1024
+
+
+def gridfs(collectionName="fs"):
+    import gridfs
+    return gridfs.GridFS(get_db(), collectionName)
+
+
+def sha256(stream):
+    digest = hashlib.sha256()
+    length = 0
+    for chunk in iter(lambda: stream.read(CHUNK), b""):
+        digest.update(chunk)
+        length += len(chunk)
+    return digest.hexdigest(), length
+
+
+# Saves a file-like object (like a werkzeug FileStorage) and returns the GridFS id to
+# store in a FileField. The file is hashed first, and only written to GridFS if no one
+# has uploaded the same bytes before, so a repeated upload doesn't write any chunks.
+def store(upload, contentType=None, collectionName="fs"):
+    from app.classes.data import Blob
+    stream = getattr(upload, "stream", upload)
+    contentType = contentType or getattr(upload, "mimetype", None)
+    digest, length = sha256(stream)
+    blobs = Blob._get_collection()
+    existing = blobs.find_one_and_update({"_id": digest}, {"$inc": {"refs": 1}}, projection={"grid_id": 1})
+    if existing:
+        return existing["grid_id"]
+
+    stream.seek(0)
+    files = gridfs(collectionName)
+    # GridFS.put reads and writes one chunk at a time
+    gridId = files.put(stream, content_type=contentType, sha256=digest)
+    try:
+        blobs.insert_one({"_id": digest, "grid_id": gridId, "refs": 1, "length": length, "content_type": contentType})
+    except DuplicateKeyError:
+        # Someone uploaded the same file at the same moment and won. Use theirs.
+        files.delete(gridId)
+        existing = blobs.find_one_and_update({"_id": digest}, {"$inc": {"refs": 1}}, projection={"grid_id": 1})
+        return existing["grid_id"]
+    return gridId
+
+
+# Drops one user of a stored file and deletes the file if that was the last one.
+def release(gridId, collectionName="fs"):
+    from app.classes.data import Blob
+    if gridId is None:
+        return
+    blobs = Blob._get_collection()
+    blob = blobs.find_one_and_update(
+        {"grid_id": gridId}, {"$inc": {"refs": -1}},
+        projection={"refs": 1}, return_document=ReturnDocument.AFTER,
+    )
+    if blob is None:
+        # A file saved before there was a blob store, which only this user had.
+        gridfs(collectionName).delete(gridId)
+    elif blob["refs"] <= 0:
+        # Only delete if nobody took a new reference in the meantime.
+        if blobs.delete_one({"_id": blob["_id"], "refs": {"$lte": 0}}).deleted_count:
+            gridfs(collectionName).delete(gridId)
@@ -0,0 +1,370 @@
+# Adds lots of clinics at once from a CSV file, instead of filling in /clinic/new once
+# per clinic. The first line of the file names the columns, which are the ClinicForm
+# fields (spaces, underscores and capitals in the names don't matter):
+#
+#     name,streetAddress,city,state,zipcode,description
+#     Eastmont Wellness,6955 Foothill Blvd,Oakland,CA,94605,Primary care and dental
+#
+# From the main project folder:
+#
+#     flask --app main clinics import clinics.csv --author someone@school.org
+#     flask --app main clinics import clinics.csv --author someone@school.org --dry-run
+#
+# or, for staff, upload the file at /clinic/import, which runs the import in the
+# background and shows how far it has got.
+#
+# Every row is checked with the same rules as ClinicForm. Rows that fail are reported
+# with their line number and left out; the rest go in. Then every address is looked up
+# (geocoded) to get the lat/lon for the clinic map:
+#   - identical addresses are only looked up once, and addresses of clinics already in
+#     the database that have a lat/lon aren't looked up at all
+#   - the lookups run CLINIC_IMPORT_WORKERS (default 4) at a time, but never more than
+#     CLINIC_IMPORT_RATE (default 1, which is what OpenStreetMap's Nominatim allows) per
+#     second in total across every gunicorn worker and 'flask clinics import', including
+#     the one /clinic/new makes. They share one token bucket in the rate_limit collection
+#     (the "mongo" storage of app/utils/ratelimit.py), and only fall back to spacing out
+#     each process's own lookups if MongoDB can't be reached.
+#   - an address that can't be found still gets its clinic, just without a lat/lon
+# The clinics are saved with insert_many, CLINIC_IMPORT_BATCH_SIZE (default 500) at a
+# time, as soon as their address is known, so an import that stops half way (the server
+# restarted, say) keeps the clinics it had already looked up.
+#
+# An upload runs in a thread of the web worker that took it, which saves a heartbeat on
+# its clinic_imports job every HEARTBEAT_SECONDS. If the worker goes away the heartbeat
+# stops, and the status page shows the job as failed once it is STALE_SECONDS old instead
+# of waiting for it forever. Very big files are better imported with the command above.
+#
+# CLINIC_IMPORT_GEOCODER picks who does the lookups: "nominatim" (the default) or "stub",
+# which makes up a point near Oakland from the address without using the network, for
+# tests and for trying an import on a computer that is offline.
+
+import csv
+import datetime as dt
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+import requests
+from flask.cli import AppGroup
+from pymongo.errors import PyMongoError
+from werkzeug.datastructures import MultiDict
+
+from app.utils.ratelimit import MongoBuckets
+
+log = logging.getLogger("app.clinicimport")
+
+FIELDS = ("name", "streetAddress", "city", "state", "zipcode", "description")
+ADDRESS_FIELDS = ("streetAddress", "city", "state", "zipcode")
+JOBS_COLLECTION = "clinic_imports"
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+
+importCli = AppGroup("clinics", help="Bulk clinic imports.")
+
+
+# Spaces out calls so there are never more than perSecond of them, however many threads
+# are making them. With a key the limit is shared by every process through a MongoDB token
+# bucket under that key, otherwise it is just for this process.
+class RateLimit:
+    def __init__(self, perSecond, key=None):
+        self.interval = 1 / perSecond if perSecond else 0
+        self.key = key
+        self.buckets = MongoBuckets() if key else None
+        self.lock = threading.Lock()
+        self.nextAt = 0.0
+
+    # Waits for the next free turn. With maxWait, gives up (returning False) instead of
+    # waiting longer than that many seconds.
+    def wait(self, maxWait=None):
+        if not self.interval:
+            return True
+        if self.buckets is None:
+            return self.localWait(maxWait)
+        giveUpAt = None if maxWait is None else time.monotonic() + maxWait
+        while True:
+            try:
+                # The bucket holds one turn, so a wait of 0 means this call has it
+                wait = self.buckets.take(self.key, 1, self.interval)
+            except PyMongoError:
+                log.warning("couldn't reach the shared %s rate limit, limiting this process only", self.key, exc_info=True)
+                return self.localWait(None if giveUpAt is None else giveUpAt - time.monotonic())
+            if not wait:
+                return True
+            if giveUpAt is not None and time.monotonic() + wait > giveUpAt:
+                return False
+            time.sleep(wait)
+
+    def localWait(self, maxWait):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.nextAt)
+            if maxWait is not None and at - now > maxWait:
+                return False
+            self.nextAt = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+        return True
+
+
+# Both geocoders take an address (a dict with the ADDRESS_FIELDS) and give back
+# (lat, lon), or None if the address couldn't be found.
+class NominatimGeocoder:
+    url = "https://nominatim.openstreetmap.org/search"
+
+    def geocode(self, address):
+        from app.utils import outbound
+        from app.utils.secrets import getSecrets
+        params = {
+            "street": address["streetAddress"], "city": address["city"], "state": address["state"],
+            "postalcode": address["zipcode"], "format": "json", "addressdetails": 1,
+            # Nominatim asks for an email so they can get in touch about heavy use
+            "email": getSecrets()["MY_EMAIL_ADDRESS"],
+        }
+        found = outbound.get(self.url, params=params, timeout=10).json()
+        if not found:
+            return None
+        return float(found[0]["lat"]), float(found[0]["lon"])
+
+
+class StubGeocoder:
+    def geocode(self, address):
+        digest = hashlib.sha1(addressKey(address).encode()).digest()
+        return 37.8 + (digest[0] - 128) / 1000, -122.27 + (digest[1] - 128) / 1000
+
+
+GEOCODERS = {"nominatim": NominatimGeocoder, "stub": StubGeocoder}
+
+
+class ClinicImport:
+    def __init__(self, app=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault("CLINIC_IMPORT_GEOCODER", os.environ.get("CLINIC_IMPORT_GEOCODER", "nominatim"))
+        app.config.setdefault("CLINIC_IMPORT_RATE", float(os.environ.get("CLINIC_IMPORT_RATE", 1)))
+        app.config.setdefault("CLINIC_IMPORT_WORKERS", int(os.environ.get("CLINIC_IMPORT_WORKERS", 4)))
+        app.config.setdefault("CLINIC_IMPORT_BATCH_SIZE", int(os.environ.get("CLINIC_IMPORT_BATCH_SIZE", 500)))
+        self.geocoder = GEOCODERS[app.config["CLINIC_IMPORT_GEOCODER"]]()
+        self.rateLimit = RateLimit(app.config["CLINIC_IMPORT_RATE"], "geocode:" + app.config["CLINIC_IMPORT_GEOCODER"])
+        self.workers = app.config["CLINIC_IMPORT_WORKERS"]
+        self.batchSize = app.config["CLINIC_IMPORT_BATCH_SIZE"]
+        app.cli.add_command(importCli)
+
+    # Looks up one address, waiting for its turn under CLINIC_IMPORT_RATE. Inside a
+    # request it won't wait past the route's time budget (see app/utils/deadline.py).
+    def geocode(self, address):
+        from app.utils.deadline import remaining
+        if not self.rateLimit.wait(remaining()):
+            return None
+        try:
+            return self.geocoder.geocode(address)
+        except (requests.RequestException, ValueError, KeyError, IndexError):
+            log.warning("couldn't geocode %s", addressKey(address), exc_info=True)
+            return None
+
+    # Imports the CSV text. progress(stage, done, total) is called as it goes, with stage
+    # "checking", "geocoding" or "saving". Returns what happened as a dict.
+    def run(self, text, author, progress=None, dryRun=False):
+        from app import autocomplete
+        from app.classes.data import Clinic
+        progress = progress or (lambda stage, done, total: None)
+        result = {"rows": 0, "errors": [], "addresses": 0, "known": 0, "geocoded": 0, "notFound": 0, "inserted": 0}
+
+        rows = []
+        for line, row in readRows(text):
+            result["rows"] += 1
+            problems = checkRow(row)
+            if problems:
+                result["errors"].append(f"line {line}: {problems}")
+            else:
+                rows.append(row)
+            if result["rows"] % 100 == 0:
+                progress("checking", result["rows"], None)
+        progress("checking", result["rows"], result["rows"])
+
+        points = knownPoints()
+        addresses = {}
+        for row in rows:
+            addresses.setdefault(addressKey(row), []).append(row)
+        result["addresses"] = len(addresses)
+        missing = {key: found[0] for key, found in addresses.items() if key not in points}
+        result["known"] = len(addresses) - len(missing)
+        if dryRun:
+            return result
+
+        clinics = Clinic._get_collection()
+        now = dt.datetime.utcnow()
+        waiting = []
+
+        def save(upTo):
+            while len(waiting) >= upTo and waiting:
+                batch = []
+                for row in waiting[:self.batchSize]:
+                    lat, lon = points.get(addressKey(row), (None, None))
+                    clinic = Clinic(author=author, create_date=now, lat=lat, lon=lon,
+                                    **{name: row[name].strip() for name in FIELDS})
+                    batch.append(clinic.to_mongo().to_dict())
+                del waiting[:self.batchSize]
+                inserted = clinics.insert_many(batch, ordered=False).inserted_ids
+                for doc, id in zip(batch, inserted):
+                    autocomplete.add("clinic", id, doc["name"])
+                result["inserted"] += len(inserted)
+
+        # Clinics at addresses that are already known don't wait for the lookups
+        for key, found in addresses.items():
+            if key not in missing:
+                waiting.extend(found)
+        save(self.batchSize)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="geocode") as pool:
+                lookups = {pool.submit(self.geocode, row): key for key, row in missing.items()}
+                for done, lookup in enumerate(as_completed(lookups), 1):
+                    point = lookup.result()
+                    if point is None:
+                        result["notFound"] += 1
+                    else:
+                        points[lookups[lookup]] = point
+                        result["geocoded"] += 1
+                    waiting.extend(addresses[lookups[lookup]])
+                    save(self.batchSize)
+                    progress("geocoding", done, len(missing))
+        save(1)
+        progress("saving", result["inserted"], len(rows))
+        log.info("imported %s clinics for %s: %s", result["inserted"], author, result)
+        return result
+
+    # Runs an uploaded file in a background thread. How far it has got is kept in the
+    # clinic_imports collection so /clinic/import/<id> works from any worker.
+    def start(self, text, author, filename):
+        jobs = jobCollection()
+        now = dt.datetime.utcnow()
+        jobId = jobs.insert_one({
+            "author": author, "filename": filename, "status": "running", "stage": "checking",
+            "done": 0, "total": None, "started": now, "heartbeat": now,
+        }).inserted_id
+        threading.Thread(target=self.runJob, args=(jobId, text, author), name="clinic-import", daemon=True).start()
+        return jobId
+
+    def runJob(self, jobId, text, author):
+        jobs = jobCollection()
+        lastSaved = [0.0]
+
+        def progress(stage, done, total):
+            # Saved at most twice a second, and always at the end of a stage
+            if done == total or time.monotonic() - lastSaved[0] >= 0.5:
+                jobs.update_one({"_id": jobId}, {"$set": {"stage": stage, "done": done, "total": total}})
+                lastSaved[0] = time.monotonic()
+
+        # A single lookup can take a while, so the heartbeat has its own thread
+        finished = threading.Event()
+
+        def beat():
+            while not finished.wait(HEARTBEAT_SECONDS):
+                try:
+                    jobs.update_one({"_id": jobId}, {"$set": {"heartbeat": dt.datetime.utcnow()}})
+                except PyMongoError:
+                    log.warning("couldn't save the heartbeat of clinic import %s", jobId, exc_info=True)
+
+        threading.Thread(target=beat, name="clinic-import-heartbeat", daemon=True).start()
+        try:
+            with self.app.app_context():
+                result = self.run(text, author, progress)
+            jobs.update_one({"_id": jobId}, {"$set": {"status": "done", "result": result, "finished": dt.datetime.utcnow()}})
+        except Exception as error:
+            log.exception("clinic import %s failed", jobId)
+            jobs.update_one({"_id": jobId}, {"$set": {"status": "failed", "error": str(error), "finished": dt.datetime.utcnow()}})
+        finally:
+            finished.set()
+
+
+def jobCollection():
+    from mongoengine.connection import get_db
+    return get_db()[JOBS_COLLECTION]
+
+
+# The job with this _id, or None. A running job whose heartbeat stopped more than
+# STALE_SECONDS ago lost its worker, so it is marked as failed.
+def findJob(jobId):
+    jobs = jobCollection()
+    job = jobs.find_one({"_id": jobId})
+    if job is None or job["status"] != "running":
+        return job
+    if dt.datetime.utcnow() - job.get("heartbeat", job["started"]) < dt.timedelta(seconds=STALE_SECONDS):
+        return job
+    stopped = {"status": "failed", "finished": dt.datetime.utcnow(),
+               "error": "the server running it restarted. Clinics it had already looked up were saved, "
+                        "so check the clinic list before uploading the rest of the file again."}
+    jobs.update_one({"_id": jobId, "status": "running", "heartbeat": job.get("heartbeat")}, {"$set": stopped})
+    return jobs.find_one({"_id": jobId})
+
+
+# (line number, row) for every row of the file, with the columns renamed to the
+# ClinicForm field names.
+def readRows(text):
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None) or []
+    names = {re.sub(r"[\s_]", "", name).lower(): name for name in FIELDS}
+    columns = [names.get(re.sub(r"[\s_]", "", column).lower()) for column in header]
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+        yield reader.line_num, {name: value for name, value in zip(columns, row) if name}
+
+
+# What is wrong with a row by ClinicForm's rules, or "" if nothing is.
+def checkRow(row):
+    from app.classes.forms import ClinicForm
+    form = ClinicForm(formdata=MultiDict(row), meta={"csrf": False})
+    if form.validate():
+        return ""
+    return "; ".join(f"{name}: {' '.join(errors)}" for name, errors in form.errors.items())
+
+
+# The same address written with different spaces or capitals is the same address.
+def addressKey(address):
+    return "|".join(" ".join((address.get(name) or "").lower().split()) for name in ADDRESS_FIELDS)
+
+
+# addressKey -> (lat, lon) for the clinics already in the database that have them.
+def knownPoints():
+    from app.classes.data import Clinic
+    found = Clinic._get_collection().find({"lat": {"$ne": None}, "lon": {"$ne": None}},
+                                          {name: 1 for name in ADDRESS_FIELDS + ("lat", "lon")})
+    return {addressKey(doc): (doc["lat"], doc["lon"]) for doc in found}
+
+
+@importCli.command("import")
+@click.argument("csvfile", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--author", required=True, help="Email of the user the clinics are posted as.")
+@click.option("--dry-run", is_flag=True, help="Check the rows and count the addresses without looking them up or saving.")
+def importClinics(csvfile, author, dry_run):
+    """Add the clinics in a CSV file, looking up their lat/lon."""
+    from app import clinicImport
+    from app.classes.data import User
+    user = User.objects(email=author).only("id").first()
+    if user is None:
+        raise click.ClickException(f"No user with the email {author}")
+    began = time.perf_counter()
+    shown = {}
+
+    def progress(stage, done, total):
+        # One line a second per stage, plus the last one
+        if done == total or time.monotonic() - shown.get(stage, 0) >= 1:
+            click.echo(f"  {stage}: {done:,}" + (f" of {total:,}" if total else ""))
+            shown[stage] = time.monotonic()
+
+    result = clinicImport.run(csvfile.read(), user.id, progress, dryRun=dry_run)
+    for error in result["errors"]:
+        click.echo(f"  skipped {error}")
+    click.echo(f"{result['rows']:,} rows, {len(result['errors']):,} skipped, {result['addresses']:,} addresses "
+               f"({result['known']:,} already known, {result['geocoded']:,} looked up, {result['notFound']:,} not found)")
+    click.echo(("Checked" if dry_run else f"Saved {result['inserted']:,} clinics") + f" in {time.perf_counter() - began:.1f}s")
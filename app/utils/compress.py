@@ -0,0 +1,151 @@
+# Compresses responses on the way out. Pages like cliniclocator.html (every clinic in
+# the page) and review.html (big reply trees) are hundreds of KB of HTML that shrinks
+# 5-10 times with gzip, which matters most on slow phone connections.
+#
+# This wraps the whole app (app.wsgi_app) so it sees every response after Flask is done
+# with it. A response is compressed when:
+#   - the browser's Accept-Encoding allows br (brotli, if installed) or gzip
+#   - its Content-Type is text like HTML, CSS, JSON or JavaScript (COMPRESS_TYPES)
+#   - it is at least COMPRESS_MIN_SIZE bytes (default 500), or streamed with no length
+#   - it isn't compressed already, like the precompressed files from app/utils/assets.py
+# Streamed responses are compressed a piece at a time and each piece is flushed, so the
+# browser still gets the top of the page as soon as it is rendered.
+#
+# Every response that could be compressed gets "Vary: Accept-Encoding" so caches between
+# us and the browser don't hand a gzipped page to a browser that can't read it.
+
+import os
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_options_header, parse_set_header
+
+COMPRESS_TYPES = {
+    "text/html", "text/css", "text/plain", "text/xml", "text/javascript", "text/csv",
+    "application/javascript", "application/json", "application/xml", "image/svg+xml",
+}
+
+# Bodies up to this size are compressed all at once. Bigger ones (like a large file) and
+# streamed ones are compressed as they are sent.
+BUFFER_LIMIT = 1024 * 1024
+
+
+# The old WSGI write() callable. Flask never uses it.
+def unsupportedWrite(data):
+    raise RuntimeError("Compress doesn't support the WSGI write() callable")
+
+
+class Compress:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_ENABLED", os.environ.get("COMPRESS_ENABLED", "1") != "0")
+        app.config.setdefault("COMPRESS_MIN_SIZE", int(os.environ.get("COMPRESS_MIN_SIZE", 500)))
+        app.config.setdefault("COMPRESS_LEVEL", int(os.environ.get("COMPRESS_LEVEL", 6)))
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4)))
+        app.config.setdefault("COMPRESS_TYPES", COMPRESS_TYPES)
+        if not app.config["COMPRESS_ENABLED"]:
+            return
+        self.minSize = app.config["COMPRESS_MIN_SIZE"]
+        self.level = app.config["COMPRESS_LEVEL"]
+        self.brotliQuality = app.config["COMPRESS_BROTLI_QUALITY"]
+        self.types = set(app.config["COMPRESS_TYPES"])
+        try:
+            import brotli
+            self.brotli = brotli
+        except ImportError:
+            self.brotli = None
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+
+    # The best encoding the browser accepts, or None
+    def chooseEncoding(self, environ):
+        accepted = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if self.brotli is not None and accepted.quality("br") > 0:
+            return "br"
+        if accepted.quality("gzip") > 0:
+            return "gzip"
+        return None
+
+    def compressible(self, status, headers):
+        code = int(status.split(" ", 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if "Content-Encoding" in headers:
+            return False
+        if "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        mimetype = parse_options_header(headers.get("Content-Type", ""))[0]
+        if mimetype not in self.types:
+            return False
+        length = headers.get("Content-Length")
+        return length is None or int(length) >= self.minSize
+
+    def compressor(self, encoding):
+        if encoding == "br":
+            compressor = self.brotli.Compressor(quality=self.brotliQuality)
+            return compressor.process, compressor.flush, compressor.finish
+        # wbits 31 means "with a gzip header and trailer"
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    def __call__(self, environ, start_response):
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return self.wsgi_app(environ, start_response)
+        started = {}
+
+        # Flask calls start_response before it hands back the body, so the headers
+        # can still be changed after looking at them.
+        def captureStart(status, headers, exc_info=None):
+            started.update(status=status, headers=headers, exc_info=exc_info)
+            return unsupportedWrite
+
+        body = self.wsgi_app(environ, captureStart)
+        status, headers = started["status"], Headers(started["headers"])
+        if not self.compressible(status, headers):
+            start_response(status, headers.to_wsgi_list(), started["exc_info"])
+            return body
+
+        vary = parse_set_header(headers.get("Vary", ""))
+        vary.add("Accept-Encoding")
+        headers["Vary"] = vary.to_header()
+        encoding = self.chooseEncoding(environ)
+        if encoding is None:
+            start_response(status, headers.to_wsgi_list(), started["exc_info"])
+            return body
+
+        headers["Content-Encoding"] = encoding
+        # The bytes are different now, so a strong ETag would be a lie. A weak one still
+        # lets the browser ask "has it changed?".
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+        compress, flush, finish = self.compressor(encoding)
+
+        if int(headers.get("Content-Length", BUFFER_LIMIT + 1)) <= BUFFER_LIMIT:
+            # A normal page is already all in memory, so compress it in one go and send
+            # the real length.
+            try:
+                data = compress(b"".join(body)) + finish()
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+            headers["Content-Length"] = str(len(data))
+            start_response(status, headers.to_wsgi_list(), started["exc_info"])
+            return [data]
+
+        headers.pop("Content-Length", None)
+        start_response(status, headers.to_wsgi_list(), started["exc_info"])
+        return self.stream(body, compress, flush, finish)
+
+    def stream(self, body, compress, flush, finish):
+        try:
+            for chunk in body:
+                if chunk:
+                    yield compress(chunk) + flush()
+            yield finish()
+        finally:
+            if hasattr(body, "close"):
+                body.close()
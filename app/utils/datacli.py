@@ -0,0 +1,415 @@
+# Commands for moving all of the data in and out of the database in bulk. This is how you
+# copy the site's data to another computer or fill a test database without clicking
+# through the web forms one post at a time. From the main project folder:
+#
+#     flask --app main data export backup/          (writes backup/blog.ndjson, backup/user.ndjson ...)
+#     flask --app main data import backup/          (reads them back into the database)
+#     flask --app main data import backup/ --collection blog --upsert
+#
+# Every collection in app/classes/data.py is written to its own NDJSON file (one JSON
+# document per line, using MongoDB's extended JSON so ObjectIds and dates survive). Files
+# stored in GridFS, like the User.image profile pictures, go in a tar archive next to
+# them (fs.tar) so the NDJSON files stay small.
+#
+# Both commands read and write in batches so memory use stays the same for a 1MB or a
+# 10GB dump. They save a checkpoint after every batch. If one stops part way (crash,
+# ctrl-c, lost connection) just run the same command again and it picks up where it
+# left off. Use --fresh to start over instead. Once every collection is done the
+# checkpoint is deleted, so the same dump can be imported again (into another database,
+# or to re-seed a test one) and the same folder exported to again.
+
+import json
+import os
+import tarfile
+import time
+
+import click
+from flask.cli import AppGroup
+
+from app import app
+
+dataCli = AppGroup("data", help="Bulk export and import of every collection as NDJSON.")
+
+EXPORT_CHECKPOINT = ".export-checkpoint.json"
+IMPORT_CHECKPOINT = ".import-checkpoint.json"
+
+
+# Every mongoengine Document class in data.py. Imported here instead of at the top so the
+# app doesn't load the models just to list the flask commands.
+def documentClasses():
+    from mongoengine import Document
+    from app.classes import data
+    return [
+        value for value in vars(data).values()
+        if isinstance(value, type) and issubclass(value, Document) and value.__module__ == data.__name__
+    ]
+
+
+# The GridFS collections (like 'fs') used by FileFields, with the database each lives in.
+def gridfsCollections():
+    from mongoengine import FileField
+    from mongoengine.connection import get_db
+    found = {}
+    for cls in documentClasses():
+        for field in cls._fields.values():
+            if isinstance(field, FileField):
+                found[field.collection_name] = get_db(field.db_alias)
+    return found
+
+
+def loadCheckpoint(folder, name, fresh):
+    path = os.path.join(folder, name)
+    if fresh or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# Written to a temporary file and then renamed so a crash never leaves half a checkpoint.
+def saveCheckpoint(folder, name, checkpoint):
+    path = os.path.join(folder, name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+# Deletes the checkpoint once everything in it is done. A run of only some collections
+# leaves it while another run that stopped part way still needs it.
+def finishCheckpoint(folder, name, checkpoint):
+    path = os.path.join(folder, name)
+    if all(state["done"] for state in checkpoint.values()) and os.path.exists(path):
+        os.remove(path)
+
+
+def chooseCollections(names):
+    classes = {cls._get_collection_name(): cls for cls in documentClasses()}
+    if not names:
+        return classes
+    unknown = set(names) - set(classes) - set(gridfsCollections())
+    if unknown:
+        raise click.BadParameter(f"unknown collection(s): {', '.join(sorted(unknown))}. Choose from {', '.join(sorted(classes))}.")
+    return {name: cls for name, cls in classes.items() if name in names}
+
+
+def report(name, count, size, began):
+    seconds = max(time.perf_counter() - began, 0.001)
+    click.echo(f"  {name}: {count:,} documents, {size / 1e6:.1f}MB in {seconds:.1f}s ({size / 1e6 / seconds:.1f}MB/s)")
+
+
+########## Export ##########
+
+def exportCollection(folder, name, cls, batchSize, checkpoint, checkpointName):
+    from bson import json_util
+    state = checkpoint.setdefault(name, {"offset": 0, "last_id": None, "count": 0, "done": False})
+    if state["done"]:
+        click.echo(f"  {name}: already exported")
+        return
+    path = os.path.join(folder, f"{name}.ndjson")
+    # Anything after the last checkpoint is a batch that may not have finished writing.
+    with open(path, "ab") as f:
+        f.truncate(state["offset"])
+
+    query = {}
+    if state["last_id"] is not None:
+        query = {"_id": {"$gt": json_util.loads(state["last_id"])}}
+    # Sorting on _id uses the _id index and makes "everything after the last _id" a
+    # correct way to resume.
+    cursor = cls._get_collection().find(query, batch_size=batchSize).sort("_id", 1)
+
+    began = time.perf_counter()
+    written = 0
+    with open(path, "ab") as f:
+        lines = []
+        for doc in cursor:
+            lines.append(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS))
+            if len(lines) == batchSize:
+                written += writeBatch(f, lines)
+                state.update(offset=f.tell(), last_id=json_util.dumps(doc["_id"]), count=state["count"] + len(lines))
+                saveCheckpoint(folder, checkpointName, checkpoint)
+                lines = []
+        if lines:
+            written += writeBatch(f, lines)
+            state.update(offset=f.tell(), last_id=json_util.dumps(doc["_id"]), count=state["count"] + len(lines))
+    state["done"] = True
+    saveCheckpoint(folder, checkpointName, checkpoint)
+    report(name, state["count"], written, began)
+
+
+def writeBatch(f, lines):
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    f.write(data)
+    f.flush()
+    return len(data)
+
+
+# GridFS files are copied into a tar archive a chunk at a time, so even a huge image is
+# never fully in memory. Each file in the archive is named with its GridFS _id and keeps
+# its content type and filename in the tar (PAX) headers.
+def exportFiles(folder, name, db, checkpoint, checkpointName):
+    import gridfs
+    from bson import ObjectId
+    state = checkpoint.setdefault(f"{name}.tar", {"offset": 0, "last_id": None, "count": 0, "done": False})
+    if state["done"]:
+        click.echo(f"  {name}.tar: already exported")
+        return
+    path = os.path.join(folder, f"{name}.tar")
+    query = {}
+    if state["last_id"] is not None:
+        query = {"_id": {"$gt": ObjectId(state["last_id"])}}
+
+    began = time.perf_counter()
+    with open(path, "ab") as f:
+        f.truncate(state["offset"])
+    with open(path, "r+b") as f:
+        f.seek(state["offset"])
+        # mode 'w' on an open file starts writing where the file is, which is how the
+        # archive is continued after a resume
+        tar = tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT)
+        for gridOut in gridfs.GridFS(db, collection=name).find(query, no_cursor_timeout=True).sort("_id", 1):
+            info = tarfile.TarInfo(str(gridOut._id))
+            info.size = gridOut.length
+            info.mtime = gridOut.upload_date.timestamp()
+            info.pax_headers = {"contentType": gridOut.content_type or "", "filename": gridOut.filename or ""}
+            tar.addfile(info, fileobj=gridOut)
+            # tarfile remembers every member it has written; forget them to keep memory flat
+            tar.members = []
+            f.flush()
+            state.update(offset=tar.offset, last_id=str(gridOut._id), count=state["count"] + 1)
+            saveCheckpoint(folder, checkpointName, checkpoint)
+        tar.close()
+    state["done"] = True
+    saveCheckpoint(folder, checkpointName, checkpoint)
+    report(f"{name}.tar", state["count"], os.path.getsize(path), began)
+
+
+@dataCli.command("export")
+@click.argument("folder", type=click.Path(file_okay=False))
+@click.option("--collection", "-c", multiple=True, help="Only export this collection. Can be used more than once.")
+@click.option("--batch-size", default=1000, show_default=True, help="Documents read and written per batch.")
+@click.option("--fresh", is_flag=True, help="Ignore any checkpoint and start the export over.")
+def exportData(folder, collection, batch_size, fresh):
+    """Export collections to FOLDER as NDJSON, plus GridFS files as tar archives."""
+    os.makedirs(folder, exist_ok=True)
+    checkpoint = loadCheckpoint(folder, EXPORT_CHECKPOINT, fresh)
+    click.echo(f"Exporting to {folder}")
+    for name, cls in chooseCollections(collection).items():
+        exportCollection(folder, name, cls, batch_size, checkpoint, EXPORT_CHECKPOINT)
+    for name, db in gridfsCollections().items():
+        if not collection or name in collection:
+            exportFiles(folder, name, db, checkpoint, EXPORT_CHECKPOINT)
+    finishCheckpoint(folder, EXPORT_CHECKPOINT, checkpoint)
+    click.echo("Done.")
+
+
+########## Import ##########
+
+def importCollection(folder, name, cls, batchSize, upsert, checkpoint, checkpointName):
+    from bson import json_util
+    path = os.path.join(folder, f"{name}.ndjson")
+    if not os.path.exists(path):
+        return
+    state = checkpoint.setdefault(name, {"offset": 0, "count": 0, "done": False})
+    if state["done"]:
+        click.echo(f"  {name}: already imported")
+        return
+
+    collection = cls._get_collection()
+    began = time.perf_counter()
+    offset = state["offset"]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        batch = []
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                batch.append(json_util.loads(line))
+            if len(batch) == batchSize:
+                writeDocuments(collection, batch, upsert)
+                state.update(offset=offset, count=state["count"] + len(batch))
+                saveCheckpoint(folder, checkpointName, checkpoint)
+                batch = []
+        if batch:
+            writeDocuments(collection, batch, upsert)
+            state.update(offset=offset, count=state["count"] + len(batch))
+    state["done"] = True
+    saveCheckpoint(folder, checkpointName, checkpoint)
+    report(name, state["count"], os.path.getsize(path), began)
+
+
+# ordered=False lets MongoDB write the whole batch in parallel instead of one at a time
+# and keep going past a bad document. Documents that are already there (for example a
+# batch that was written just before a crash) are skipped, or replaced with --upsert.
+def writeDocuments(collection, batch, upsert):
+    from pymongo import ReplaceOne
+    from pymongo.errors import BulkWriteError
+    if upsert:
+        collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False)
+        return
+    try:
+        collection.insert_many(batch, ordered=False)
+    except BulkWriteError as error:
+        # 11000 is "duplicate key", which means the document is already imported
+        problems = [e for e in error.details["writeErrors"] if e["code"] != 11000]
+        if problems:
+            raise
+
+
+def importFiles(folder, name, db, checkpoint, checkpointName):
+    import gridfs
+    from bson import ObjectId
+    path = os.path.join(folder, f"{name}.tar")
+    if not os.path.exists(path):
+        return
+    state = checkpoint.setdefault(f"{name}.tar", {"offset": 0, "count": 0, "done": False})
+    if state["done"]:
+        click.echo(f"  {name}.tar: already imported")
+        return
+
+    fs = gridfs.GridFS(db, collection=name)
+    began = time.perf_counter()
+    with open(path, "rb") as f:
+        f.seek(state["offset"])
+        tar = tarfile.open(fileobj=f, mode="r:")
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            fileID = ObjectId(member.name)
+            if not fs.exists(fileID):
+                # GridFS reads the tar member a chunk at a time as it stores it
+                fs.put(
+                    tar.extractfile(member),
+                    _id=fileID,
+                    filename=member.pax_headers.get("filename") or None,
+                    contentType=member.pax_headers.get("contentType") or None,
+                )
+            tar.members = []
+            state.update(offset=tar.offset, count=state["count"] + 1)
+            saveCheckpoint(folder, checkpointName, checkpoint)
+    state["done"] = True
+    saveCheckpoint(folder, checkpointName, checkpoint)
+    report(f"{name}.tar", state["count"], os.path.getsize(path), began)
+
+
+@dataCli.command("import")
+@click.argument("folder", type=click.Path(exists=True, file_okay=False))
+@click.option("--collection", "-c", multiple=True, help="Only import this collection. Can be used more than once.")
+@click.option("--batch-size", default=1000, show_default=True, help="Documents written per insert_many/bulk_write.")
+@click.option("--upsert", is_flag=True, help="Replace documents that already exist instead of skipping them.")
+@click.option("--fresh", is_flag=True, help="Ignore any checkpoint and start the import over.")
+def importData(folder, collection, batch_size, upsert, fresh):
+    """Import NDJSON files and GridFS tar archives from FOLDER."""
+    checkpoint = loadCheckpoint(folder, IMPORT_CHECKPOINT, fresh)
+    click.echo(f"Importing from {folder}")
+    for name, cls in chooseCollections(collection).items():
+        importCollection(folder, name, cls, batch_size, upsert, checkpoint, IMPORT_CHECKPOINT)
+    for name, db in gridfsCollections().items():
+        if not collection or name in collection:
+            importFiles(folder, name, db, checkpoint, IMPORT_CHECKPOINT)
+    finishCheckpoint(folder, IMPORT_CHECKPOINT, checkpoint)
+    click.echo("Done.")
+
+
+########## One time fixes ##########
+
+# Replies saved before Reply.parent and Reply.ancestors existed only know their children
+# (through the replies list). This walks every thread from the top and fills in parent and
+# ancestors with one update_many per reply that has answers, so deleting a reply also
+# deletes everything under it.
+@dataCli.command("backfill-reply-ancestors")
+@click.option("--batch-size", default=1000, show_default=True, help="Top level replies read per batch.")
+def backfillReplyAncestors(batch_size):
+    """Fill in Reply.parent and Reply.ancestors for old replies."""
+    from app.classes.data import Reply
+    replies = Reply._get_collection()
+    began = time.perf_counter()
+    updated = 0
+    for root in replies.find({"outer": True}, {"replies": 1}, batch_size=batch_size):
+        # (reply _id, its ancestors, its replies list) still to visit in this thread
+        stack = [(root["_id"], [], root.get("replies") or [])]
+        while stack:
+            replyID, ancestors, children = stack.pop()
+            childIDs = [child["_ref"].id for child in children if isinstance(child, dict) and "_ref" in child]
+            if not childIDs:
+                continue
+            childAncestors = ancestors + [replyID]
+            updated += replies.update_many(
+                {"_id": {"$in": childIDs}},
+                {"$set": {"parent": replyID, "ancestors": childAncestors}},
+            ).modified_count
+            for child in replies.find({"_id": {"$in": childIDs}}, {"replies": 1}):
+                stack.append((child["_id"], childAncestors, child.get("replies") or []))
+    click.echo(f"Updated {updated:,} replies in {time.perf_counter() - began:.1f}s")
+
+
+# Compares a stored counter (like Blog.comment_count) with the real number of child
+# documents, batchSize parents at a time, and fixes the ones that are wrong. Each batch is
+# one $group over the children using the index on their parent field, so this never loads
+# the children themselves.
+def reconcileCounter(parents, children, parentField, counterField, batchSize, dryRun):
+    from pymongo import UpdateOne
+    wrong = 0
+    checked = 0
+    batch = []
+    cursor = parents.find({}, {counterField: 1}, batch_size=batchSize).sort("_id", 1)
+    while True:
+        doc = next(cursor, None)
+        if doc is not None:
+            batch.append(doc)
+        if batch and (doc is None or len(batch) == batchSize):
+            ids = [parent["_id"] for parent in batch]
+            counts = {row["_id"]: row["n"] for row in children.aggregate([
+                {"$match": {parentField: {"$in": ids}}},
+                {"$group": {"_id": "$" + parentField, "n": {"$sum": 1}}},
+            ])}
+            fixes = [
+                UpdateOne({"_id": parent["_id"]}, {"$set": {counterField: counts.get(parent["_id"], 0)}})
+                for parent in batch if parent.get(counterField) != counts.get(parent["_id"], 0)
+            ]
+            if fixes and not dryRun:
+                parents.bulk_write(fixes, ordered=False)
+            wrong += len(fixes)
+            checked += len(batch)
+            batch = []
+        if doc is None:
+            return checked, wrong
+
+
+@dataCli.command("reconcile-counters")
+@click.option("--batch-size", default=1000, show_default=True, help="Parent documents checked per batch.")
+@click.option("--dry-run", is_flag=True, help="Only report the counters that are wrong.")
+def reconcileCounters(batch_size, dry_run):
+    """Recount Blog.comment_count, Review.reply_count and Club.member_count.
+
+    The routes keep these up to date with $inc, so normally nothing changes. Run it from
+    cron (once a night is plenty) to fix counts after a crash between the two writes, a
+    manual edit in the database, or an import of old data that doesn't have them.
+    """
+    from pymongo import UpdateOne
+    from app.classes.data import Blog, Club, Comment, Reply, Review
+    began = time.perf_counter()
+    for name, parents, children, parentField, counterField in [
+        ("blog", Blog._get_collection(), Comment._get_collection(), "blog", "comment_count"),
+        ("review", Review._get_collection(), Reply._get_collection(), "review", "reply_count"),
+    ]:
+        checked, wrong = reconcileCounter(parents, children, parentField, counterField, batch_size, dry_run)
+        click.echo(f"{name}.{counterField}: {wrong:,} of {checked:,} wrong")
+
+    # Club members are a list on the club itself, so the server can compare the two and
+    # only send back the clubs that are off.
+    clubs = Club._get_collection()
+    wrong = list(clubs.aggregate([
+        {"$project": {"n": {"$size": {"$ifNull": ["$members", []]}}, "member_count": 1}},
+        {"$match": {"$expr": {"$ne": ["$n", {"$ifNull": ["$member_count", -1]}]}}},
+    ]))
+    if wrong and not dry_run:
+        for start in range(0, len(wrong), batch_size):
+            clubs.bulk_write([
+                UpdateOne({"_id": club["_id"]}, {"$set": {"member_count": club["n"]}})
+                for club in wrong[start:start + batch_size]
+            ], ordered=False)
+    click.echo(f"club.member_count: {len(wrong):,} wrong")
+    click.echo(("Checked" if dry_run else "Fixed") + f" in {time.perf_counter() - began:.1f}s")
+
+
+app.cli.add_command(dataCli)
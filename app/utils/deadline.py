@@ -0,0 +1,136 @@
+# A time budget for every request, so one slow query (like reading every reply of a
+# huge review without an index) can't hold a worker thread for many seconds while
+# other requests wait behind it.
+#
+# Each route gets DEADLINE_MS (default 5000) milliseconds unless it sets its own:
+#
+#     @app.route('/review/<reviewID>')
+#     @login_required
+#     @deadlines.budget(3000, degraded=reviewWithoutReplies)
+#     def review(reviewID):
+#
+# budget(None) turns it off for a route. While the route runs:
+#   - every MongoDB command is sent with maxTimeMS set to the time that is left, so
+#     MongoDB itself stops working on a query once nobody will wait for the answer. This
+#     is pymongo's pymongo.timeout(), which covers mongoengine and raw pymongo alike.
+#   - every call through app/utils/outbound.py gets the time that is left as its
+#     timeout, and isn't made at all if there is no time left.
+# When the budget runs out the route's degraded function is called with the same
+# arguments, with DEADLINE_DEGRADED_MS (default 1000) more to make a cut down page (for
+# example the review without its replies). Routes without one, or whose degraded page
+# is too slow as well, answer 503 with a Retry-After header straight away.
+#
+# The streamed list pages (app/utils/streaming.py) have already sent their top half when
+# they run out of time, so for them the page just stops. Give them a bigger budget.
+#
+# Every request that runs out is counted in deadline_exceeded_total on /metrics.
+#
+# mongoengine's save(), update() and delete() turn a timed out write into its own
+# OperationError, so those are handled too when the error they wrap is a timeout.
+
+import logging
+import os
+import time
+
+import pymongo
+import requests
+from flask import current_app, g, has_request_context, render_template, request, session
+from flask.globals import request_ctx
+from mongoengine.errors import OperationError
+from prometheus_client import Counter
+from pymongo.errors import PyMongoError
+
+log = logging.getLogger("app.deadline")
+
+EXCEEDED = Counter("deadline_exceeded_total", "Requests that ran out of their time budget", ["endpoint", "answer"])
+
+
+class Deadlines:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("DEADLINE_MS", int(os.environ.get("DEADLINE_MS", 5000)))
+        app.config.setdefault("DEADLINE_DEGRADED_MS", int(os.environ.get("DEADLINE_DEGRADED_MS", 1000)))
+        self.defaultMs = app.config["DEADLINE_MS"]
+        self.degradedMs = app.config["DEADLINE_DEGRADED_MS"]
+        app.before_request(self.start)
+        app.teardown_request(self.stop)
+        # requests.Timeout covers outbound.DeadlineExceeded too
+        app.register_error_handler(PyMongoError, self.exceeded)
+        app.register_error_handler(requests.Timeout, self.exceeded)
+        app.register_error_handler(OperationError, self.exceeded)
+
+    # Sets the route's budget in milliseconds. The view keeps these as attributes, which
+    # functools.wraps copies onto login_required and the other decorators around it.
+    def budget(self, ms, degraded=None):
+        def set(view):
+            view.deadlineMs = ms
+            view.degraded = degraded
+            return view
+        return set
+
+    def start(self):
+        view = current_app.view_functions.get(request.endpoint)
+        ms = getattr(view, "deadlineMs", self.defaultMs)
+        if ms:
+            self.begin(ms)
+
+    def begin(self, ms):
+        g.deadline = time.monotonic() + ms / 1000
+        g.deadlineScope = pymongo.timeout(ms / 1000)
+        g.deadlineScope.__enter__()
+
+    def stop(self, error=None):
+        scope = g.pop("deadlineScope", None)
+        g.pop("deadline", None)
+        if scope is not None:
+            scope.__exit__(None, None, None)
+
+    def exceeded(self, error):
+        # Only timeouts are handled here, any other database error is a normal 500
+        if not timedOut(error):
+            raise error
+        self.stop()
+        # A page that ran out of time while rendering has already taken the flashed
+        # messages, so they are put back for the page sent instead.
+        if request_ctx.flashes:
+            session["_flashes"] = list(request_ctx.flashes) + session.get("_flashes", [])
+        request_ctx.flashes = None
+        endpoint = request.endpoint or "none"
+        view = current_app.view_functions.get(request.endpoint)
+        degraded = getattr(view, "degraded", None)
+        if degraded is not None:
+            self.begin(self.degradedMs)
+            try:
+                response = degraded(**(request.view_args or {}))
+                EXCEEDED.labels(endpoint, "degraded").inc()
+                log.warning("%s ran out of time (%s), sent the degraded page", request.path, error)
+                return response
+            except (PyMongoError, OperationError, requests.Timeout) as degradedError:
+                if not timedOut(degradedError):
+                    raise
+            finally:
+                self.stop()
+        EXCEEDED.labels(endpoint, "503").inc()
+        log.warning("%s ran out of time (%s)", request.path, error)
+        return render_template('busy.html'), 503, {"Retry-After": "30"}
+
+
+# Whether error is the budget running out, looking inside mongoengine's OperationError
+# for the pymongo error it was raised from.
+def timedOut(error):
+    if isinstance(error, OperationError):
+        error = error.__cause__ or error.__context__
+    if isinstance(error, PyMongoError):
+        return error.timeout
+    return isinstance(error, requests.Timeout)
+
+
+# Seconds left in this request's budget, or None when there is no budget (outside a
+# request, or a route with budget(None)).
+def remaining():
+    if not has_request_context() or g.get("deadline") is None:
+        return None
+    return g.deadline - time.monotonic()
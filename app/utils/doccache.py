@@ -0,0 +1,260 @@
+# A read-through cache for the documents pages load over and over: a Club, Sport or
+# Clinic on its own page and the logged in User, which Flask-Login loads on every single
+# request. Those classes use CachedQuerySet (their meta 'queryset_class' in data.py), so
+#
+#     Club.objects.get(id=clubID)
+#
+# first looks in this worker's cache and only asks MongoDB when the club isn't there. Any
+# other query (filters, only(), lists) goes to MongoDB like before. Every call gets its
+# own Document built from the cached data, so changing one can't change the cache.
+#
+# The cache is an LRU of at most DOC_CACHE_SIZE (default 2000) documents per worker, and
+# nothing stays longer than DOC_CACHE_SECONDS (default 300). DOC_CACHE_SIZE=0 turns it off.
+#
+# Keeping it right: this is also a pymongo command listener (passed to connect() in
+# app/__init__.py), so it sees every update, delete and findAndModify the worker sends to
+# those collections, whether it came from a route, .update() on a Document or raw pymongo.
+# When one succeeds the documents it touched are dropped from this worker's cache straight
+# away and an event saying so is written to DOC_CACHE_COLLECTION (default
+# 'cache_invalidations'), a small capped collection. Every worker follows that collection
+# with a tailable cursor in a background thread, which MongoDB answers as soon as an event
+# is written, and drops the same documents from its own cache. A write that only names
+# documents by something other than _id drops the whole collection. Writes made from
+# somewhere that isn't running this code (the mongo shell, Compass) are not seen, which
+# is what DOC_CACHE_SECONDS is for.
+
+import atexit
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from cachetools import TTLCache
+from pymongo import CursorType, ReadPreference, monitoring
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+from app.utils.readrouting import RoutedQuerySet
+
+log = logging.getLogger("app.doccache")
+
+# The Document classes that use CachedQuerySet
+CACHED_CLASSES = ("User", "Club", "Sport", "Clinic")
+WRITE_COMMANDS = {"update": ("updates", "q"), "delete": ("deletes", "q"), "findAndModify": (None, "query")}
+
+
+class CachedQuerySet(RoutedQuerySet):
+    def get(self, *q_objs, **query):
+        from app import documentCache
+        id = self.cachedId(q_objs, query)
+        if id is None or not documentCache.enabled:
+            return super().get(*q_objs, **query)
+        # Fill the cache from the primary, a secondary could still have the old version
+        load = lambda: RoutedQuerySet.get(self.read_preference(ReadPreference.PRIMARY), *q_objs, **query)
+        return documentCache.get(self._document, id, load)
+
+    # The _id for a plain objects.get(id=...) or objects.get(pk=...), otherwise None.
+    def cachedId(self, q_objs, query):
+        if q_objs or len(query) != 1 or self._query_obj or self._mongo_query or self._loaded_fields:
+            return None
+        value = query.get("id", query.get("pk"))
+        if value is None:
+            return None
+        try:
+            return ObjectId(value)
+        except (InvalidId, TypeError):
+            return None
+
+
+class DocumentCache(monitoring.CommandListener):
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.cache = {}
+        # collection name -> how many times it has had something dropped. A document that
+        # was being loaded while it changed isn't put in the cache.
+        self.generations = {}
+        self.pending = {}
+        self.events = queue.Queue()
+        self.handle = None
+        self.enabled = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("DOC_CACHE_SIZE", int(os.environ.get("DOC_CACHE_SIZE", 2000)))
+        app.config.setdefault("DOC_CACHE_SECONDS", int(os.environ.get("DOC_CACHE_SECONDS", 300)))
+        app.config.setdefault("DOC_CACHE_COLLECTION", os.environ.get("DOC_CACHE_COLLECTION", "cache_invalidations"))
+        self.size = app.config["DOC_CACHE_SIZE"]
+        self.seconds = app.config["DOC_CACHE_SECONDS"]
+        self.collectionName = app.config["DOC_CACHE_COLLECTION"]
+        self.enabled = self.size > 0
+        self.cache = TTLCache(maxsize=max(self.size, 1), ttl=self.seconds)
+        # The lowercase names mongoengine gives the CACHED_CLASSES collections
+        self.collections = {name.lower() for name in CACHED_CLASSES}
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    # The document with this _id, from the cache or from load() (which raises DoesNotExist
+    # like objects.get does if there isn't one).
+    def get(self, cls, id, load):
+        self.ensureStarted()
+        collection = cls._get_collection_name()
+        key = (collection, id)
+        with self.lock:
+            son = self.cache.get(key)
+            generation = self.generations.get(collection, 0)
+        if son is not None:
+            return cls._from_son(son)
+        doc = load()
+        with self.lock:
+            if self.generations.get(collection, 0) == generation:
+                self.cache[key] = doc.to_mongo()
+        return doc
+
+    # Drops documents (or with ids None, every document of the collection) from this
+    # worker's cache.
+    def evict(self, collection, ids):
+        with self.lock:
+            self.generations[collection] = self.generations.get(collection, 0) + 1
+            if ids is None:
+                for key in [key for key in self.cache if key[0] == collection]:
+                    self.cache.pop(key, None)
+            else:
+                for id in ids:
+                    self.cache.pop((collection, id), None)
+
+    def clear(self):
+        with self.lock:
+            for collection in self.collections:
+                self.generations[collection] = self.generations.get(collection, 0) + 1
+            self.cache.clear()
+
+    # pymongo calls these for every command. The ids a write touches are worked out when
+    # it starts and dropped once it has happened.
+    def started(self, event):
+        if not self.enabled or event.command_name not in WRITE_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        if collection not in self.collections:
+            return
+        listName, filterName = WRITE_COMMANDS[event.command_name]
+        statements = (event.command.get(listName) or []) if listName else [event.command]
+        self.pending[event.request_id] = (collection, writtenIds(statement.get(filterName) or {} for statement in statements))
+
+    def succeeded(self, event):
+        self.written(event)
+
+    def failed(self, event):
+        # a failed write might still have changed some documents
+        self.written(event)
+
+    def written(self, event):
+        touched = self.pending.pop(event.request_id, None)
+        if touched is None:
+            return
+        collection, ids = touched
+        self.evict(collection, ids)
+        # The event is written by the background thread, a command listener mustn't wait on
+        # the database.
+        self.ensureStarted()
+        self.events.put({"coll": collection, "ids": ids, "worker": self.worker})
+
+    # The two background threads are started the first time each worker process uses the
+    # cache, like the live feed thread in app/utils/livefeed.py.
+    def ensureStarted(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.worker = f"{socket.gethostname()}:{os.getpid()}"
+                self.events = queue.Queue()
+                self.handle = None
+                self.cache.clear()
+                threading.Thread(target=self.publish, name="doc-cache-publish", daemon=True).start()
+                threading.Thread(target=self.follow, name="doc-cache-follow", daemon=True).start()
+                atexit.register(self.flush)
+                self.pid = os.getpid()
+
+    # The capped collection, made the first time any worker needs it.
+    def eventCollection(self):
+        if self.handle is None:
+            from mongoengine.connection import get_db
+            db = get_db()
+            try:
+                # A tailable cursor on an empty capped collection stops straight away, so
+                # it starts with one event that doesn't drop anything.
+                db.create_collection(self.collectionName, capped=True, size=1024 * 1024, max=10000)
+                db[self.collectionName].insert_one({"coll": None, "ids": [], "worker": self.worker})
+            except CollectionInvalid:
+                pass
+            self.handle = db[self.collectionName]
+        return self.handle
+
+    def publish(self):
+        while True:
+            batch = [self.events.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.eventCollection().insert_many(batch, ordered=False)
+            except PyMongoError:
+                log.exception("couldn't publish %s cache invalidations", len(batch))
+                time.sleep(1)
+
+    # Writes any events still waiting, for a process that is about to exit.
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                self.eventCollection().insert_many(batch, ordered=False)
+            except PyMongoError:
+                log.exception("couldn't publish %s cache invalidations", len(batch))
+
+    def follow(self):
+        while True:
+            try:
+                cursor = self.eventCollection().find(cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        self.dispatch(event)
+            except PyMongoError:
+                log.exception("cache invalidation cursor stopped, restarting in 1s")
+            except Exception:
+                log.exception("cache invalidation event failed")
+            # Events could have been missed while there was no cursor, so start again with
+            # an empty cache. The new cursor reads the whole collection from the start.
+            self.clear()
+            time.sleep(1)
+
+    def dispatch(self, event):
+        # This worker dropped its own writes when it made them
+        if event.get("coll") is None or event.get("worker") == self.worker:
+            return
+        self.evict(event["coll"], event.get("ids"))
+
+
+# The _ids a write's filters can touch, or None if any of them could touch any document.
+def writtenIds(filters):
+    ids = []
+    for filter in filters:
+        value = filter.get("_id")
+        if isinstance(value, dict) and list(value) == ["$in"]:
+            value = value["$in"]
+        if isinstance(value, ObjectId):
+            ids.append(value)
+        elif isinstance(value, list) and all(isinstance(id, ObjectId) for id in value):
+            ids.extend(value)
+        else:
+            return None
+    return ids
@@ -0,0 +1,190 @@
+# Live updates for the review and blog pages. Instead of people reloading a busy review
+# over and over (which reads the whole reply tree every time), the page opens a
+# Server-Sent Events connection to /review/<id>/events or /blog/<id>/events and new
+# replies and comments are added to the page as they are posted (app/static/live.js).
+#
+# Each worker runs one MongoDB change stream on the reply and comment collections in a
+# background thread, no matter how many pages are open. When a reply is inserted the
+# thread looks up the author's name once and hands the event to every open page for that
+# review, through an in-memory queue per page.
+#
+# Change streams only work on a replica set (a single member one is fine, see
+# bench/replset.py), so this is off unless LIVE_UPDATES=1.
+#
+# Under gunicorn's gthread workers every open page holds one of the worker's threads
+# while it waits. LIVE_MAX_SUBSCRIBERS (default half of GUNICORN_THREADS) caps that so
+# normal pages always have threads left; pages over the cap just don't get live
+# updates. A connection is closed after LIVE_STREAM_SECONDS and the browser reconnects
+# by itself, sending the id of the last thing it got so anything posted in between is
+# sent first.
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import Response, request
+from pymongo.errors import PyMongoError
+
+log = logging.getLogger("app.livefeed")
+
+
+class LiveFeed:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("LIVE_UPDATES", os.environ.get("LIVE_UPDATES") == "1")
+        app.config.setdefault("LIVE_MAX_SUBSCRIBERS", int(os.environ.get(
+            "LIVE_MAX_SUBSCRIBERS", max(1, int(os.environ.get("GUNICORN_THREADS", 4)) // 2))))
+        app.config.setdefault("LIVE_STREAM_SECONDS", int(os.environ.get("LIVE_STREAM_SECONDS", 300)))
+        app.config.setdefault("LIVE_KEEPALIVE_SECONDS", 15)
+        self.enabled = app.config["LIVE_UPDATES"]
+        self.maxSubscribers = app.config["LIVE_MAX_SUBSCRIBERS"]
+        self.streamSeconds = app.config["LIVE_STREAM_SECONDS"]
+        self.keepalive = app.config["LIVE_KEEPALIVE_SECONDS"]
+        app.jinja_env.globals.update(live_updates=self.enabled)
+
+    def subscriberCount(self):
+        return sum(len(pages) for pages in self.subscribers.values())
+
+    def subscribe(self, key):
+        with self.lock:
+            if self.subscriberCount() >= self.maxSubscribers:
+                return None
+            page = queue.Queue(maxsize=100)
+            self.subscribers.setdefault(key, set()).add(page)
+        self.startWatcher()
+        return page
+
+    def unsubscribe(self, key, page):
+        with self.lock:
+            pages = self.subscribers.get(key)
+            if pages is not None:
+                pages.discard(page)
+                if not pages:
+                    del self.subscribers[key]
+
+    def publish(self, key, event):
+        with self.lock:
+            pages = list(self.subscribers.get(key, ()))
+        for page in pages:
+            try:
+                page.put_nowait(event)
+            except queue.Full:
+                # That page stopped reading. It will catch up from its last event id
+                # when it reconnects.
+                pass
+
+    # The change stream thread is started by the first subscriber in each worker
+    # process, like the write-behind thread in app/utils/writebehind.py.
+    def startWatcher(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                threading.Thread(target=self.watch, name="live-feed", daemon=True).start()
+                self.pid = os.getpid()
+
+    def watch(self):
+        from mongoengine.connection import get_db
+        from app.classes.data import Comment, Reply
+        names = {Reply._get_collection_name(): "reply", Comment._get_collection_name(): "comment"}
+        pipeline = [{"$match": {"operationType": "insert", "ns.coll": {"$in": list(names)}}}]
+        resumeToken = None
+        while True:
+            try:
+                with get_db().watch(pipeline, resume_after=resumeToken) as stream:
+                    for change in stream:
+                        resumeToken = stream.resume_token
+                        kind = names[change["ns"]["coll"]]
+                        self.dispatch(kind, change["fullDocument"])
+            except PyMongoError:
+                log.exception("live feed change stream stopped, restarting in 5s")
+                time.sleep(5)
+            except Exception:
+                log.exception("live feed event failed")
+
+    def dispatch(self, kind, doc):
+        if kind == "reply":
+            key = ("review", str(doc.get("review")))
+        else:
+            key = ("blog", str(doc.get("blog")))
+        # Nobody is watching, so don't bother looking up the author.
+        if key not in self.subscribers:
+            return
+        self.publish(key, makeEvents(kind, [doc])[0])
+
+    # The text/event-stream response for one open page. backlog(lastId) gives the events
+    # posted after lastId, for a browser that is reconnecting.
+    def stream(self, key, backlog):
+        if not self.enabled:
+            return Response("Live updates are off.\n", status=404, mimetype="text/plain")
+        page = self.subscribe(key)
+        if page is None:
+            return Response("Too many live pages open.\n", status=503, mimetype="text/plain",
+                            headers={"Retry-After": "60"})
+        lastId = request.headers.get("Last-Event-ID")
+        missed = backlog(lastId) if lastId else []
+
+        def events():
+            try:
+                # How long the browser waits before reconnecting
+                yield "retry: 3000\n\n"
+                for event in missed:
+                    yield formatEvent(event)
+                closeAt = time.monotonic() + self.streamSeconds
+                while time.monotonic() < closeAt:
+                    try:
+                        yield formatEvent(page.get(timeout=self.keepalive))
+                    except queue.Empty:
+                        # A comment line keeps proxies from closing an idle connection
+                        yield ": keepalive\n\n"
+            finally:
+                self.unsubscribe(key, page)
+
+        return Response(events(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def formatEvent(event):
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event)}\n\n"
+
+
+# Turns raw reply or comment documents into the JSON the page needs, looking up all of
+# their authors with one query.
+def makeEvents(kind, docs):
+    from app.classes.data import User
+    authorIds = list({doc.get("author") for doc in docs if doc.get("author")})
+    authors = {user["_id"]: user for user in User._get_collection().find(
+        {"_id": {"$in": authorIds}}, {"fname": 1, "lname": 1, "username": 1})}
+    events = []
+    for doc in docs:
+        author = authors.get(doc.get("author"), {})
+        event = {
+            "kind": kind,
+            "id": str(doc["_id"]),
+            "author": {
+                "id": str(doc.get("author")),
+                "name": f"{author.get('fname') or ''} {author.get('lname') or ''}".strip(),
+                "username": author.get("username") or "",
+            },
+            "created": doc["create_date"].isoformat() + "Z" if doc.get("create_date") else None,
+        }
+        if kind == "reply":
+            event.update(
+                review=str(doc.get("review")),
+                parent=str(doc["parent"]) if doc.get("parent") else None,
+                depth=doc.get("dFromOuter") or 0,
+                text=doc.get("text") or "",
+            )
+        else:
+            event.update(blog=str(doc.get("blog")), content=doc.get("content") or "")
+        events.append(event)
+    return events
@@ -0,0 +1,132 @@
+# Numbers about the running site in the Prometheus format, served at /metrics so a
+# Prometheus server can collect ("scrape") them every few seconds:
+#
+#   http_requests_total                  requests by route (Flask endpoint name like
+#                                        blogList or clinicMap), method and status code
+#   http_request_duration_seconds        a histogram of how long each route takes
+#   http_requests_in_progress            requests being worked on right now
+#   mongo_pool_connections               open MongoDB connections
+#   mongo_pool_connections_in_use        connections busy with a query right now
+#   mongo_pool_checkout_seconds          how long a request waited for a free connection
+#   outbound_http_duration_seconds       calls to other websites (Google, OpenStreetMap)
+#   deadline_exceeded_total              requests that ran out of time (app/utils/deadline.py)
+#
+# Under gunicorn there are several worker processes and each only knows its own numbers.
+# When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py does this) every worker writes its
+# numbers to small memory-mapped files in that folder and /metrics adds them all up, so it
+# doesn't matter which worker answers the scrape. Recording a request costs a few
+# microseconds.
+#
+# If METRICS_TOKEN is set, /metrics needs the header  Authorization: Bearer <token>
+
+import os
+import threading
+import time
+
+from flask import Response, abort, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+from pymongo import monitoring
+
+# Buckets in seconds, from 5ms up to 10s, which covers everything from a cached page to
+# a list page that loads every document.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["endpoint", "method", "status"])
+LATENCY = Histogram("http_request_duration_seconds", "Time to answer a request", ["endpoint"], buckets=BUCKETS)
+IN_PROGRESS = Gauge("http_requests_in_progress", "Requests being answered right now", multiprocess_mode="livesum")
+
+POOL_OPEN = Gauge("mongo_pool_connections", "Open MongoDB connections", multiprocess_mode="livesum")
+POOL_IN_USE = Gauge("mongo_pool_connections_in_use", "MongoDB connections checked out", multiprocess_mode="livesum")
+POOL_WAIT = Histogram("mongo_pool_checkout_seconds", "Time spent waiting for a MongoDB connection", buckets=BUCKETS)
+POOL_FAILED = Counter("mongo_pool_checkout_failed_total", "Times no MongoDB connection could be had", ["reason"])
+
+OUTBOUND = Histogram("outbound_http_duration_seconds", "Calls to other websites", ["host", "status"], buckets=BUCKETS)
+
+
+# Keeps the MongoDB connection pool numbers up to date. Passed to connect() in
+# app/__init__.py like QueryStats.
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.waiting = threading.local()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        POOL_OPEN.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        POOL_OPEN.dec()
+
+    def connection_check_out_started(self, event):
+        self.waiting.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        POOL_FAILED.labels(str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        started = getattr(self.waiting, "started", None)
+        if started is not None:
+            POOL_WAIT.observe(time.perf_counter() - started)
+            self.waiting.started = None
+        POOL_IN_USE.inc()
+
+    def connection_checked_in(self, event):
+        POOL_IN_USE.dec()
+
+
+def observeOutbound(host, status, seconds):
+    OUTBOUND.labels(host, str(status)).observe(seconds)
+
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_TOKEN", os.environ.get("METRICS_TOKEN"))
+        self.token = app.config["METRICS_TOKEN"]
+        app.before_request(self.beforeRequest)
+        app.after_request(self.afterRequest)
+        app.teardown_request(self.teardownRequest)
+        app.add_url_rule("/metrics", "metrics", self.metrics)
+
+    def beforeRequest(self):
+        g.metricsStarted = time.perf_counter()
+        IN_PROGRESS.inc()
+
+    def afterRequest(self, response):
+        started = g.get("metricsStarted")
+        if started is not None:
+            endpoint = request.endpoint or "none"
+            LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+            REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+        return response
+
+    def teardownRequest(self, error=None):
+        if g.pop("metricsStarted", None) is not None:
+            IN_PROGRESS.dec()
+
+    def metrics(self):
+        if self.token and request.headers.get("Authorization") != f"Bearer {self.token}":
+            abort(403)
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,182 @@
+# Numbered changes to the data already in the database, for when the models in
+# app/classes/data.py change shape (a field is renamed, a new field needs filling in, bad
+# values need cleaning up). Run them from the main project folder while the site is up:
+#
+#     flask --app main migrate status
+#     flask --app main migrate run --dry-run      (how many documents each step would change)
+#     flask --app main migrate run
+#     flask --app main migrate run --to 2 --batch-size 200 --load 0.25
+#
+# Each migration is a list of steps, and each step is a query for the documents that still
+# need changing plus the update that changes them. A step works through the matching
+# documents --batch-size at a time in _id order. After every batch the last _id is saved in
+# the 'migrations' collection, so if the command stops (crash, ctrl-c, deploy) running it
+# again carries on from there. Finished migrations are never run again.
+#
+# To keep the site fast while it runs, every batch is written with a "majority" write
+# concern, so on a replica set it waits for the secondaries to catch up before the next
+# batch, and --load (default 0.5) is the share of the time spent working: at 0.5 it rests
+# as long as each batch took. Only run one 'migrate run' at a time.
+#
+# The site has to work with documents from before and after a migration while it runs,
+# so a renamed field keeps its old name declared in data.py until every database has been
+# migrated. To add a migration append it to MIGRATIONS with the next number. Never change
+# one that has already been run somewhere.
+
+import datetime as dt
+import time
+
+import click
+from flask.cli import AppGroup
+from pymongo import WriteConcern
+
+from app import app
+
+migrateCli = AppGroup("migrate", help="Versioned, resumable data migrations.")
+
+STATE_COLLECTION = "migrations"
+
+
+class Migration:
+    def __init__(self, version, name, steps):
+        self.version = version
+        self.name = name
+        # (document class name, query, update) for each step
+        self.steps = steps
+
+
+# A DateTimeField that is there but not a date (for example a null left behind by an
+# old route) or, for modify_date, that was set when the document was created instead of
+# when it was edited.
+def setAtCreate(field):
+    return {"$or": [
+        {field: {"$exists": True, "$not": {"$type": "date"}}},
+        {
+            field: {"$type": "date"},
+            "create_date": {"$type": "date"},
+            "$expr": {"$lt": [{"$abs": {"$subtract": [f"${field}", "$create_date"]}}, 1000]},
+        },
+    ]}
+
+
+MIGRATIONS = [
+    # Clinic was the only model with createdate/modifydate instead of create_date and
+    # modify_date. A date already under the new name (from an edit made since the new
+    # code was deployed) is newer, so it is kept.
+    Migration(1, "clinic-date-field-names", [
+        ("Clinic", {"$or": [{"createdate": {"$exists": True}}, {"modifydate": {"$exists": True}}]}, [
+            {"$set": {
+                "create_date": {"$ifNull": ["$createdate", {"$ifNull": ["$create_date", "$$REMOVE"]}]},
+                "modify_date": {"$ifNull": ["$modify_date", {"$ifNull": ["$modifydate", "$$REMOVE"]}]},
+            }},
+            {"$unset": ["createdate", "modifydate"]},
+        ]),
+    ]),
+    # User.createdate had a typo (defaultdefault) so it was never filled in. Users get a
+    # create_date from createdate if they have one, otherwise from the time in their _id.
+    Migration(2, "user-create-date", [
+        ("User", {"$or": [{"create_date": {"$exists": False}}, {"createdate": {"$exists": True}}]}, [
+            {"$set": {"create_date": {"$ifNull": ["$createdate", {"$ifNull": ["$create_date", {"$toDate": "$_id"}]}]}}},
+            {"$unset": "createdate"},
+        ]),
+    ]),
+    # The create routes used to set modify_date (to the function dt.datetime.utcnow, which
+    # mongoengine turned into the time it saved), so every post looked edited. Take it off
+    # anything whose modify_date isn't a real later edit.
+    Migration(3, "unset-modify-date-from-create", [
+        (name, setAtCreate("modify_date"), {"$unset": {"modify_date": ""}})
+        for name in ("Blog", "Review", "Reply", "Club", "Sport", "Slime", "Clinic", "Comment")
+    ]),
+]
+
+
+def documentClass(name):
+    from app.classes import data
+    return getattr(data, name)
+
+
+def stateCollection():
+    from mongoengine.connection import get_db
+    return get_db()[STATE_COLLECTION]
+
+
+def pageQuery(query, lastId):
+    return query if lastId is None else {"$and": [query, {"_id": {"$gt": lastId}}]}
+
+
+# Runs one migration from wherever it got to last time. With dryRun nothing is written
+# and it only reports how many documents each remaining step would change.
+def runMigration(migration, batchSize, load, dryRun):
+    states = stateCollection()
+    state = states.find_one({"_id": migration.version}) or {}
+    if state.get("done"):
+        click.echo("  already done")
+        return
+    if not dryRun and not state:
+        states.insert_one({"_id": migration.version, "name": migration.name, "step": 0,
+                           "lastId": None, "changed": 0, "started": dt.datetime.utcnow()})
+    for stepNumber, (className, query, update) in enumerate(migration.steps):
+        if stepNumber < state.get("step", 0):
+            continue
+        lastId = state.get("lastId") if stepNumber == state.get("step", 0) else None
+        collection = documentClass(className)._get_collection().with_options(
+            write_concern=WriteConcern("majority"))
+        label = f"{migration.version} {migration.name} [{className}]"
+        if dryRun:
+            click.echo(f"  {label}: {collection.count_documents(pageQuery(query, lastId)):,} to change")
+            continue
+        changed = 0
+        while True:
+            began = time.perf_counter()
+            ids = [doc["_id"] for doc in collection.find(pageQuery(query, lastId), {"_id": 1}).sort("_id", 1).limit(batchSize)]
+            if not ids:
+                break
+            result = collection.update_many({"$and": [query, {"_id": {"$in": ids}}]}, update)
+            lastId = ids[-1]
+            changed += result.modified_count
+            states.update_one({"_id": migration.version}, {
+                "$set": {"step": stepNumber, "lastId": lastId},
+                "$inc": {"changed": result.modified_count},
+            })
+            took = time.perf_counter() - began
+            if load < 1:
+                time.sleep(took * (1 - load) / load)
+        states.update_one({"_id": migration.version}, {"$set": {"step": stepNumber + 1, "lastId": None}})
+        click.echo(f"  {label}: changed {changed:,}")
+    if not dryRun:
+        states.update_one({"_id": migration.version}, {"$set": {"done": True, "finished": dt.datetime.utcnow()}})
+
+
+@migrateCli.command("status")
+def migrateStatus():
+    """List the migrations and how far each has got."""
+    states = {state["_id"]: state for state in stateCollection().find()}
+    for migration in MIGRATIONS:
+        state = states.get(migration.version)
+        if state is None:
+            status = "not started"
+        elif state.get("done"):
+            status = f"done {state['finished']:%Y-%m-%d %H:%M}, changed {state.get('changed', 0):,}"
+        else:
+            status = f"stopped in step {state['step'] + 1} of {len(migration.steps)}, changed {state.get('changed', 0):,} so far"
+        click.echo(f"{migration.version:>3} {migration.name}: {status}")
+
+
+@migrateCli.command("run")
+@click.option("--to", "upTo", type=int, help="Only run migrations up to this number.")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--load", default=0.5, show_default=True, type=click.FloatRange(0.01, 1),
+              help="Share of the time spent writing, the rest is spent resting between batches.")
+@click.option("--dry-run", is_flag=True, help="Count what each step would change without writing.")
+def migrateRun(upTo, batch_size, load, dry_run):
+    """Run every migration that hasn't finished, in order."""
+    began = time.perf_counter()
+    for migration in MIGRATIONS:
+        if upTo is not None and migration.version > upTo:
+            break
+        click.echo(f"{migration.version} {migration.name}")
+        runMigration(migration, batch_size, load, dry_run)
+    click.echo(("Counted" if dry_run else "Finished") + f" in {time.perf_counter() - began:.1f}s")
+
+
+app.cli.add_command(migrateCli)
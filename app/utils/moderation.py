@@ -0,0 +1,289 @@
+# Bulk moderation for staff: find posts by who wrote them, when, a blog tag, the hospital
+# a review is about or some text they contain, see how many match (and how many comments
+# and replies go with them), then delete or edit all of them at once. Used by /moderate
+# and the /moderate/api/... JSON routes in app/routes/moderate.py.
+#
+# Matching documents are worked through MODERATION_BATCH_SIZE (default 500) at a time in
+# _id order. For each batch the documents and everything under them are removed with one
+# bulk_write per collection, and the counters on the parents (Blog.comment_count,
+# Review.reply_count) and the parent replies' 'replies' lists are fixed in the same pass.
+# A preview runs exactly the same code without writing anything, so its numbers are what
+# a delete would do.
+#
+# Only users with User.staff set can use any of it. Give someone access with
+#
+#     flask --app main moderate staff someone@school.org
+#     flask --app main moderate staff someone@school.org --remove
+
+import datetime as dt
+import logging
+import os
+import re
+from functools import wraps
+
+import click
+from bson import DBRef, ObjectId
+from bson.errors import InvalidId
+from flask import abort
+from flask.cli import AppGroup
+from flask_login import current_user
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+
+log = logging.getLogger("app.moderation")
+
+# What can be moderated. 'text' fields are searched by 'contains', 'edit' fields can be
+# changed in bulk, and 'filters' are the filters that make sense for that kind.
+KINDS = {
+    "blog": {"text": ["subject", "content"], "edit": ["subject", "content", "tag"], "filters": {"tag"}},
+    "comment": {"text": ["content"], "edit": ["content"], "filters": set()},
+    "review": {"text": ["subject", "text"], "edit": ["text"], "filters": {"hospital"}},
+    "reply": {"text": ["text"], "edit": ["text"], "filters": {"hospital"}},
+}
+FILTERS = ("author", "since", "until", "tag", "hospital", "contains")
+
+
+class ModerationError(ValueError):
+    pass
+
+
+class Moderation:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MODERATION_BATCH_SIZE", int(os.environ.get("MODERATION_BATCH_SIZE", 500)))
+        self.batchSize = app.config["MODERATION_BATCH_SIZE"]
+        app.cli.add_command(moderateCli)
+
+    def staffOnly(self, view):
+        @wraps(view)
+        def checked(*args, **kwargs):
+            if not current_user.is_authenticated or not getattr(current_user, "staff", False):
+                abort(403)
+            return view(*args, **kwargs)
+        return checked
+
+    # Every matching _id, batchSize at a time. The next batch starts after the last _id
+    # of this one, so a batch that was just deleted doesn't shift what comes next.
+    def batches(self, kind, query):
+        collection = documentClass(kind)._get_collection()
+        last = None
+        while True:
+            page = query if last is None else {"$and": [query, {"_id": {"$gt": last}}]}
+            ids = [doc["_id"] for doc in collection.find(page, {"_id": 1}).sort("_id", 1).limit(self.batchSize)]
+            if not ids:
+                return
+            yield ids
+            last = ids[-1]
+
+    # How many documents a delete would remove, by collection, without removing them.
+    def preview(self, kind, filters):
+        query = buildQuery(kind, filters)
+        counts = {}
+        seen = set()
+        for ids in self.batches(kind, query):
+            addCounts(counts, deleteBatch(kind, ids, dryRun=True, seen=seen))
+        counts.setdefault(kind, 0)
+        return counts
+
+    # Just the number of matching documents, to check nothing changed since a preview.
+    def count(self, kind, filters):
+        query = buildQuery(kind, filters)
+        return documentClass(kind)._get_collection().count_documents(query)
+
+    # The newest few matching documents, shortened for showing in a list.
+    def sample(self, kind, filters, limit=20):
+        query = buildQuery(kind, filters)
+        fields = {name: 1 for name in KINDS[kind]["text"] + ["author", "create_date"]}
+        docs = documentClass(kind)._get_collection().find(query, fields).sort("_id", -1).limit(limit)
+        return [{
+            "id": str(doc["_id"]),
+            "author": str(doc.get("author")),
+            "created": doc["create_date"].isoformat() + "Z" if doc.get("create_date") else None,
+            "text": " / ".join(doc.get(field) or "" for field in KINDS[kind]["text"])[:200],
+        } for doc in docs]
+
+    def delete(self, kind, filters, by=None):
+        query = buildQuery(kind, filters)
+        counts = {}
+        for ids in self.batches(kind, query):
+            addCounts(counts, deleteBatch(kind, ids))
+        counts.setdefault(kind, 0)
+        log.info("%s deleted %s matching %s %s", by, counts, kind, filters)
+        return counts
+
+    def edit(self, kind, filters, changes, by=None):
+        query = buildQuery(kind, filters)
+        bad = set(changes) - set(KINDS[kind]["edit"])
+        if bad or not changes:
+            raise ModerationError(f"{kind} edits can only change {', '.join(KINDS[kind]['edit'])}")
+        for name, value in changes.items():
+            if not isinstance(value, str):
+                raise ModerationError(f"{name} must be a string")
+        collection = documentClass(kind)._get_collection()
+        update = {"$set": dict(changes, modify_date=dt.datetime.utcnow())}
+        edited = 0
+        for ids in self.batches(kind, query):
+            edited += collection.bulk_write([UpdateMany({"_id": {"$in": ids}}, update)], ordered=False).modified_count
+        log.info("%s edited %s %s matching %s: %s", by, edited, kind, filters, changes)
+        return {kind: edited}
+
+
+def documentClass(kind):
+    from app.classes.data import Blog, Comment, Reply, Review
+    return {"blog": Blog, "comment": Comment, "review": Review, "reply": Reply}[kind]
+
+
+def addCounts(total, counts):
+    for name, count in counts.items():
+        total[name] = total.get(name, 0) + count
+
+
+def parseDate(value, name):
+    if isinstance(value, dt.date):
+        return dt.datetime.combine(value, dt.time())
+    try:
+        return dt.datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ModerationError(f"{name} must be a date like 2024-01-31")
+
+
+# Users an author filter means: an ObjectId, an email or a username.
+def authorIds(author):
+    from app.classes.data import User
+    try:
+        return [ObjectId(author)]
+    except (InvalidId, TypeError):
+        pass
+    return [user["_id"] for user in User._get_collection().find(
+        {"$or": [{"email": author}, {"username": author}]}, {"_id": 1})]
+
+
+# The MongoDB query for the filters. Empty filters are left out, and at least one is
+# needed so a mistake can't select every post on the site. Every value has to be a
+# string (since and until are checked by parseDate): anything else from the JSON API, like
+# {"$exists": true}, would be a MongoDB operator that matches everything.
+def buildQuery(kind, filters):
+    if not isinstance(kind, str) or kind not in KINDS:
+        raise ModerationError(f"kind must be one of {', '.join(KINDS)}")
+    filters = {name: value for name, value in filters.items() if value is not None and value != ""}
+    unknown = set(filters) - set(FILTERS)
+    if unknown:
+        raise ModerationError(f"unknown filter {', '.join(sorted(unknown))}")
+    for name, value in filters.items():
+        if name not in ("since", "until") and not isinstance(value, str):
+            raise ModerationError(f"{name} must be a string")
+    if not filters:
+        raise ModerationError("give at least one filter")
+    for name in ("tag", "hospital"):
+        if name in filters and name not in KINDS[kind]["filters"]:
+            raise ModerationError(f"{kind} can't be filtered by {name}")
+
+    query = {}
+    if "author" in filters:
+        query["author"] = {"$in": authorIds(filters["author"])}
+    if "since" in filters or "until" in filters:
+        query["create_date"] = {}
+        if "since" in filters:
+            query["create_date"]["$gte"] = parseDate(filters["since"], "since")
+        if "until" in filters:
+            # until is the last day to include
+            query["create_date"]["$lt"] = parseDate(filters["until"], "until") + dt.timedelta(days=1)
+    if "tag" in filters:
+        query["tag"] = filters["tag"]
+    if "hospital" in filters:
+        # replies keep a copy of their review's hospital in 'name'
+        query["name"] = filters["hospital"]
+    if "contains" in filters:
+        pattern = {"$regex": re.escape(filters["contains"]), "$options": "i"}
+        query["$or"] = [{field: pattern} for field in KINDS[kind]["text"]]
+    return query
+
+
+# Deletes one batch of documents of one kind and whatever hangs off them, returning how
+# many of each were (or with dryRun, would be) deleted. seen is for dry runs, where
+# nothing is deleted, so replies under two matching replies aren't counted twice.
+def deleteBatch(kind, ids, dryRun=False, seen=None):
+    from app.classes.data import Blog, Comment, Reply, Review
+    comments, replies = Comment._get_collection(), Reply._get_collection()
+    counts = {}
+    if kind == "blog":
+        counts["comment"] = write(comments, [DeleteMany({"blog": {"$in": ids}})], dryRun)
+        counts["blog"] = write(Blog._get_collection(), [DeleteMany({"_id": {"$in": ids}})], dryRun)
+    elif kind == "review":
+        counts["reply"] = write(replies, [DeleteMany({"review": {"$in": ids}})], dryRun)
+        counts["review"] = write(Review._get_collection(), [DeleteMany({"_id": {"$in": ids}})], dryRun)
+    elif kind == "comment":
+        # The comments plus any comments made on them
+        found = comments.find({"$or": [{"_id": {"$in": ids}}, {"comment": {"$in": ids}}]}, {"blog": 1})
+        found = unseen(found, seen)
+        perBlog = tally(doc.get("blog") for doc in found)
+        write(Blog._get_collection(), [
+            UpdateOne({"_id": blog}, {"$inc": {"comment_count": -n}}) for blog, n in perBlog.items() if blog
+        ], dryRun)
+        counts["comment"] = write(comments, [DeleteMany({"_id": {"$in": [doc["_id"] for doc in found]}})], dryRun)
+    elif kind == "reply":
+        # The replies plus every reply under them (see Reply.ancestors)
+        found = replies.find({"$or": [{"_id": {"$in": ids}}, {"ancestors": {"$in": ids}}]},
+                             {"review": 1, "parent": 1, "outer": 1, "dFromOuter": 1})
+        found = unseen(found, seen)
+        deleted = {doc["_id"] for doc in found}
+        perReview = tally(doc.get("review") for doc in found)
+        updates = [UpdateOne({"_id": review}, {"$inc": {"reply_count": -n}}) for review, n in perReview.items() if review]
+        write(Review._get_collection(), updates, dryRun)
+        # Take the top replies of each deleted thread out of their parents' lists. Old
+        # replies without 'parent' are looked for one level up, like replyDelete does.
+        pulls = []
+        for doc in found:
+            if doc.get("parent") in deleted:
+                continue
+            pull = {"$pull": {"replies": {"_ref": DBRef(replies.name, doc["_id"])}}}
+            if doc.get("parent"):
+                pulls.append(UpdateOne({"_id": doc["parent"]}, pull))
+            elif not doc.get("outer") and doc.get("dFromOuter"):
+                pulls.append(UpdateMany({"review": doc.get("review"), "dFromOuter": doc["dFromOuter"] - 1}, pull))
+        write(replies, pulls, dryRun)
+        counts["reply"] = write(replies, [DeleteMany({"_id": {"$in": list(deleted)}})], dryRun)
+    return counts
+
+
+def unseen(found, seen):
+    found = list(found)
+    if seen is None:
+        return found
+    found = [doc for doc in found if doc["_id"] not in seen]
+    seen.update(doc["_id"] for doc in found)
+    return found
+
+
+def tally(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+# Runs the operations as one bulk_write and returns how many documents they delete. A dry
+# run counts what the deletes would match instead.
+def write(collection, operations, dryRun):
+    if not operations:
+        return 0
+    if dryRun:
+        return sum(collection.count_documents(op._filter) for op in operations if isinstance(op, DeleteMany))
+    return collection.bulk_write(operations, ordered=False).deleted_count
+
+
+moderateCli = AppGroup("moderate", help="Staff moderation tools.")
+
+
+@moderateCli.command("staff")
+@click.argument("email")
+@click.option("--remove", is_flag=True, help="Take staff access away instead.")
+def setStaff(email, remove):
+    """Give a user (by email) access to /moderate."""
+    from app.classes.data import User
+    changed = User.objects(email=email).update(staff=not remove)
+    if not changed:
+        raise click.ClickException(f"No user with the email {email}")
+    click.echo(f"{email} is {'no longer' if remove else 'now'} staff")
@@ -0,0 +1,50 @@
+# Every call the app makes to another website (Google login, OpenStreetMap) goes through
+# this one requests Session. Sharing the session means the connection to each website is
+# kept open and reused instead of doing a new TLS handshake every time, and it is the one
+# place where those calls are timed for /metrics.
+#
+# Use it like the requests library:
+#     from app.utils import outbound
+#     r = outbound.get(url)
+#
+# Inside a request the call gets whatever is left of the route's time budget as its
+# timeout (see app/utils/deadline.py), and raises DeadlineExceeded without calling the
+# website if nothing is left. Both are a requests.Timeout, so one except catches them.
+
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from app.utils.deadline import remaining
+from app.utils.metrics import observeOutbound
+
+session = requests.Session()
+
+
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+def request(method, url, **kwargs):
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded(f"no time left in this request's budget to call {url}")
+        kwargs["timeout"] = min(left, kwargs.get("timeout") or left)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = session.request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        observeOutbound(urlsplit(url).hostname or "unknown", status, time.perf_counter() - started)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
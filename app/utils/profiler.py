@@ -0,0 +1,188 @@
+# A sampling profiler for finding out why a route is slow on the real site. While a
+# request is being profiled, a background thread looks at what that request's thread is
+# doing every few milliseconds (PROFILE_INTERVAL_MS, default 5) and counts each call
+# stack it sees. Functions that show up in lots of samples are where the time goes:
+# template rendering, mongoengine loading references, calls to other websites, etc.
+#
+# Profiling is off unless it is turned on one of two ways:
+#   - PROFILE_SAMPLE_RATE=0.01 profiles 1% of all requests picked at random
+#   - a request with the header  X-Profile-Token: <token>  is always profiled. Make a
+#     token with  flask --app main profile token  (it stops working after
+#     PROFILE_TOKEN_MAX_AGE seconds, default one hour). Example:
+#         curl -H "X-Profile-Token: $(flask --app main profile token)" https://site/blogs
+#     Tokens are signed with FLASK_SECRET_KEY, so they only work when it is set. Without
+#     it every process makes up its own random key (app/__init__.py), and a token made by
+#     the command would never match the site's, so none are made or accepted.
+#
+# Each profile is saved in PROFILE_DIR (default profiles/) in a folder named after the
+# route, as a "collapsed stack" .folded file. Turn one into a picture with
+# flamegraph.pl (https://github.com/brendangregg/FlameGraph) or drop it on
+# https://www.speedscope.app. When the folder is bigger than PROFILE_MAX_MB (default
+# 100) the oldest profiles are deleted.
+#
+# When nothing is being profiled the only cost per request is one random number and one
+# header lookup. The sampling thread only runs while a profiled request is in progress.
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask import g, request
+from flask.cli import AppGroup
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+TOKEN_HEADER = "X-Profile-Token"
+
+
+# "function (file.py:line)" for every frame from the outside in, joined by ';'
+def collapseStack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class SamplingProfiler:
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        # thread id -> Counter of stacks for every request being profiled right now
+        self.active = {}
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.environ.get("PROFILE_SAMPLE_RATE", 0)))
+        app.config.setdefault("PROFILE_DIR", os.environ.get("PROFILE_DIR", "profiles"))
+        app.config.setdefault("PROFILE_MAX_MB", float(os.environ.get("PROFILE_MAX_MB", 100)))
+        app.config.setdefault("PROFILE_INTERVAL_MS", float(os.environ.get("PROFILE_INTERVAL_MS", 5)))
+        app.config.setdefault("PROFILE_TOKEN_MAX_AGE", int(os.environ.get("PROFILE_TOKEN_MAX_AGE", 3600)))
+        self.app = app
+        self.rate = app.config["PROFILE_SAMPLE_RATE"]
+        self.interval = app.config["PROFILE_INTERVAL_MS"] / 1000
+        self.folder = app.config["PROFILE_DIR"]
+        self.maxBytes = app.config["PROFILE_MAX_MB"] * 1024 * 1024
+        self.tokens = bool(os.environ.get("FLASK_SECRET_KEY"))
+
+        app.before_request(self.beforeRequest)
+        app.teardown_request(self.teardownRequest)
+        app.cli.add_command(profileCli)
+
+    def serializer(self):
+        return URLSafeTimedSerializer(self.app.secret_key, salt="profile")
+
+    def makeToken(self):
+        return self.serializer().dumps("profile")
+
+    def validToken(self, token):
+        if not self.tokens:
+            return False
+        try:
+            self.serializer().loads(token, max_age=self.app.config["PROFILE_TOKEN_MAX_AGE"])
+        except BadSignature:
+            return False
+        return True
+
+    def wanted(self):
+        if self.rate and random.random() < self.rate:
+            return True
+        token = request.headers.get(TOKEN_HEADER)
+        return token is not None and self.validToken(token)
+
+    def beforeRequest(self):
+        if not self.wanted():
+            return
+        stacks = Counter()
+        g.profile = (threading.get_ident(), stacks, time.perf_counter())
+        with self.lock:
+            self.active[threading.get_ident()] = stacks
+            # threads don't survive a fork, so a gunicorn worker starts its own
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+                self.thread.start()
+            self.wake.notify()
+
+    def teardownRequest(self, error=None):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        ident, stacks, started = profile
+        with self.lock:
+            self.active.pop(ident, None)
+        elapsed = time.perf_counter() - started
+        try:
+            self.save(request.endpoint or "unknown", stacks, elapsed)
+        except OSError as error:
+            self.app.logger.warning("Could not save profile: %s", error)
+
+    # The background thread. It sleeps until there is a request to profile. Samples are
+    # counted while holding the lock so a request that just finished is never written
+    # to while it is being saved.
+    def sample(self):
+        me = threading.get_ident()
+        while True:
+            with self.lock:
+                while not self.active:
+                    self.wake.wait()
+                frames = sys._current_frames()
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None and ident != me:
+                        stacks[collapseStack(frame)] += 1
+                del frames
+            time.sleep(self.interval)
+
+    def save(self, endpoint, stacks, elapsed):
+        if not stacks:
+            return
+        folder = os.path.join(self.folder, endpoint)
+        os.makedirs(folder, exist_ok=True)
+        name = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{elapsed * 1000:.0f}ms-{os.getpid()}-{random.randrange(1 << 16):04x}.folded"
+        with open(os.path.join(folder, name), "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.prune()
+
+    # Deletes the oldest profiles until the folder is under PROFILE_MAX_MB.
+    def prune(self):
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+profileCli = AppGroup("profile", help="Sampling profiler tools.")
+
+
+@profileCli.command("token")
+def profileToken():
+    """Print a signed token for the X-Profile-Token header."""
+    from app import profiler
+    if not profiler.tokens:
+        raise click.ClickException("Set FLASK_SECRET_KEY (the same one the site uses) to make profile tokens")
+    click.echo(profiler.makeToken())
@@ -0,0 +1,201 @@
+# Keeps track of every MongoDB command the app sends while it answers a request. A page
+# can easily cause dozens of queries without it being obvious in the code, for example
+# every {{blog.author.fname}} in a template loop is another query to load that User.
+#
+# For each request this counts the commands, the documents that came back and the time
+# spent, per collection. The totals are:
+#   - sent back to the browser in a Server-Timing header, so they show up in the
+#     Network tab of the browser's developer tools (click a request, then "Timing")
+#   - written as one JSON line per request to the 'app.requests' log
+# Any single command slower than SLOW_QUERY_MS (default 100) is also written to the slow
+# query log (SLOW_QUERY_LOG, default slow_queries.log) with the shape of its filter, like
+# {"review": "?", "dFromOuter": "?"}, which is usually enough to know what index is missing.
+
+import json
+import logging
+import os
+import time
+
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+requestLog = logging.getLogger("app.requests")
+slowLog = logging.getLogger("app.slowqueries")
+
+# Commands that count as "the app talking to the database". Things like the driver's
+# heartbeat (hello) and endSessions are left out.
+DOCUMENT_COMMANDS = {
+    "find", "getMore", "aggregate", "count", "distinct", "insert", "update", "delete",
+    "findAndModify", "listIndexes", "createIndexes",
+}
+
+
+# Turns a filter into its shape: same keys and operators, but every value is '?'.
+# {"author": ObjectId(...), "age": {"$gt": 3}} -> {"author": "?", "age": {"$gt": "?"}}
+def filterShape(value):
+    if isinstance(value, dict):
+        return {key: filterShape(inner) for key, inner in value.items()}
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], dict):
+        return [filterShape(inner) for inner in value]
+    return "?"
+
+
+def commandFilter(name, command):
+    if name == "find":
+        return command.get("filter", {})
+    if name in ("count", "distinct"):
+        return command.get("query", {})
+    if name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        return pipeline[0].get("$match", pipeline)
+    if name == "update":
+        return (command.get("updates") or [{}])[0].get("q", {})
+    if name == "delete":
+        return (command.get("deletes") or [{}])[0].get("q", {})
+    if name == "findAndModify":
+        return command.get("query", {})
+    return {}
+
+
+def documentsReturned(name, reply):
+    cursor = reply.get("cursor")
+    if cursor is not None:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if name in ("count", "distinct", "findAndModify"):
+        return 1
+    return 0
+
+
+# The numbers for one request. Stored on flask.g so each request (and each thread) has
+# its own.
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.documents = 0
+        self.micros = 0
+        # collection name -> [commands, documents, microseconds]
+        self.collections = {}
+
+    def add(self, collection, documents, micros):
+        self.commands += 1
+        self.documents += documents
+        self.micros += micros
+        totals = self.collections.setdefault(collection, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += documents
+        totals[2] += micros
+
+    def serverTiming(self, elapsed):
+        parts = [f'app;dur={elapsed * 1000:.1f}', f'mongo;dur={self.micros / 1000:.1f};desc="{self.commands} cmds, {self.documents} docs"']
+        for collection, (commands, documents, micros) in sorted(self.collections.items()):
+            parts.append(f'mongo-{collection};dur={micros / 1000:.1f};desc="{commands} cmds, {documents} docs"')
+        return ", ".join(parts)
+
+    def asDict(self):
+        return {
+            "commands": self.commands,
+            "documents": self.documents,
+            "ms": round(self.micros / 1000, 2),
+            "collections": {
+                collection: {"commands": c, "documents": d, "ms": round(m / 1000, 2)}
+                for collection, (c, d, m) in self.collections.items()
+            },
+        }
+
+
+# A pymongo CommandListener. pymongo calls started() just before it sends a command and
+# succeeded()/failed() when the answer comes back, on the same thread that sent it.
+# It is passed to connect() in app/__init__.py so it sees every command the app makes.
+class QueryStats(monitoring.CommandListener):
+    def __init__(self, app=None):
+        # request_id -> (database, collection, command name, command) for commands waiting on a reply
+        self.pending = {}
+        self.slowMicros = 100 * 1000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SLOW_QUERY_MS", float(os.environ.get("SLOW_QUERY_MS", 100)))
+        app.config.setdefault("SLOW_QUERY_LOG", os.environ.get("SLOW_QUERY_LOG", "slow_queries.log"))
+        app.config.setdefault("REQUEST_LOG", os.environ.get("REQUEST_LOG", "1") == "1")
+        self.slowMicros = app.config["SLOW_QUERY_MS"] * 1000
+
+        if not slowLog.handlers and app.config["SLOW_QUERY_LOG"]:
+            handler = logging.FileHandler(app.config["SLOW_QUERY_LOG"], delay=True)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            slowLog.addHandler(handler)
+            slowLog.setLevel(logging.WARNING)
+            slowLog.propagate = False
+        if not requestLog.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            requestLog.addHandler(handler)
+            requestLog.setLevel(logging.INFO if app.config["REQUEST_LOG"] else logging.WARNING)
+            requestLog.propagate = False
+
+        app.before_request(self.beforeRequest)
+        app.after_request(self.afterRequest)
+
+    def beforeRequest(self):
+        g.mongoStats = RequestStats()
+
+    def afterRequest(self, response):
+        stats = g.pop("mongoStats", None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        response.headers["Server-Timing"] = stats.serverTiming(elapsed)
+        if requestLog.isEnabledFor(logging.INFO):
+            requestLog.info(json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "ms": round(elapsed * 1000, 2),
+                "mongo": stats.asDict(),
+            }))
+        return response
+
+    def started(self, event):
+        name = event.command_name
+        if name not in DOCUMENT_COMMANDS:
+            return
+        if name == "getMore":
+            collection = event.command.get("collection")
+        else:
+            collection = event.command.get(name)
+        self.pending[event.request_id] = (event.database_name, collection, name, event.command)
+
+    def succeeded(self, event):
+        self.finished(event, event.reply)
+
+    def failed(self, event):
+        self.finished(event, {})
+
+    def finished(self, event, reply):
+        pending = self.pending.pop(event.request_id, None)
+        if pending is None:
+            return
+        database, collection, name, command = pending
+        if has_request_context():
+            stats = g.get("mongoStats")
+            if stats is not None:
+                stats.add(collection, documentsReturned(name, reply), event.duration_micros)
+        if event.duration_micros >= self.slowMicros:
+            self.logSlow(event, database, collection, name, command)
+
+    def logSlow(self, event, database, collection, name, command):
+        entry = {
+            "ms": round(event.duration_micros / 1000, 2),
+            "db": database,
+            "collection": collection,
+            "command": name,
+            "filter": filterShape(commandFilter(name, command)),
+        }
+        if "sort" in command:
+            entry["sort"] = dict(command["sort"])
+        if has_request_context():
+            entry["endpoint"] = request.endpoint
+            entry["path"] = request.path
+        slowLog.warning(json.dumps(entry, default=str))
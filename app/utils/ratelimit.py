@@ -0,0 +1,160 @@
+# Limits how often one user can post to the routes that create things, so a
+# double-click, a stuck browser or a script can't turn into hundreds of writes. Each
+# user has a "token bucket" per route: the bucket holds up to N tokens, every POST takes
+# one, and it refills at N per period. A user can post N times quickly, then has to slow
+# down to the refill rate. Use it under @app.route and above @login_required:
+#
+#     @app.route('/blog/new', methods=['GET', 'POST'])
+#     @rateLimiter.limit("5/minute")
+#     @login_required
+#     def blogNew():
+#
+# It runs before login_required so a request over the limit gets a short 429 answer with
+# a Retry-After header without loading the user, parsing the form or touching the
+# database. Users are told apart by the user id Flask-Login keeps in the session cookie
+# (or by IP address when not logged in).
+#
+# Settings:
+#   RATE_LIMIT_ENABLED    set to 0 to turn the limits off
+#   RATE_LIMITS           change a route's limit, like "blogNew=10/minute,slimeNew=2/second"
+#   RATE_LIMIT_STORAGE    "memory" (default) keeps the buckets in each worker, so with 4
+#                         gunicorn workers a user can get up to 4 times the limit.
+#                         "mongo" keeps them in the rate_limit collection so all workers
+#                         share them, at the cost of one small MongoDB update per POST.
+
+import logging
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import Response, request, session
+
+log = logging.getLogger("app.ratelimit")
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+# "5/minute" -> (5, 60)
+def parseLimit(text):
+    count, period = text.strip().split("/")
+    return int(count), PERIODS[period.strip().rstrip("s")]
+
+
+class MemoryBuckets:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.lastPrune = time.monotonic()
+
+    # Takes one token from the bucket. Returns 0 if there was one, otherwise how many
+    # seconds until there will be.
+    def take(self, key, capacity, period):
+        now = time.monotonic()
+        rate = capacity / period
+        with self.lock:
+            tokens, updated, period = self.buckets.get(key, (capacity, now, period))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now, period)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now, period)
+                wait = (1 - tokens) / rate
+            if now - self.lastPrune > 60:
+                self.prune(now)
+        return wait
+
+    # A bucket untouched for a whole period is full again, which is the same as not
+    # having one, so drop those to keep memory from growing with every user ever seen.
+    def prune(self, now):
+        self.lastPrune = now
+        self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] < value[2]}
+
+
+class MongoBuckets:
+    def __init__(self):
+        self.ready = False
+
+    def collection(self):
+        from mongoengine.connection import get_db
+        collection = get_db()["rate_limit"]
+        if not self.ready:
+            # MongoDB deletes buckets by itself once they have been full for a while.
+            collection.create_index("expires", expireAfterSeconds=0)
+            self.ready = True
+        return collection
+
+    # The same sums as MemoryBuckets.take, but done inside MongoDB in one atomic update
+    # so two workers can't both take the last token. $$NOW is MongoDB's clock, so the
+    # workers' clocks don't have to agree.
+    def take(self, key, capacity, period):
+        from pymongo import ReturnDocument
+        rate = capacity / period
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]}, 1000]}
+        bucket = self.collection().find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": {"$min": [capacity, {"$add": [
+                    {"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]},
+                ]}]}}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "updated": "$$NOW",
+                    "expires": {"$add": ["$$NOW", period * 1000]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"tokens": 1, "allowed": 1},
+        )
+        if bucket["allowed"]:
+            return 0
+        return (1 - bucket["tokens"]) / rate
+
+
+class RateLimiter:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATE_LIMIT_ENABLED", os.environ.get("RATE_LIMIT_ENABLED", "1") != "0")
+        app.config.setdefault("RATE_LIMIT_STORAGE", os.environ.get("RATE_LIMIT_STORAGE", "memory"))
+        app.config.setdefault("RATE_LIMITS", os.environ.get("RATE_LIMITS", ""))
+        self.enabled = app.config["RATE_LIMIT_ENABLED"]
+        self.overrides = {}
+        for item in app.config["RATE_LIMITS"].split(","):
+            if item.strip():
+                endpoint, limit = item.split("=")
+                self.overrides[endpoint.strip()] = parseLimit(limit)
+        self.storage = MongoBuckets() if app.config["RATE_LIMIT_STORAGE"] == "mongo" else MemoryBuckets()
+
+    def limit(self, default, methods=("POST",)):
+        def decorator(view):
+            endpoint = view.__name__
+
+            @wraps(view)
+            def limited(*args, **kwargs):
+                if self.enabled and request.method in methods:
+                    capacity, period = self.overrides.get(endpoint) or parseLimit(default)
+                    who = session.get("_user_id") or request.remote_addr
+                    try:
+                        wait = self.storage.take(f"{endpoint}:{who}", capacity, period)
+                    except Exception:
+                        # Better to let a post through than to break posting for
+                        # everyone when the shared buckets can't be reached.
+                        log.exception("rate limit check failed")
+                        wait = 0
+                    if wait:
+                        return Response(
+                            "Too many requests, please wait a moment and try again.\n",
+                            status=429,
+                            mimetype="text/plain",
+                            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+                        )
+                return view(*args, **kwargs)
+            return limited
+        return decorator
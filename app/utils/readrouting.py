@@ -0,0 +1,124 @@
+# Lets pages that only read (lists, detail pages, the clinic map) be answered by a
+# secondary member of a MongoDB replica set, so the primary only has to do the writes.
+# Turn it on with
+#
+#     MONGO_READ_PREFERENCE=secondaryPreferred MONGO_MAX_STALENESS_SECONDS=90
+#
+# and mark the read-only routes:
+#
+#     @app.route('/blogs')
+#     @readRouting.readOnly
+#     def blogList():
+#
+# secondaryPreferred reads from a secondary when there is one, and never from one that
+# is more than MONGO_MAX_STALENESS_SECONDS behind the primary (90 is the smallest MongoDB
+# allows). Every other route, and all writes, still use the primary.
+#
+# A secondary can be a few seconds behind, so after a user posts something the page they
+# are sent to might not show it yet. To stop that, the time of the user's last write (the
+# "operationTime" MongoDB sends back) is kept in their Flask session for
+# MONGO_MAX_STALENESS_SECONDS. Their read-only pages use a causally consistent session
+# started after that time, which makes the secondary wait until it has the write before
+# answering. Other users aren't slowed down.
+#
+# Only queries made through a Document's objects use the secondary. Following a
+# ReferenceField in a template (like {{blog.author.fname}}) still reads from the primary.
+#
+# With MONGO_READ_PREFERENCE unset (the default) nothing here does anything. See
+# bench/replset.py to start a local three member replica set to try it on.
+
+import os
+import time
+from functools import wraps
+
+from bson import json_util
+from flask import g, has_request_context, session
+from mongoengine import QuerySet
+from pymongo import monitoring
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+
+WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+SESSION_KEY = "_lastWrite"
+
+
+# The QuerySet class for every Document in data.py (their meta 'queryset_class'). It
+# picks up the read preference and causal session readOnly set up for this request.
+class RoutedQuerySet(QuerySet):
+    def __init__(self, document, collection):
+        super().__init__(document, collection)
+        if has_request_context() and g.get("readPreference") is not None:
+            self._read_preference = g.readPreference
+
+    @property
+    def _cursor_args(self):
+        args = super()._cursor_args
+        if has_request_context() and g.get("mongoSession") is not None:
+            args["session"] = g.mongoSession
+        return args
+
+    def aggregate(self, pipeline, *suppl_pipeline, **kwargs):
+        if has_request_context() and g.get("mongoSession") is not None:
+            kwargs.setdefault("session", g.mongoSession)
+        return super().aggregate(pipeline, *suppl_pipeline, **kwargs)
+
+
+class ReadRouting(monitoring.CommandListener):
+    def __init__(self, app=None):
+        self.preference = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MONGO_READ_PREFERENCE", os.environ.get("MONGO_READ_PREFERENCE", "primary"))
+        app.config.setdefault("MONGO_MAX_STALENESS_SECONDS", int(os.environ.get("MONGO_MAX_STALENESS_SECONDS", 90)))
+        self.maxStaleness = app.config["MONGO_MAX_STALENESS_SECONDS"]
+        mode = read_pref_mode_from_name(app.config["MONGO_READ_PREFERENCE"])
+        if mode:
+            self.preference = make_read_preference(mode, None, max_staleness=self.maxStaleness)
+        app.after_request(self.afterRequest)
+        app.teardown_request(self.teardownRequest)
+
+    def readOnly(self, view):
+        @wraps(view)
+        def routed(*args, **kwargs):
+            if self.preference is not None:
+                g.readPreference = self.preference
+                lastWrite = session.get(SESSION_KEY)
+                if lastWrite and time.time() - lastWrite["at"] < self.maxStaleness:
+                    g.mongoSession = self.causalSession(json_util.loads(lastWrite["times"]))
+            return view(*args, **kwargs)
+        return routed
+
+    def causalSession(self, times):
+        from mongoengine.connection import get_connection
+        mongoSession = get_connection().start_session(causal_consistency=True)
+        if times.get("clusterTime"):
+            mongoSession.advance_cluster_time(times["clusterTime"])
+        mongoSession.advance_operation_time(times["operationTime"])
+        return mongoSession
+
+    # Remember when this user last wrote, so their next pages can wait for it.
+    def afterRequest(self, response):
+        lastWrite = g.pop("lastWrite", None)
+        if lastWrite is not None and self.preference is not None:
+            session[SESSION_KEY] = {"at": time.time(), "times": json_util.dumps(lastWrite)}
+        return response
+
+    def teardownRequest(self, error=None):
+        mongoSession = g.pop("mongoSession", None)
+        if mongoSession is not None:
+            mongoSession.end_session()
+
+    # pymongo calls these for every command (this is passed to connect() in
+    # app/__init__.py). Replica set members send back the time of every write.
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if event.command_name in WRITE_COMMANDS and has_request_context():
+            operationTime = event.reply.get("operationTime")
+            if operationTime is not None:
+                g.lastWrite = {"operationTime": operationTime, "clusterTime": event.reply.get("$clusterTime")}
+
+    def failed(self, event):
+        pass
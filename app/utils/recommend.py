@@ -0,0 +1,211 @@
+# "You might also like" clubs, worked out from who belongs to which club. Two clubs are
+# similar when a lot of the same people joined both. Run the job from the main project
+# folder, for example every night:
+#
+#     flask --app main recommend clubs
+#     flask --app main recommend clubs --top 5 --grade-weight 1 --dry-run
+#
+# It reads every Club.members list once and builds a users x clubs matrix (a SciPy sparse
+# matrix, so it only stores the memberships, not every empty user/club pair). Multiplying
+# it by itself gives how many members each pair of clubs share, and dividing by the sizes
+# of the two clubs (cosine similarity) stops the biggest clubs from being similar to
+# everything. The best --top clubs for each club, and for each user the best clubs they
+# haven't joined, are saved as Suggestion documents (app/classes/data.py) so the club
+# page and /myprofile only do one small lookup. A user's list is topped up to --top with
+# the most joined clubs they aren't in, so someone who has joined every club like theirs
+# still gets suggestions. Users in no clubs at all have no list and get the most joined
+# clubs ("popular").
+#
+# With --grade-weight above 0 it also saves a list per grade where members count less the
+# further their grade is from that grade (a member 2 grades away counts 1 / (1 + 2 x
+# weight)), so a 9th grader mostly sees what other 9th graders joined.
+#
+# The job needs numpy and scipy (in requirements.txt). The site itself doesn't: it only
+# reads the saved suggestions.
+
+import datetime as dt
+import time
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+
+from app import app
+
+recommendCli = AppGroup("recommend", help="Precomputed club suggestions.")
+
+BATCH = 1000
+
+
+def clubKey(clubId, grade=None):
+    return f"club:{clubId}" if grade is None else f"club:{clubId}:grade:{grade}"
+
+
+def userKey(userId):
+    return f"user:{userId}"
+
+
+# The clubs to show for the first of keys that has any, as (id, name) pairs. Pass the
+# most specific key first. This is the one query the pages make.
+def suggestionsFor(*keys):
+    from app.classes.data import Suggestion
+    found = {doc["_id"]: doc for doc in Suggestion._get_collection().find({"_id": {"$in": list(keys)}})}
+    for key in keys:
+        if found.get(key, {}).get("clubs"):
+            return list(zip(found[key]["clubs"], found[key]["names"]))
+    return []
+
+
+def membershipMatrix():
+    import numpy as np
+    from scipy import sparse
+    from app.classes.data import Club
+    clubIds, names, rows, cols = [], [], [], []
+    userRow = {}
+    for col, club in enumerate(Club._get_collection().find({}, {"name": 1, "members": 1}, batch_size=BATCH)):
+        clubIds.append(club["_id"])
+        names.append(club.get("name") or "")
+        for userId in set(club.get("members") or ()):
+            rows.append(userRow.setdefault(userId, len(userRow)))
+            cols.append(col)
+    members = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(userRow), len(clubIds)),
+    )
+    return members, list(userRow), clubIds, names
+
+
+# Each user's grade (or None), in the same order as the matrix rows.
+def userGrades(userIds):
+    from app.classes.data import User
+    grades = {}
+    for start in range(0, len(userIds), BATCH):
+        for user in User._get_collection().find({"_id": {"$in": userIds[start:start + BATCH]}}, {"grade": 1}):
+            grades[user["_id"]] = user.get("grade")
+    return [grades.get(userId) for userId in userIds]
+
+
+# Club x club cosine similarity, with each user's memberships counted `weights` times.
+def similarity(members, weights=None):
+    import numpy as np
+    from scipy import sparse
+    weighted = members if weights is None else sparse.diags(weights) @ members
+    shared = (members.T @ weighted).tocsr()
+    size = np.sqrt(shared.diagonal())
+    size[size == 0] = 1
+    inverse = sparse.diags(1 / size)
+    similar = (inverse @ shared @ inverse).tocsr()
+    similar.setdiag(0)
+    similar.eliminate_zeros()
+    return similar
+
+
+# The `top` biggest entries of one sparse matrix row as (column, value), biggest first,
+# leaving out the columns in skip.
+def topOfRow(matrix, row, top, skip=()):
+    import numpy as np
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    cols, values = matrix.indices[start:end], matrix.data[start:end]
+    if len(skip):
+        keep = ~np.isin(cols, skip)
+        cols, values = cols[keep], values[keep]
+    if len(values) > top:
+        best = np.argpartition(-values, top)[:top]
+        cols, values = cols[best], values[best]
+    order = np.lexsort((cols, -values))
+    return [(int(cols[i]), float(values[i])) for i in order]
+
+
+def suggestion(key, picks, clubIds, names, now):
+    return {
+        "_id": key,
+        "clubs": [clubIds[col] for col, _ in picks],
+        "names": [names[col] for col, _ in picks],
+        "scores": [round(score, 4) for _, score in picks],
+        "create_date": now,
+    }
+
+
+def buildSuggestions(top, gradeWeight):
+    import numpy as np
+    members, userIds, clubIds, names = membershipMatrix()
+    now = dt.datetime.utcnow()
+    grades = userGrades(userIds) if gradeWeight > 0 else [None] * len(userIds)
+
+    tables = {None: similarity(members)}
+    for grade in sorted({g for g in grades if g is not None}):
+        distance = np.array([abs(g - grade) if g is not None else 0 for g in grades], dtype=np.float32)
+        tables[grade] = similarity(members, 1 / (1 + gradeWeight * distance))
+
+    for grade, similar in tables.items():
+        for col in range(len(clubIds)):
+            picks = topOfRow(similar, col, top)
+            if picks:
+                yield suggestion(clubKey(clubIds[col], grade), picks, clubIds, names, now)
+
+    counts = np.asarray(members.sum(axis=0)).ravel()
+    mostJoined = [int(col) for col in np.argsort(-counts, kind="stable") if counts[col] > 0]
+
+    # A user's score for a club is the sum of its similarity to every club they're in.
+    for grade, similar in tables.items():
+        rows = [row for row, g in enumerate(grades) if (g if g in tables else None) == grade]
+        if not rows:
+            continue
+        scores = (members[rows] @ similar).tocsr()
+        for i, row in enumerate(rows):
+            joined = members.indices[members.indptr[row]:members.indptr[row + 1]]
+            picks = topOfRow(scores, i, top, joined)
+            if len(picks) < top:
+                # Popular clubs fill the rest of the list, with a score of 0
+                taken = set(joined.tolist()) | {col for col, _ in picks}
+                picks += [(col, 0.0) for col in islice((col for col in mostJoined if col not in taken), top - len(picks))]
+            if picks:
+                yield suggestion(userKey(userIds[row]), picks, clubIds, names, now)
+
+    popular = [(col, float(counts[col])) for col in mostJoined[:top]]
+    if popular:
+        yield suggestion("popular", popular, clubIds, names, now)
+
+
+@recommendCli.command("clubs")
+@click.option("--top", default=5, show_default=True, help="Clubs to keep for each club and user.")
+@click.option("--grade-weight", default=0.0, show_default=True, help="Also make per-grade lists, 0 turns that off.")
+@click.option("--batch-size", default=BATCH, show_default=True)
+@click.option("--dry-run", is_flag=True, help="Work them out and print counts without saving.")
+def recommendClubs(top, grade_weight, batch_size, dry_run):
+    """Work out similar clubs from Club.members and save them as Suggestions."""
+    from pymongo import ReplaceOne
+    from app.classes.data import Suggestion
+    try:
+        import numpy  # noqa: F401
+        import scipy  # noqa: F401
+    except ImportError:
+        raise click.ClickException("This needs numpy and scipy: pip install -r requirements.txt")
+
+    began = time.perf_counter()
+    collection = Suggestion._get_collection()
+    startedAt = dt.datetime.utcnow()
+    counts = {}
+    batch = []
+    for doc in buildSuggestions(top, grade_weight):
+        kind = doc["_id"].split(":")[0] + (" by grade" if ":grade:" in doc["_id"] else "")
+        counts[kind] = counts.get(kind, 0) + 1
+        if dry_run:
+            continue
+        batch.append(ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+    if not dry_run:
+        # Anything this run didn't write is for a club or user that is gone, or one that
+        # no longer has anything to suggest.
+        removed = collection.delete_many({"create_date": {"$lt": startedAt}}).deleted_count
+        click.echo(f"Removed {removed:,} old suggestions")
+    for kind, count in sorted(counts.items()):
+        click.echo(f"{kind}: {count:,}")
+    click.echo(("Worked out" if dry_run else "Saved") + f" in {time.perf_counter() - began:.1f}s")
+
+
+app.cli.add_command(recommendCli)
@@ -0,0 +1,94 @@
+# Sends a page to the browser while it is still being rendered, for the list pages that
+# can have thousands of rows (blogs, reviews, clubs). render_template builds the whole
+# page as one string first, so the browser sees nothing until the last row is done and
+# the worker holds the whole page in memory. With streamTemplate the top of the page goes
+# out right away and rows follow as they are rendered, STREAM_CHUNK_BYTES at a time.
+#
+#     blogs = Batched(Blog.objects(), 'author')
+#     return streamTemplate('blogs.html', blogs=blogs)
+#
+# Batched reads the QuerySet from MongoDB STREAM_BATCH_SIZE documents at a time and,
+# for each batch, loads the referenced documents (like every blog's author) with one
+# query instead of one query per row. Only one batch is in memory at a time.
+#
+# The response headers are sent before the rows are rendered, so the queries for the
+# rows don't show up in the Server-Timing header or request log (app/utils/querystats.py).
+
+import time
+
+from flask import Response, current_app, get_flashed_messages, stream_with_context
+
+# The first piece is sent as soon as there is this much, so the browser can start
+# loading the CSS while the rows are being read.
+FIRST_CHUNK_BYTES = 1024
+
+
+class Batched:
+    def __init__(self, queryset, *references):
+        self.queryset = queryset
+        self.references = references
+
+    # So {% if blogs %} still works. Same cheap check a QuerySet does.
+    def __bool__(self):
+        return self.queryset.clone().only("id").first() is not None
+
+    def __iter__(self):
+        size = current_app.config.get("STREAM_BATCH_SIZE", 100)
+        batch = []
+        for document in self.queryset.clone().no_cache().batch_size(size):
+            batch.append(document)
+            if len(batch) == size:
+                yield from self.loadReferences(batch)
+                batch = []
+        if batch:
+            yield from self.loadReferences(batch)
+
+    def loadReferences(self, batch):
+        for name in self.references:
+            field = self.queryset._document._fields[name]
+            ids = {document._data[name].id for document in batch if document._data.get(name) is not None}
+            found = field.document_type.objects.in_bulk(list(ids))
+            for document in batch:
+                ref = document._data.get(name)
+                if ref is not None and ref.id in found:
+                    document._data[name] = found[ref.id]
+        return batch
+
+
+def streamTemplate(name, **context):
+    app = current_app._get_current_object()
+    # Take the flashed messages out of the session now. Once the headers are sent the
+    # session cookie can't change, so a message read while streaming would show again on
+    # the next page.
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(name)
+    return Response(stream_with_context(chunked(
+        template.generate(context),
+        app.config.get("STREAM_CHUNK_BYTES", 16 * 1024),
+        app.config.get("STREAM_FLUSH_SECONDS", 0.2),
+    )), mimetype="text/html")
+
+
+# Jinja yields lots of tiny strings. This groups them into pieces of about chunkBytes so
+# the network isn't flooded with tiny packets. The time is only checked when a new string
+# arrives: if flushSeconds have gone by since the last piece, everything buffered goes
+# out then, so a page that produces output slowly still arrives bit by bit. Nothing is
+# sent while the template is waiting (for the next batch from MongoDB, say). What came
+# before that wait goes out with the first string after it.
+def chunked(pieces, chunkBytes, flushSeconds):
+    buffer = []
+    size = 0
+    limit = FIRST_CHUNK_BYTES
+    lastFlush = time.monotonic()
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= limit or time.monotonic() - lastFlush >= flushSeconds:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+            limit = chunkBytes
+            lastFlush = time.monotonic()
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
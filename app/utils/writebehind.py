@@ -0,0 +1,147 @@
+# Saves documents in batches instead of one at a time. When a whole class fills in the
+# sleep check-in form at once, every slimeNew used to wait for its own insert. With
+# WRITE_BEHIND=1 the route puts the document in a buffer and answers right away, and a
+# background thread in each worker sends the buffer to MongoDB with one insert_many when
+# it holds WRITE_BEHIND_SIZE documents (default 500) or every WRITE_BEHIND_SECONDS
+# (default 1), whichever comes first.
+#
+# Nothing is lost when a worker stops normally (gunicorn restarting it, ctrl-c): the
+# background thread is stopped, waiting up to WRITE_BEHIND_STOP_SECONDS (default 10) for
+# an insert it is in the middle of, and then the buffer is flushed on the way out. If
+# MongoDB can't be reached then, the documents are appended to
+# WRITE_BEHIND_SPILL_DIR/<collection>.ndjson (default spill/) instead, in the same format
+# as 'flask data export', so they can be loaded later with
+#
+#     flask --app main data import spill --collection slime
+#
+# Only a worker that is killed outright (kill -9, out of memory) can lose the last
+# second of documents. Leave WRITE_BEHIND off for anything that can't take that risk.
+
+import atexit
+import logging
+import os
+import threading
+
+from bson import ObjectId, json_util
+
+log = logging.getLogger("app.writebehind")
+
+
+class WriteBehind:
+    def __init__(self, documentClass, app=None):
+        self.documentClass = documentClass
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.buffer = []
+        self.thread = None
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("WRITE_BEHIND", os.environ.get("WRITE_BEHIND") == "1")
+        app.config.setdefault("WRITE_BEHIND_SIZE", int(os.environ.get("WRITE_BEHIND_SIZE", 500)))
+        app.config.setdefault("WRITE_BEHIND_SECONDS", float(os.environ.get("WRITE_BEHIND_SECONDS", 1)))
+        app.config.setdefault("WRITE_BEHIND_SPILL_DIR", os.environ.get("WRITE_BEHIND_SPILL_DIR", "spill"))
+        app.config.setdefault("WRITE_BEHIND_STOP_SECONDS", float(os.environ.get("WRITE_BEHIND_STOP_SECONDS", 10)))
+        self.enabled = app.config["WRITE_BEHIND"]
+        self.size = app.config["WRITE_BEHIND_SIZE"]
+        self.seconds = app.config["WRITE_BEHIND_SECONDS"]
+        self.spillDir = app.config["WRITE_BEHIND_SPILL_DIR"]
+        self.stopSeconds = app.config["WRITE_BEHIND_STOP_SECONDS"]
+        atexit.register(self.close)
+
+    # Saves the document now, or puts it in the buffer when WRITE_BEHIND is on. The
+    # document gets its _id here either way so the caller can use document.id.
+    def save(self, document):
+        if not self.enabled:
+            return document.save()
+        document.validate()
+        if document.id is None:
+            document.id = ObjectId()
+        with self.lock:
+            self.buffer.append(document.to_mongo())
+            full = len(self.buffer) >= self.size
+        self.startThread()
+        if full:
+            self.wake.set()
+        return document
+
+    # The thread is started by the first save in each worker process. Under gunicorn the
+    # app is imported in the master and then forked, and a thread started in the master
+    # wouldn't exist in the workers.
+    def startThread(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.seconds)
+            self.wake.clear()
+            try:
+                self.flush(spill=False)
+            except Exception:
+                log.exception("write-behind flush of %s failed, will try again", self.documentClass.__name__)
+
+    # Stops the background thread and saves what is left, for a worker that is exiting.
+    # A batch the thread has taken out of the buffer is only back in it (if its insert
+    # failed) once the thread is done, so it is waited for first. Returns how many
+    # documents were saved here.
+    def close(self):
+        self.stopping.set()
+        self.wake.set()
+        thread = self.thread if self.pid == os.getpid() else None
+        if thread is not None and thread.is_alive():
+            thread.join(self.stopSeconds)
+            if thread.is_alive():
+                log.warning("write-behind thread of %s still busy after %ss, a batch it is saving may be lost",
+                            self.documentClass.__name__, self.stopSeconds)
+        return self.flush()
+
+    # Sends everything in the buffer in one insert_many. If that fails the documents go
+    # back in the buffer for the next try, or to the spill file when the worker is
+    # shutting down and there is no next try.
+    def flush(self, spill=True):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        if not batch:
+            return 0
+        try:
+            self.insert(batch)
+        except Exception:
+            if spill:
+                log.exception("could not flush %s documents, writing them to %s", len(batch), self.spillDir)
+                self.spill(batch)
+                return 0
+            with self.lock:
+                self.buffer = batch + self.buffer
+            raise
+        return len(batch)
+
+    def insert(self, batch):
+        from pymongo.errors import BulkWriteError
+        try:
+            self.documentClass._get_collection().insert_many(batch, ordered=False)
+        except BulkWriteError as error:
+            # 11000 is "duplicate key": that document was already saved by an earlier
+            # try that timed out after MongoDB got it.
+            if any(e["code"] != 11000 for e in error.details["writeErrors"]):
+                raise
+
+    def spill(self, batch):
+        os.makedirs(self.spillDir, exist_ok=True)
+        path = os.path.join(self.spillDir, self.documentClass._get_collection_name() + ".ndjson")
+        lines = "".join(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n" for doc in batch)
+        # One write of the whole batch with O_APPEND so two workers spilling at the same
+        # time don't mix up each other's lines.
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode("utf-8"))
+        finally:
+            os.close(fd)
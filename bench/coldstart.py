@@ -0,0 +1,52 @@
+# Cold start check. This measures how long it takes a fresh Python process to import
+# the app (create the Flask app, load every route and set up the lazy database
+# connection). This is the time a new gunicorn master or a reloaded dev server waits
+# before it can answer anything.
+#
+# Run it from the main project folder:
+#
+#     python bench/coldstart.py
+#
+# It imports the app several times, each in a brand new process, and fails (exit code 1)
+# if the median is over the budget. When this was written the import took about 470ms
+# on a laptop, down from about 840ms before unused imports (setuptools, flask_security,
+# jwt) were removed from data.py. Change the budget with COLDSTART_BUDGET_MS.
+
+import os
+import statistics
+import subprocess
+import sys
+
+BUDGET_MS = float(os.environ.get("COLDSTART_BUDGET_MS", 750))
+RUNS = int(os.environ.get("COLDSTART_RUNS", 5))
+
+# This is run in a new process so nothing is already imported or cached.
+MEASURE = "import time; t = time.perf_counter(); import app; print((time.perf_counter() - t) * 1000)"
+
+
+def measure():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE],
+        cwd=root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    # The first run warms the disk cache and the .pyc files so it doesn't count.
+    measure()
+    times = [measure() for i in range(RUNS)]
+    median = statistics.median(times)
+    print(f"cold start: median {median:.0f}ms, min {min(times):.0f}ms, max {max(times):.0f}ms (budget {BUDGET_MS:.0f}ms)")
+    if median > BUDGET_MS:
+        print("cold start is over budget. Check `python -X importtime -c 'import app'` for slow imports.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
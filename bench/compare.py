@@ -0,0 +1,60 @@
+# Compares two load test results from bench/loadtest.py, for example the last commit
+# and this one:
+#
+#     python bench/compare.py bench/results/abc1234.json bench/results/def5678.json
+#
+# It prints how much each route's p50/p95/p99 changed. It exits with code 1 if any
+# route's p95 got slower by more than --fail-over percent (default 20) so it can be used
+# as a check before merging.
+
+import argparse
+import json
+import sys
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two load test results.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--fail-over", type=float, default=20.0, help="percent p95 slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'route':<22}{'p50':>16}{'p95':>16}{'p99':>16}")
+    slower = []
+    for name in sorted(set(old["routes"]) | set(new["routes"])):
+        if name not in old["routes"] or name not in new["routes"]:
+            print(f"{name:<22}  only in {'new' if name in new['routes'] else 'old'}")
+            continue
+        a = old["routes"][name]
+        b = new["routes"][name]
+        cells = [f"{b[k]:>8.1f} {change(a[k], b[k]):+6.0f}%" for k in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<22}" + "".join(cells))
+        if change(a["p95_ms"], b["p95_ms"]) > args.fail_over:
+            slower.append(name)
+
+    opsOld = old["mongo"]["ops_per_request"]
+    opsNew = new["mongo"]["ops_per_request"]
+    print(f"\nMongo ops per request: {opsOld} -> {opsNew} ({change(opsOld, opsNew):+.0f}%)")
+    if "rps" in old.get("total", {}) and "rps" in new.get("total", {}):
+        print(f"Requests per second: {old['total']['rps']} -> {new['total']['rps']}")
+
+    if slower:
+        print(f"\np95 regressed by more than {args.fail_over:.0f}%: {', '.join(slower)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+# Load test. This hammers a running copy of the site with many users at once and
+# writes down how fast every route was. Use it to check if a change made the site
+# faster or slower.
+#
+# 1) Seed a local database (this erases it first):
+#        python bench/seed.py --scale 0.01
+# 2) Start the site against that database with the test login turned on:
+#        MONGO_HOST=mongodb://localhost:27017 MONGO_DB_NAME=bench ENABLE_TEST_LOGIN=1 RATE_LIMIT_ENABLED=0 gunicorn
+#    (the load test posts much faster than a person, so the per-user limits are off)
+# 3) Run the load test:
+#        python bench/loadtest.py --url http://127.0.0.1:8000 --concurrency 16 --duration 60
+# 4) Compare two runs (for example before and after a commit):
+#        python bench/compare.py bench/results/OLD.json bench/results/NEW.json
+#
+# Every route in app/routes/ has a scenario below. Routes that change or delete data
+# work on documents the scenario made itself, so the seeded data stays the same. The
+# results (p50/p95/p99 latency, requests per second and MongoDB operations per request)
+# are saved as JSON in bench/results/ named after the current git commit.
+
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from pymongo import MongoClient
+
+from seed import DEFAULT_DB, DEFAULT_HOST, makeId
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+# where the app sends you after creating something, like /blog/<id>
+CREATED = re.compile(r"/([0-9a-f]{24})$")
+
+
+class Run:
+    def __init__(self, url, sizes, timeout):
+        self.url = url.rstrip("/")
+        self.sizes = sizes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.times = {}
+        self.errors = {}
+        # every HTTP request sent, timed or not, so Mongo ops can be divided by it
+        self.sent = 0
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.times.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+# One simulated person. Each has their own session (cookie jar) and logs in as a
+# random seeded user through the /login/test route.
+class Visitor:
+    def __init__(self, run, rnd):
+        self.run = run
+        self.rnd = rnd
+        self.session = requests.Session()
+        self.user = rnd.randrange(run.sizes["users"])
+        self.get(f"/login/test/user{self.user}@bench.test")
+
+    def get(self, path, **kwargs):
+        with self.run.lock:
+            self.run.sent += 1
+        return self.session.get(self.run.url + path, timeout=self.run.timeout, allow_redirects=False, **kwargs)
+
+    def post(self, path, data):
+        with self.run.lock:
+            self.run.sent += 1
+        return self.session.post(self.run.url + path, data=data, timeout=self.run.timeout, allow_redirects=False)
+
+    # Sends a request and records how long it took under the route's name.
+    # Redirects count as success because that is how the app answers a good form post.
+    def timed(self, name, method, path, data=None):
+        began = time.perf_counter()
+        try:
+            if method == "GET":
+                response = self.get(path)
+            else:
+                response = self.post(path, data)
+        except requests.RequestException:
+            self.run.record(name, time.perf_counter() - began, False)
+            return None
+        self.run.record(name, time.perf_counter() - began, response.status_code < 400)
+        return response
+
+    # Fills out a form: gets the page for its CSRF token, then posts it.
+    def submit(self, name, path, fields):
+        page = self.get(path)
+        token = CSRF.search(page.text)
+        data = dict(fields, csrf_token=token.group(1) if token else "")
+        return self.timed(name, "POST", path, data)
+
+    def newId(self, response):
+        if response is None or "Location" not in response.headers:
+            return None
+        found = CREATED.search(response.headers["Location"])
+        return found.group(1) if found else None
+
+    def pick(self, kind):
+        return str(makeId(kind, self.rnd.randrange(self.run.sizes[kind])))
+
+
+# The scenarios. Each one exercises one route. The number is how often it is picked
+# compared to the others, roughly how often real people use that page.
+
+def index(v):
+    v.timed("index", "GET", "/")
+
+def aboutus(v):
+    v.timed("aboutus", "GET", "/aboutus")
+
+def myProfile(v):
+    v.timed("myProfile", "GET", "/myprofile")
+
+def profileEdit(v):
+    v.timed("profileEdit", "GET", "/myprofile/edit")
+
+def blogList(v):
+    v.timed("blogList", "GET", "/blogs")
+
+def blog(v):
+    v.timed("blog", "GET", f"/blog/{v.pick('blog')}")
+
+def blogPopular(v):
+    # the first few blogs have most of the comments (see seed.py)
+    v.timed("blog (popular)", "GET", f"/blog/{makeId('blog', v.rnd.randrange(3))}")
+
+def blogNew(v):
+    v.submit("blogNew", "/blog/new", {"subject": "load test", "content": "load test blog", "tag": "bench"})
+
+def blogEdit(v):
+    blogID = v.newId(v.submit("blogNew", "/blog/new", {"subject": "edit me", "content": "x", "tag": "bench"}))
+    if blogID:
+        v.submit("blogEdit", f"/blog/edit/{blogID}", {"subject": "edited", "content": "y", "tag": "bench"})
+
+def blogDelete(v):
+    blogID = v.newId(v.submit("blogNew", "/blog/new", {"subject": "delete me", "content": "x", "tag": "bench"}))
+    if blogID:
+        v.timed("blogDelete", "GET", f"/blog/delete/{blogID}")
+
+def commentNew(v):
+    v.submit("commentNew", f"/comment/new/{v.pick('blog')}", {"content": "load test comment"})
+
+def commentEditDelete(v):
+    blogID = v.newId(v.submit("blogNew", "/blog/new", {"subject": "comments", "content": "x", "tag": "bench"}))
+    if not blogID:
+        return
+    v.submit("commentNew", f"/comment/new/{blogID}", {"content": "first"})
+    page = v.get(f"/blog/{blogID}")
+    found = re.search(r"/comment/edit/([0-9a-f]{24})", page.text)
+    if found:
+        v.submit("commentEdit", f"/comment/edit/{found.group(1)}", {"content": "edited"})
+        v.timed("commentDelete", "GET", f"/comment/delete/{found.group(1)}")
+
+def reviewList(v):
+    v.timed("reviewList", "GET", "/reviews")
+
+def review(v):
+    v.timed("review", "GET", f"/review/{v.pick('review')}")
+
+def reviewBigTree(v):
+    trees = max(1, min(v.run.sizes["reply_trees"], v.run.sizes["review"]))
+    v.timed("review (big tree)", "GET", f"/review/{makeId('review', v.rnd.randrange(trees))}")
+
+def reviewNew(v):
+    v.submit("reviewNew", "/review/new", {"name": "Alameda Hospital", "subject": "Other", "text": "load test", "rating": 5})
+
+def reviewEditDelete(v):
+    fields = {"name": "Alameda Hospital", "subject": "Other", "text": "edit me", "rating": 5}
+    reviewID = v.newId(v.submit("reviewNew", "/review/new", fields))
+    if reviewID:
+        v.submit("reviewEdit", f"/review/edit/{reviewID}", dict(fields, text="edited"))
+        v.timed("reviewDelete", "GET", f"/review/delete/{reviewID}")
+
+def replies(v):
+    fields = {"name": "Alameda Hospital", "subject": "Other", "text": "thread", "rating": 5}
+    reviewID = v.newId(v.submit("reviewNew", "/review/new", fields))
+    if not reviewID:
+        return
+    v.submit("replyNewRev", f"/reply/newRev/{reviewID}", {"text": "top"})
+    page = v.get(f"/review/{reviewID}")
+    found = re.search(r"/reply/edit/([0-9a-f]{24})", page.text)
+    if found:
+        replyID = found.group(1)
+        v.submit("replyNewRep", f"/reply/newRep/{reviewID}/{replyID}", {"text": "answer"})
+        v.submit("replyEdit", f"/reply/edit/{replyID}", {"text": "edited"})
+        v.timed("replyDelete", "GET", f"/reply/delete/{replyID}")
+
+def slimeNew(v):
+    v.submit("slimeNew", "/slime/new", {"sleep_time": v.rnd.randint(1, 12), "time_frame": "PM"})
+
+def clubList(v):
+    v.timed("clubList", "GET", "/clubs")
+
+def club(v):
+    v.timed("club", "GET", f"/club/{v.pick('club')}")
+
+def clubBig(v):
+    big = max(1, min(v.run.sizes["big_clubs"], v.run.sizes["club"]))
+    v.timed("club (5k members)", "GET", f"/club/{makeId('club', v.rnd.randrange(big))}")
+
+CLUB = {"name": "Bench Club", "advisor": "Bench", "description": "x", "meeting_day": "Monday", "meeting_time": "Lunch", "meeting_place": "101"}
+
+def clubNew(v):
+    v.submit("clubNew", "/club/new", CLUB)
+
+def clubEditDelete(v):
+    clubID = v.newId(v.submit("clubNew", "/club/new", CLUB))
+    if clubID:
+        v.submit("clubEdit", f"/club/edit/{clubID}", dict(CLUB, name="Edited Club"))
+        v.timed("clubDelete", "GET", f"/club/delete/{clubID}")
+
+def joinClub(v):
+    # the join button is a plain form with no CSRF token
+    v.timed("joinClub", "POST", f"/club/join/{v.pick('club')}", {})
+
+def sportList(v):
+    v.timed("sportList", "GET", "/sports")
+
+def sport(v):
+    v.timed("sport", "GET", f"/sport/{v.pick('sport')}")
+
+SPORT = {"name": "Bench Ball", "coach": "Bench", "description": "x", "meeting_day": "Monday",
+         "meeting_time1": 3, "meeting_time2": 30, "meeting_place": "Field", "time_frame": "PM"}
+
+def sportNew(v):
+    v.submit("sportNew", "/sport/new", SPORT)
+
+def sportEditDelete(v):
+    sportID = v.newId(v.submit("sportNew", "/sport/new", SPORT))
+    if sportID:
+        v.submit("sportEdit", f"/sport/edit/{sportID}", dict(SPORT, name="Edited Ball"))
+        v.timed("sportDelete", "GET", f"/sport/delete/{sportID}")
+
+def clinicMap(v):
+    v.timed("clinicMap", "GET", "/clinic/map")
+
+def clinicList(v):
+    v.timed("clinicList", "GET", "/clinic/list")
+
+def clinic(v):
+    v.timed("clinic", "GET", f"/clinic/{v.pick('clinic')}")
+
+def clinicForm(v):
+    # Only the empty form. Posting it calls the OpenStreetMap geocoder for real,
+    # which would make the numbers about their servers instead of ours.
+    v.timed("clinicNew (form)", "GET", "/clinic/new")
+
+
+SCENARIOS = [
+    (index, 5), (aboutus, 1), (myProfile, 3), (profileEdit, 1),
+    (blogList, 3), (blog, 10), (blogPopular, 3), (blogNew, 2), (blogEdit, 1), (blogDelete, 1),
+    (commentNew, 3), (commentEditDelete, 1),
+    (reviewList, 3), (review, 6), (reviewBigTree, 2), (reviewNew, 1), (reviewEditDelete, 1), (replies, 2),
+    (slimeNew, 3),
+    (clubList, 3), (club, 6), (clubBig, 2), (clubNew, 1), (clubEditDelete, 1), (joinClub, 2),
+    (sportList, 2), (sport, 4), (sportNew, 1), (sportEditDelete, 1),
+    (clinicMap, 2), (clinicList, 2), (clinic, 4), (clinicForm, 1),
+]
+
+
+def percentile(sortedTimes, p):
+    index = min(len(sortedTimes) - 1, int(round(p / 100 * (len(sortedTimes) - 1))))
+    return sortedTimes[index]
+
+
+def summarize(times, errors, seconds):
+    ordered = sorted(times)
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "rps": round(len(ordered) / seconds, 2),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+# Adds up MongoDB's own operation counters. The difference before and after the run
+# is every operation the site caused (plus a few of our own, which are tiny).
+def mongoOps(db):
+    counters = db.command("serverStatus")["opcounters"]
+    return {name: int(value) for name, value in counters.items()}
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def worker(run, seed, stopAt, counter):
+    rnd = random.Random(seed)
+    visitor = Visitor(run, rnd)
+    functions = [s[0] for s in SCENARIOS]
+    weights = [s[1] for s in SCENARIOS]
+    while time.perf_counter() < stopAt:
+        with counter["lock"]:
+            if counter["left"] <= 0:
+                return
+            counter["left"] -= 1
+        try:
+            rnd.choices(functions, weights)[0](visitor)
+        except requests.RequestException:
+            pass
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Load test every route of a running site.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mongo-host", default=DEFAULT_HOST)
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run")
+    parser.add_argument("--max-scenarios", type=int, default=10 ** 9, help="stop after this many scenarios")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="where to write the JSON results")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    db = MongoClient(args.mongo_host)[args.db]
+    meta = db["bench_meta"].find_one({"_id": "seed"})
+    if meta is None:
+        print(f"Database '{args.db}' has not been seeded. Run bench/seed.py first.")
+        return 1
+    seeded = meta["args"]
+    sizes = {
+        "users": seeded["users"], "blog": seeded["blogs"], "review": seeded["reviews"], "club": seeded["clubs"],
+        "sport": seeded["sports"], "clinic": seeded["clinics"],
+        "reply_trees": seeded["reply_trees"], "big_clubs": seeded["big_clubs"],
+    }
+
+    run = Run(args.url, sizes, args.timeout)
+    counter = {"lock": threading.Lock(), "left": args.max_scenarios}
+    before = mongoOps(db)
+    began = time.perf_counter()
+    threads = [
+        threading.Thread(target=worker, args=(run, args.seed * 1000 + n, began + args.duration, counter))
+        for n in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - began
+    after = mongoOps(db)
+
+    delta = {name: after[name] - before.get(name, 0) for name in after}
+    allTimes = [t for times in run.times.values() for t in times]
+    report = {
+        "commit": gitCommit(),
+        "created": dt.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "seeded": seeded,
+        "seconds": round(seconds, 2),
+        "http_requests": run.sent,
+        "total": summarize(allTimes, sum(run.errors.values()), seconds) if allTimes else {},
+        "mongo": {
+            "opcounters": delta,
+            "ops_per_request": round(sum(delta.values()) / max(run.sent, 1), 2),
+        },
+        "routes": {name: summarize(times, run.errors.get(name, 0), seconds) for name, times in sorted(run.times.items())},
+    }
+
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+
+    print(f"{'route':<22}{'count':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in report["routes"].items():
+        print(f"{name:<22}{stats['count']:>7}{stats['errors']:>5}{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+    if allTimes:
+        print(f"\n{report['total']['rps']} requests/s, {report['mongo']['ops_per_request']} Mongo ops per request")
+    print(f"Saved {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# Starts a local MongoDB replica set for trying features that need one: reads from
+# secondaries (app/utils/readrouting.py) and change streams. It needs the mongod program
+# from a MongoDB Community install on your PATH.
+#
+#     python bench/replset.py                   (three members on ports 27017-27019)
+#     python bench/replset.py --members 1       (a single member replica set)
+#
+# It prints the MONGO_HOST to start the site with, for example
+#
+#     MONGO_HOST="mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0" \
+#         MONGO_DB_NAME=bench MONGO_READ_PREFERENCE=secondaryPreferred gunicorn
+#
+# and keeps running until you press ctrl-c, which stops every member. The data goes in a
+# temporary folder and is thrown away, so seed it with bench/seed.py --host <that host>.
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Run a throwaway local MongoDB replica set.")
+    parser.add_argument("--members", type=int, default=3)
+    parser.add_argument("--port", type=int, default=27017, help="port of the first member")
+    parser.add_argument("--name", default="rs0")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if shutil.which("mongod") is None:
+        print("mongod isn't on your PATH. Install MongoDB Community Server first.")
+        return 1
+    folder = tempfile.mkdtemp(prefix="replset-")
+    ports = [args.port + i for i in range(args.members)]
+    processes = []
+    try:
+        for port in ports:
+            dbpath = f"{folder}/{port}"
+            os.makedirs(dbpath)
+            processes.append(subprocess.Popen(
+                ["mongod", "--replSet", args.name, "--port", str(port), "--dbpath", dbpath,
+                 "--bind_ip", "localhost", "--logpath", f"{dbpath}/mongod.log"],
+            ))
+
+        first = MongoClient("localhost", ports[0], directConnection=True, serverSelectionTimeoutMS=30000)
+        first.admin.command("replSetInitiate", {
+            "_id": args.name,
+            "members": [{"_id": i, "host": f"localhost:{port}"} for i, port in enumerate(ports)],
+        })
+        host = f"mongodb://{','.join(f'localhost:{port}' for port in ports)}/?replicaSet={args.name}"
+        client = MongoClient(host, serverSelectionTimeoutMS=1000)
+        print("Waiting for a primary", end="", flush=True)
+        while True:
+            try:
+                client.admin.command("ping")
+                if client.primary:
+                    break
+            except PyMongoError:
+                pass
+            print(".", end="", flush=True)
+            time.sleep(1)
+        print(f"\nReplica set '{args.name}' is up. Use:\n\n    MONGO_HOST=\"{host}\"\n\nctrl-c to stop it.")
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+        print("A member stopped, shutting down.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+# Fills a local MongoDB with fake data so the load test (bench/loadtest.py) has
+# something realistic to work with. The default sizes are what we expect the site
+# to look like after a few years:
+#
+#     python bench/seed.py                      (100k users, 1M blogs, 1M comments ...)
+#     python bench/seed.py --scale 0.01         (1% of everything, good for a quick run)
+#     python bench/seed.py --blogs 5000         (change any one size)
+#
+# This ERASES the benchmark database first. It writes straight to MongoDB with
+# insert_many instead of going through the app so a million documents takes minutes,
+# not days. The documents look exactly like the ones mongoengine saves (see
+# app/classes/data.py).
+#
+# Everything is generated from a fixed random seed and the _ids are built from a counter,
+# so seeding twice gives the same database and the load test hits the same pages.
+
+import argparse
+import datetime as dt
+import os
+import random
+import struct
+import sys
+import time
+
+from bson import ObjectId
+from bson.dbref import DBRef
+from pymongo import MongoClient
+
+DEFAULT_HOST = os.environ.get("BENCH_MONGO_HOST", "mongodb://localhost:27017")
+DEFAULT_DB = os.environ.get("BENCH_DB", "bench")
+
+BATCH = 10000
+START = dt.datetime(2023, 8, 1)
+
+# one number per collection so ids from different collections never collide
+KINDS = {"user": 1, "blog": 2, "comment": 3, "review": 4, "reply": 5, "club": 6, "sport": 7, "clinic": 8, "slime": 9}
+
+HOSPITALS = [
+    "Wilma Chan Highland Hospital", "Alta Bates Summit Medical Center", "UCSF Benioff Children's Hospital",
+    "Kaiser Permanente", "Fairmont Rehabilitation & Wellness", "John George Psychiatric Pavilion",
+    "Alameda Hospital", "San Leandro Hospital",
+]
+EXPERIENCES = ["Patient Care", "Visitor", "Waiting Duration", "Internship/Leanring Programs", "Volunteer", "Patient", "Hospitality", "Other"]
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+WORDS = ("the quick brown fox jumps over lazy dog school club sport game team lunch class study "
+         "music art robot garden chess soccer basket ball track field debate science math book").split()
+
+
+# Makes the _id for document number i of a collection. The same kind and i always give
+# the same id, so any script can work out the id of "blog 1234" without a query.
+def makeId(kind, i):
+    return ObjectId(struct.pack(">IB3xI", int(START.timestamp()), KINDS[kind], i))
+
+
+def sentence(rnd, n):
+    return " ".join(rnd.choice(WORDS) for i in range(n))
+
+
+def when(rnd, total_minutes=60 * 24 * 365 * 2):
+    return START + dt.timedelta(minutes=rnd.randrange(total_minutes))
+
+
+# Sends documents to MongoDB BATCH at a time so memory stays small no matter how many
+# documents there are.
+def insertAll(db, name, docs, total):
+    collection = db[name]
+    batch = []
+    done = 0
+    began = time.perf_counter()
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == BATCH:
+            collection.insert_many(batch, ordered=False)
+            done += len(batch)
+            batch = []
+            print(f"\r  {name}: {done:,}/{total:,}", end="", flush=True)
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        done += len(batch)
+    print(f"\r  {name}: {done:,} in {time.perf_counter() - began:.1f}s")
+
+
+def users(rnd, count):
+    for i in range(count):
+        yield {
+            "_id": makeId("user", i),
+            "create_date": when(rnd),
+            "gid": f"bench{i}",
+            "gname": f"Bench User{i}",
+            "username": f"bench{i}",
+            "fname": "Bench",
+            "lname": f"User{i}",
+            "email": f"user{i}@bench.test",
+            "role": rnd.choice(["Student", "Student", "Student", "Teacher"]),
+            "grade": rnd.randint(9, 12),
+        }
+
+
+def blogs(rnd, count, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("blog", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "subject": sentence(rnd, 4),
+            "content": sentence(rnd, 60),
+            "tag": rnd.choice(WORDS),
+            "comment_count": 0,
+            "create_date": when(rnd),
+        }
+
+
+def comments(rnd, count, blogCount, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("comment", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            # most comments land on a few popular blogs, like real life
+            "blog": makeId("blog", min(int(rnd.paretovariate(1.2)) - 1, blogCount - 1)),
+            "content": sentence(rnd, 20),
+            "create_date": when(rnd),
+        }
+
+
+def reviews(rnd, count, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("review", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "name": rnd.choice(HOSPITALS),
+            "subject": rnd.choice(EXPERIENCES),
+            "text": sentence(rnd, 40),
+            "rating": rnd.randint(0, 10),
+            "reply_count": 0,
+            "create_date": when(rnd),
+        }
+
+
+# Builds one reply tree on a review. Each new reply either starts a new thread or answers
+# a random earlier reply, which gives a few very deep, very busy threads. The parent keeps
+# a list of its children and the child keeps its parent and ancestors, the same way
+# replyNewRep does.
+def replyTree(rnd, review, size, firstIndex, userCount):
+    tree = []
+    for n in range(size):
+        doc = {
+            "_id": makeId("reply", firstIndex + n),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "review": makeId("review", review),
+            "name": HOSPITALS[review % len(HOSPITALS)],
+            "text": sentence(rnd, 15),
+            "replies": [],
+            "create_date": when(rnd),
+        }
+        if not tree or rnd.random() < 0.1:
+            doc["outer"] = True
+            doc["dFromOuter"] = 0
+            doc["ancestors"] = []
+        else:
+            parent = tree[rnd.randrange(len(tree))]
+            doc["outer"] = False
+            doc["dFromOuter"] = parent["dFromOuter"] + 1
+            doc["parent"] = parent["_id"]
+            doc["ancestors"] = parent["ancestors"] + [parent["_id"]]
+            parent["replies"].append({"_cls": "Reply", "_ref": DBRef("reply", doc["_id"])})
+        tree.append(doc)
+    return tree
+
+
+def replies(rnd, reviewCount, trees, treeSize, userCount):
+    index = 0
+    for review in range(min(trees, reviewCount)):
+        yield from replyTree(rnd, review, treeSize, index, userCount)
+        index += treeSize
+    # every other review gets a handful of replies
+    for review in range(min(trees, reviewCount), reviewCount):
+        small = replyTree(rnd, review, rnd.randint(0, 5), index, userCount)
+        yield from small
+        index += len(small)
+
+
+def clubs(rnd, count, bigClubs, members, userCount):
+    for i in range(count):
+        size = min(members if i < bigClubs else rnd.randint(0, 40), userCount)
+        yield {
+            "_id": makeId("club", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "name": f"{sentence(rnd, 2).title()} Club {i}",
+            "advisor": f"Teacher {rnd.randrange(200)}",
+            "description": sentence(rnd, 30),
+            "meeting_place": f"Room {rnd.randint(100, 400)}",
+            "meeting_day": rnd.choice(DAYS),
+            "meeting_time": rnd.choice(["Advisory", "Lunch", "After School"]),
+            "members": [makeId("user", u) for u in rnd.sample(range(userCount), size)],
+            "member_count": size,
+            "create_date": when(rnd),
+        }
+
+
+def sports(rnd, count, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("sport", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "name": f"{sentence(rnd, 1).title()} {i}",
+            "coach": f"Coach {rnd.randrange(100)}",
+            "description": sentence(rnd, 30),
+            "meeting_place": "Field",
+            "meeting_day": rnd.choice(DAYS),
+            "meeting_time1": rnd.randint(1, 12),
+            "meeting_time2": rnd.choice([0, 15, 30, 45]),
+            "time_frame": rnd.choice(["AM", "PM"]),
+            "create_date": when(rnd),
+        }
+
+
+def clinics(rnd, count, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("clinic", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "create_date": when(rnd),
+            "name": f"Clinic {i}",
+            "streetAddress": f"{rnd.randint(1, 9999)} {rnd.choice(WORDS).title()} St",
+            "city": "Oakland",
+            "state": "CA",
+            "zipcode": f"946{rnd.randint(0, 99):02d}",
+            "description": sentence(rnd, 20),
+            # somewhere around the East Bay
+            "lat": 37.80 + rnd.uniform(-0.15, 0.15),
+            "lon": -122.27 + rnd.uniform(-0.15, 0.15),
+        }
+
+
+def slimes(rnd, count, userCount):
+    for i in range(count):
+        yield {
+            "_id": makeId("slime", i),
+            "author": makeId("user", rnd.randrange(userCount)),
+            "sleep_time": rnd.randint(1, 12),
+            "time_frame": rnd.choice(["AM", "PM"]),
+            "create_date": when(rnd),
+        }
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Seed a benchmark database with fake data.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--seed", type=int, default=2023)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every size by this")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--blogs", type=int, default=1000000)
+    parser.add_argument("--comments", type=int, default=1000000)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--reply-trees", type=int, default=5, help="reviews that get a huge reply tree")
+    parser.add_argument("--tree-size", type=int, default=10000, help="replies in each huge tree")
+    parser.add_argument("--clubs", type=int, default=500)
+    parser.add_argument("--big-clubs", type=int, default=20, help="clubs that get --club-members members")
+    parser.add_argument("--club-members", type=int, default=5000)
+    parser.add_argument("--sports", type=int, default=200)
+    parser.add_argument("--clinics", type=int, default=50000)
+    parser.add_argument("--slimes", type=int, default=100000)
+    args = parser.parse_args(argv)
+    for name in ["users", "blogs", "comments", "reviews", "tree_size", "clubs", "club_members", "sports", "clinics", "slimes"]:
+        setattr(args, name, max(1, int(getattr(args, name) * args.scale)))
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    rnd = random.Random(args.seed)
+    client = MongoClient(args.host)
+    client.drop_database(args.db)
+    db = client[args.db]
+    print(f"Seeding {args.host} database '{args.db}'")
+
+    insertAll(db, "user", users(rnd, args.users), args.users)
+    insertAll(db, "blog", blogs(rnd, args.blogs, args.users), args.blogs)
+    insertAll(db, "comment", comments(rnd, args.comments, args.blogs, args.users), args.comments)
+    insertAll(db, "review", reviews(rnd, args.reviews, args.users), args.reviews)
+    treeTotal = min(args.reply_trees, args.reviews) * args.tree_size
+    insertAll(db, "reply", replies(rnd, args.reviews, args.reply_trees, args.tree_size, args.users), treeTotal)
+    insertAll(db, "club", clubs(rnd, args.clubs, args.big_clubs, args.club_members, args.users), args.clubs)
+    insertAll(db, "sport", sports(rnd, args.sports, args.users), args.sports)
+    insertAll(db, "clinic", clinics(rnd, args.clinics, args.users), args.clinics)
+    insertAll(db, "slime", slimes(rnd, args.slimes, args.users), args.slimes)
+
+    # the indexes mongoengine would make from the meta in data.py
+    db["user"].create_index("gid", unique=True, sparse=True)
+    db["reply"].create_index("ancestors")
+    db["reply"].create_index([("review", 1), ("dFromOuter", 1)])
+    db["comment"].create_index("blog")
+    db["comment"].create_index("comment")
+    for name in ["blog", "comment", "clinic", "review", "reply", "slime", "club", "sport"]:
+        db[name].create_index("author")
+    db["club"].create_index("members")
+    for name in ["blog", "review", "club", "sport", "clinic"]:
+        db[name].create_index([("create_date", -1), ("_id", -1)])
+    # Comments and replies are generated separately from their blogs and reviews, so
+    # count them the same way 'flask data reconcile-counters' does.
+    for parent, child, field, counter in [("blog", "comment", "blog", "comment_count"), ("review", "reply", "review", "reply_count")]:
+        for row in db[child].aggregate([{"$group": {"_id": "$" + field, "n": {"$sum": 1}}}]):
+            db[parent].update_one({"_id": row["_id"]}, {"$set": {counter: row["n"]}})
+    # Remember what was seeded so the load test knows which ids exist.
+    db["bench_meta"].insert_one({
+        "_id": "seed",
+        "args": vars(args),
+        "created": dt.datetime.utcnow(),
+    })
+    print("Done.")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# This is the production setup. main.py runs the Werkzeug development server which is
+# great for working on the site but can only handle one thing at a time. Gunicorn runs
+# several copies (workers) of the app at once. Start it from this folder with:
+#
+#     gunicorn
+#
+# gunicorn automatically reads this file. Every setting can be changed with an
+# environment variable so nothing here needs to be edited on the server.
+
+import os
+import multiprocessing
+import shutil
+import tempfile
+
+# Each worker writes its /metrics numbers to files in this folder so they can be added up
+# across workers (see app/utils/metrics.py). It has to be set before the app is imported,
+# and emptied so numbers from the last time the server ran aren't added in.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "maciepractice-metrics"))
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+# This is the app object in app/__init__.py
+wsgi_app = "app:app"
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# A worker is a separate process and threads are how many requests each worker can
+# handle at the same time. Most of our time is spent waiting on MongoDB so threads help.
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = 5
+
+# preload imports the app once in the master process and then forks the workers from
+# it. This makes startup faster, uses less memory and means every worker shares the same
+# FLASK_SECRET_KEY even when it comes from os.urandom().
+preload_app = True
+
+# Restart workers now and then so a slow memory leak can't take the site down.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+
+accesslog = "-"
+errorlog = "-"
+
+
+# A worker that stopped can't be serving requests, so drop its in-progress and
+# connection counts.
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+# This runs inside each new worker right after it is forked from the master. The
+# MongoDB client from the master can't be shared between processes, so each worker
+# makes its own. One connection per thread is all a worker can ever use at once.
+def post_fork(server, worker):
+    from app import connectDB
+    connectDB(maxPoolSize=server.cfg.threads)
+    server.log.info("Worker %s connected to MongoDB (maxPoolSize=%s)", worker.pid, server.cfg.threads)
+    # Build the autocomplete name index now so the first search doesn't wait for it. If
+    # the database isn't reachable yet the first search builds it instead.
+    from app import autocomplete
+    try:
+        autocomplete.ensureBuilt()
+    except Exception:
+        server.log.exception("Worker %s couldn't build the autocomplete index", worker.pid)
+
+
+# Runs in a worker when it stops normally (restart after max_requests, deploy, ctrl-c).
+# Stops the write-behind thread and saves any slime check-ins still waiting in its buffer.
+def worker_exit(server, worker):
+    from app.routes.slime import slimeWrites
+    saved = slimeWrites.close()
+    if saved:
+        server.log.info("Worker %s saved %s buffered check-ins on exit", worker.pid, saved)